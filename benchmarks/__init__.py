@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks, each runnable as a module, e.g. python -m benchmarks.upsert."""
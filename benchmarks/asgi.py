@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Compare the ASGI and WSGI applications at many concurrent connections.
+
+Each connection sends its requests one after another, as a client with a
+keep-alive connection would. The WSGI application is served by a pool of
+worker threads, as by a threaded server, so connections beyond the workers
+queue for one. The ASGI application serves every connection on one event
+loop, whose requests yield to others while they wait on the database.
+
+Both have the same middleware for their sessions and codecs, and the WSGI
+application's response cache is disabled, so that every request reaches
+the database. Requests are sent in-process rather than through servers,
+so the numbers are those of the applications and their concurrency alone.
+Most requests read a user or a group, and the rest create a user.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.endpoints.drivers import InProcess
+from benchmarks.endpoints.report import percentile
+
+
+def configure(path):
+    """Point the apps at a database file, before they are first imported."""
+    os.environ['FALCON_EXPERIMENT_DATABASE_URL'] = 'sqlite:///{}'.format(path)
+
+
+def requests(label, users, groups, writes):
+    """Return a function returning the nth request of a run.
+
+    Users created are named after the run's label, so that runs sharing a
+    database each create new ones.
+    """
+    from benchmarks.endpoints.scenarios import get, send
+    from benchmarks.endpoints.seed import email
+
+    def request(number):
+        chooser = random.Random(number)
+        if chooser.random() < writes:
+            return send('POST', '/user', {
+                'email': 'new.{}.{}@example.com'.format(label, number),
+                'username': 'New',
+            })
+        if chooser.random() < 0.25:
+            return get('/group/{}'.format(chooser.randint(1, groups)))
+        return get('/user/{}'.format(email(chooser.randrange(users))))
+    return request
+
+
+def run_wsgi(application, workers, connections, count, request):
+    """Send count requests over connections to a pool of worker threads.
+
+    Returns the latency, from being sent to being answered, and the status
+    of each request, and the seconds they all took.
+    """
+    driver = InProcess(application)
+    latencies = [None] * count
+    statuses = [None] * count
+    numbers = iter(range(count))
+    lock = threading.Lock()
+    answered = []
+    done = threading.Event()
+
+    with ThreadPoolExecutor(workers) as executor:
+        def submit():
+            with lock:
+                number = next(numbers, None)
+            if number is None:
+                return
+            began = time.perf_counter()
+            future = executor.submit(driver.send, *request(number))
+            future.add_done_callback(
+                lambda future: finish(number, began, future)
+            )
+
+        def finish(number, began, future):
+            latencies[number] = time.perf_counter() - began
+            try:
+                statuses[number] = future.result()
+            finally:
+                # The connection sends its next request
+                submit()
+                with lock:
+                    answered.append(number)
+                    if len(answered) == count:
+                        done.set()
+
+        began = time.perf_counter()
+        for _ in range(min(connections, count)):
+            submit()
+        done.wait()
+        seconds = time.perf_counter() - began
+    return latencies, statuses, seconds
+
+
+async def call(application, method, path, query_string, body):
+    """Call an ASGI application, returning the code of its status."""
+    body = body.encode() if body else b''
+    headers = [(b'content-length', str(len(body)).encode())]
+    if body:
+        headers.append((b'content-type', b'application/json'))
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query_string.encode(),
+        'headers': headers,
+    }
+    statuses = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    await application(scope, receive, send)
+    return statuses[0]
+
+
+async def run_asgi(application, connections, count, request):
+    """Send count requests over connections, each a task on the loop.
+
+    Returns as run_wsgi does.
+    """
+    latencies = [None] * count
+    statuses = [None] * count
+    numbers = iter(range(count))
+
+    async def connection():
+        for number in numbers:
+            began = time.perf_counter()
+            statuses[number] = await call(application, *request(number))
+            latencies[number] = time.perf_counter() - began
+
+    began = time.perf_counter()
+    await asyncio.gather(*(
+        connection() for _ in range(min(connections, count))
+    ))
+    return latencies, statuses, time.perf_counter() - began
+
+
+def report(connections, name, latencies, statuses, seconds):
+    """Print a line of a run's results, returning its errors."""
+    errors = sum(status not in (200, 201) for status in statuses)
+    print('{:>11} {:5} {:10.0f} {:9.2f} {:9.2f} {:7}'.format(
+        connections, name, len(latencies) / seconds,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        errors,
+    ))
+    return errors
+
+
+def run(args):
+    """Run both applications at each number of connections.
+
+    Returns the number of requests answered with an error.
+    """
+    from falcon_experiment import app, async_db
+    from falcon_experiment.asgi import asgi_application
+
+    from benchmarks.endpoints.seed import seed
+
+    seed(args.users, args.groups, args.members)
+    app.cache.capacity = 0
+    wsgi_application = app.create_api(
+        middleware=[app.RequireCodec(), app.DBSession()]
+    )
+    loop = asyncio.new_event_loop()
+    print('connections app   requests/s    p50 ms    p99 ms  errors')
+    errors = 0
+    try:
+        for connections in args.connections:
+            request = requests(
+                'wsgi.{}'.format(connections),
+                args.users, args.groups, args.writes,
+            )
+            errors += report(connections, 'wsgi', *run_wsgi(
+                wsgi_application, args.workers, connections,
+                args.requests, request,
+            ))
+            request = requests(
+                'asgi.{}'.format(connections),
+                args.users, args.groups, args.writes,
+            )
+            errors += report(connections, 'asgi', *loop.run_until_complete(
+                run_asgi(asgi_application, connections, args.requests, request)
+            ))
+    finally:
+        loop.run_until_complete(async_db.engine.dispose())
+        loop.close()
+    return errors
+
+
+def main():
+    """Run the benchmark, exiting non-zero if any request failed."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--members', type=int, default=100,
+                        help='users in each group')
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='requests sent at each number of connections')
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help='numbers of concurrent connections to run at')
+    parser.add_argument('--workers', type=int, default=15,
+                        help='threads serving the WSGI application, by '
+                             'default as many as the pool has connections')
+    parser.add_argument('--writes', type=float, default=0.1,
+                        help='fraction of requests that create a user')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        configure(os.path.join(directory, 'benchmark.db'))
+        errors = run(args)
+    if errors:
+        sys.exit('{} requests failed'.format(errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Compare concurrent user creates per second with and without coalescing.
+
+Threads in one process POST new users to the app in-process, against a
+SQLite file. Without coalescing, each create is committed on its own.
+With it, the creates of concurrent requests are committed together. Each
+mode runs in a process of its own, spawned with the settings for it.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+
+def configure(path, delay, synchronous):
+    """Point the app at a database file and set the coalescing delay."""
+    os.environ['FALCON_EXPERIMENT_DATABASE_URL'] = 'sqlite:///{}'.format(path)
+    os.environ['FALCON_EXPERIMENT_COALESCE_DELAY'] = str(delay)
+    os.environ['FALCON_EXPERIMENT_SQLITE_SYNCHRONOUS'] = synchronous
+
+
+def work(threads, seconds, results):
+    """Create users from several threads, reporting creates and commits."""
+    from sqlalchemy import event
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    from falcon_experiment import app
+    from falcon_experiment.db import engine
+
+    commits = []
+    event.listen(engine, 'commit', lambda connection: commits.append(1))
+    counts = []
+    deadline = time.perf_counter() + seconds
+
+    def create(number):
+        client = Client(app.application, BaseResponse)
+        created = errors = 0
+        while time.perf_counter() < deadline:
+            response = client.post(
+                '/user',
+                data=json.dumps({
+                    'email': 'user.{}.{}@example.com'.format(number, created),
+                    'username': 'User',
+                }),
+                content_type='application/json',
+            )
+            if response.status_code == 201:
+                created += 1
+            else:
+                errors += 1
+        counts.append((created, errors))
+
+    workers = [
+        threading.Thread(target=create, args=(number,))
+        for number in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    results.put((
+        sum(created for created, _ in counts),
+        sum(errors for _, errors in counts),
+        len(commits),
+    ))
+
+
+def run(context, delay, synchronous, threads, seconds):
+    """Run a mode, returning creates, errors and commits per second."""
+    with tempfile.TemporaryDirectory() as directory:
+        configure(
+            os.path.join(directory, 'benchmark.db'), delay, synchronous
+        )
+        results = context.Queue()
+        process = context.Process(
+            target=work, args=(threads, seconds, results)
+        )
+        process.start()
+        created, errors, commits = results.get()
+        process.join()
+
+    return created / seconds, errors / seconds, commits / seconds
+
+
+def main():
+    """Run the benchmark with and without coalescing, and compare them."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--delay', type=float, default=2,
+                        help='milliseconds to gather creates for')
+    parser.add_argument('--synchronous', default='FULL',
+                        help='SQLite synchronous pragma, FULL or NORMAL')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print('{:12} {:>10} {:>10} {:>10}'.format(
+        'mode', 'creates/s', 'errors/s', 'commits/s'
+    ))
+    for name, delay in (('alone', 0), ('coalesced', args.delay)):
+        rates = run(
+            context, delay, args.synchronous, args.threads, args.seconds
+        )
+        print('{:12} {:10.0f} {:10.0f} {:10.0f}'.format(name, *rates))
+
+
+if __name__ == '__main__':
+    main()
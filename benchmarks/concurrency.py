@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Compare concurrent reader and writer throughput of SQLite profiles.
+
+Reader and writer processes share one SQLite file, each driving the app
+in-process: readers GET users, and writers POST new ones. The response
+cache is disabled so that every read reaches the database. The rollback
+journal profile is SQLite's default. The WAL profile is the one the app
+uses for SQLite files by default. In memory databases are private to a
+connection, so cannot be shared, and are not compared.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+PROFILES = [
+    ('rollback journal', {'JOURNAL_MODE': 'DELETE', 'SYNCHRONOUS': 'FULL'}),
+    ('WAL', {'JOURNAL_MODE': 'WAL', 'SYNCHRONOUS': 'NORMAL'}),
+]
+
+
+def configure(path, pragmas):
+    """Point the app at a database file with pragmas, via the environment.
+
+    Processes are spawned, so they import the app afresh with these set.
+    """
+    os.environ['FALCON_EXPERIMENT_DATABASE_URL'] = 'sqlite:///{}'.format(path)
+    for name, value in pragmas.items():
+        os.environ['FALCON_EXPERIMENT_SQLITE_' + name] = value
+
+
+def seed(users):
+    """Create the tables, and the users readers will read."""
+    from falcon_experiment import app  # noqa: creates the tables
+    from falcon_experiment.db import Session
+    from falcon_experiment.models import User
+
+    User.bulk_create(User.email, (
+        {'email': 'user.{}@example.com'.format(number), 'username': 'User'}
+        for number in range(users)
+    ))
+    Session.commit()
+    Session.remove()
+
+
+def work(role, number, users, seconds, results):
+    """Read or write for a number of seconds, reporting requests and errors.
+
+    Requests that fail because the database stayed locked are counted as
+    errors.
+    """
+    from sqlalchemy.exc import OperationalError
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    from falcon_experiment import app
+    from falcon_experiment.db import Session
+
+    app.cache.capacity = 0
+    client = Client(app.application, BaseResponse)
+    requests = errors = count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            if role == 'reader':
+                response = client.get('/user/user.{}@example.com'.format(
+                    random.randrange(users)
+                ))
+            else:
+                response = client.post(
+                    '/user',
+                    data=json.dumps({
+                        'email': 'writer.{}.{}@example.com'.format(
+                            number, count
+                        ),
+                        'username': 'Writer',
+                    }),
+                    content_type='application/json',
+                )
+                count += 1
+        except OperationalError:
+            Session.remove()
+            errors += 1
+            continue
+
+        if response.status_code >= 500:
+            errors += 1
+        else:
+            requests += 1
+
+    results.put((role, requests, errors))
+
+
+def run(context, pragmas, readers, writers, users, seconds):
+    """Run a profile, returning requests and errors per second by role."""
+    with tempfile.TemporaryDirectory() as directory:
+        configure(os.path.join(directory, 'benchmark.db'), pragmas)
+        process = context.Process(target=seed, args=(users,))
+        process.start()
+        process.join()
+
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=work,
+                args=(role, number, users, seconds, results),
+            )
+            for number, role in enumerate(
+                ['reader'] * readers + ['writer'] * writers
+            )
+        ]
+        for process in processes:
+            process.start()
+        totals = {
+            'reader': [0, 0],
+            'writer': [0, 0],
+        }
+        for _ in processes:
+            role, requests, errors = results.get()
+            totals[role][0] += requests
+            totals[role][1] += errors
+        for process in processes:
+            process.join()
+
+    return {
+        role: (requests / seconds, errors / seconds)
+        for role, (requests, errors) in totals.items()
+    }
+
+
+def main():
+    """Run the benchmark for each profile and print a comparison."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print('{:16} {:>10} {:>10} {:>10} {:>10}'.format(
+        'profile', 'reads/s', 'errors/s', 'writes/s', 'errors/s'
+    ))
+    for name, pragmas in PROFILES:
+        rates = run(
+            context, pragmas,
+            args.readers, args.writers, args.users, args.seconds,
+        )
+        print('{:16} {:10.0f} {:10.0f} {:10.0f} {:10.0f}'.format(
+            name, *(rates['reader'] + rates['writer'])
+        ))
+
+
+if __name__ == '__main__':
+    main()
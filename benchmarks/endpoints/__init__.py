@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of every endpoint, with a baseline to catch regressions.
+
+Run as python -m benchmarks.endpoints. The app is pointed at a SQLite file,
+which is seeded with users, groups and memberships, before each route is
+driven both in-process, calling the WSGI application directly, and over
+HTTP, through a local multi-threaded server. Throughput and p50 and p99
+latencies are reported per endpoint, and may be saved as a baseline, or
+compared with one to fail when an endpoint has regressed.
+
+The app reads its settings when first imported, so the modules of this
+package, which import it, are only imported once the database is set.
+"""
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Benchmark every endpoint, in-process and over HTTP.
+
+Each driver starts from a freshly seeded database. Exits non-zero if any
+request was answered with a status its endpoint does not expect, or if an
+endpoint regressed past the tolerance of a baseline.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+
+def configure(path):
+    """Point the app at a database file, before it is first imported."""
+    os.environ['FALCON_EXPERIMENT_DATABASE_URL'] = 'sqlite:///{}'.format(path)
+
+
+def run(args):
+    """Run the benchmark of each driver, returning the summaries."""
+    from falcon_experiment import app
+
+    from benchmarks.endpoints import drivers, report, scenarios
+    from benchmarks.endpoints.seed import seed
+
+    # Writers waiting for SQLite's lock would be logged as slow requests
+    logging.getLogger(app.__name__).setLevel(logging.ERROR)
+    run = {'parameters': {
+        'users': args.users,
+        'groups': args.groups,
+        'members': args.members,
+        'requests': args.requests,
+        'threads': args.threads,
+    }, 'drivers': OrderedDict()}
+    for driver in (
+        drivers.InProcess(app.application),
+        drivers.HTTP(app.application, args.threads),
+    ):
+        if args.driver and driver.name not in args.driver:
+            continue
+
+        seed(args.users, args.groups, args.members)
+        summaries = run['drivers'][driver.name] = OrderedDict()
+        with driver:
+            for endpoint in scenarios.endpoints(
+                args.users, args.groups, args.members
+            ):
+                if args.endpoint and endpoint.name not in args.endpoint:
+                    continue
+                if endpoint.prepare is not None:
+                    endpoint.prepare(args.requests)
+                summaries[endpoint.name] = report.summarise(
+                    endpoint, driver.run(endpoint, args.requests)
+                )
+        print(report.table(driver.name, summaries))
+    return run
+
+
+def main():
+    """Run the benchmarks, and check them against a baseline if given."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--members', type=int, default=100,
+                        help='users in each group')
+    parser.add_argument('--requests', type=int, default=300,
+                        help='requests made of each endpoint')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads sending requests over HTTP')
+    parser.add_argument('--driver', action='append',
+                        choices=['in-process', 'http'],
+                        help='run only this driver, may be repeated')
+    parser.add_argument('--endpoint', action='append',
+                        help='run only this endpoint, e.g. "GET /user", '
+                             'may be repeated')
+    parser.add_argument('--save', metavar='PATH',
+                        help='save the results as a baseline')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='fail if the results regressed from these')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction by which throughput and p50 may be '
+                             'worse than the baseline')
+    parser.add_argument('--tail-tolerance', type=float, default=1,
+                        help='fraction by which p99 may be worse than the '
+                             'baseline')
+    parser.add_argument('--slack', type=float, default=1,
+                        help='milliseconds by which latencies may always be '
+                             'worse than the baseline')
+    args = parser.parse_args()
+
+    from benchmarks.endpoints import report
+
+    baseline = report.load(args.baseline) if args.baseline else None
+    with tempfile.TemporaryDirectory() as directory:
+        configure(os.path.join(directory, 'benchmark.db'))
+        results = run(args)
+
+    if args.save:
+        report.save(results, args.save)
+
+    failures = report.errors(results)
+    if baseline is not None:
+        if baseline['parameters'] != results['parameters']:
+            sys.exit('The baseline was run with other parameters: {}'.format(
+                baseline['parameters']
+            ))
+        failures.extend(
+            report.regressions(
+                results, baseline,
+                args.tolerance, args.tail_tolerance, args.slack,
+            )
+        )
+    if failures:
+        sys.exit('Failed:\n' + '\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Drivers sending the requests of an endpoint, and timing each of them.
+
+InProcess calls the WSGI application directly, so its latencies are those
+of the app alone. HTTP sends requests over local connections to a
+multi-threaded server from several threads at once, so its latencies
+include the server, the connections and the contention between requests.
+"""
+
+import http.client
+import threading
+import time
+
+from falcon.testing import create_environ
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+#: Requests made of GET /user before timing, to warm up the app
+WARM_UP = 10
+
+
+class Result(object):
+
+    """The latencies and statuses of requests, and the seconds they took."""
+
+    def __init__(self, latencies, statuses, seconds):
+        self.latencies = latencies
+        self.statuses = statuses
+        self.seconds = seconds
+
+
+class Driver(object):
+
+    """Sends the requests of endpoints from a number of threads at once.
+
+    Request n is sent by thread n modulo threads.
+    """
+
+    #: Name of the driver, in reports and baselines
+    name = None
+
+    def __init__(self, application, threads=1):
+        self.application = application
+        self.threads = threads
+
+    def __enter__(self):
+        for _ in range(WARM_UP):
+            self.send('GET', '/user', '', None)
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def send(self, method, path, query_string, body):
+        """Send a request, returning the code of the response's status."""
+        raise NotImplementedError
+
+    def run(self, endpoint, count):
+        """Send count requests of an endpoint, returning their Result."""
+        latencies = [None] * count
+        statuses = [None] * count
+
+        def work(first):
+            for number in range(first, count, self.threads):
+                request = endpoint.request(number)
+                began = time.perf_counter()
+                statuses[number] = self.send(*request)
+                latencies[number] = time.perf_counter() - began
+
+        threads = [
+            threading.Thread(target=work, args=(first,))
+            for first in range(self.threads)
+        ]
+        began = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return Result(latencies, statuses, time.perf_counter() - began)
+
+
+class InProcess(Driver):
+
+    """Calls the WSGI application directly, as a server would."""
+
+    name = 'in-process'
+
+    def send(self, method, path, query_string, body):
+        """Call the application, reading the whole body of the response."""
+        environ = create_environ(
+            path=path,
+            query_string=query_string,
+            method=method,
+            body=body or '',
+            headers={'Content-Type': 'application/json'} if body else None,
+        )
+        statuses = []
+
+        def start_response(status, headers, exc_info=None):
+            statuses.append(status)
+
+        chunks = self.application(environ, start_response)
+        try:
+            for _ in chunks:
+                pass
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return int(statuses[0].split(' ', 1)[0])
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    """Handles requests without logging each of them."""
+
+    def log(self, type, message, *args):
+        """Log nothing."""
+
+
+class HTTP(Driver):
+
+    """Sends requests to a local multi-threaded server of the application.
+
+    Each request is sent over a connection of its own.
+    """
+
+    name = 'http'
+
+    def __enter__(self):
+        self.server = make_server(
+            '127.0.0.1', 0, self.application,
+            threaded=True, request_handler=QuietHandler,
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return super(HTTP, self).__enter__()
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def send(self, method, path, query_string, body):
+        """Send a request, reading the whole body of the response."""
+        connection = http.client.HTTPConnection(
+            '127.0.0.1', self.server.server_port
+        )
+        try:
+            connection.request(
+                method,
+                path + ('?' + query_string if query_string else ''),
+                body=body,
+                headers={'Content-Type': 'application/json'} if body else {},
+            )
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Summaries of the results of a run, and their comparison with a baseline.
+
+A run is saved as JSON: the numbers it was run with, and a summary of
+each endpoint for each driver, e.g.:
+
+    {"parameters": {"users": 10000, ...},
+     "drivers": {"http": {"GET /user": {"throughput": 812.4,
+                                        "p50_ms": 4.1, "p99_ms": 9.8,
+                                        "errors": 0}, ...}, ...}}
+"""
+
+import json
+import math
+
+
+def percentile(values, fraction):
+    """Return the nearest rank percentile of values, e.g. 0.99 for p99."""
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarise(endpoint, result):
+    """Return the throughput, p50, p99 and errors of an endpoint's Result.
+
+    Requests answered with a status the endpoint does not expect are
+    errors.
+    """
+    return {
+        'throughput': len(result.latencies) / result.seconds,
+        'p50_ms': percentile(result.latencies, 0.5) * 1000,
+        'p99_ms': percentile(result.latencies, 0.99) * 1000,
+        'errors': sum(
+            status not in endpoint.expected for status in result.statuses
+        ),
+    }
+
+
+def regressions(run, baseline, tolerance, tail_tolerance, slack_ms):
+    """Return a line for each way the run is worse than the baseline.
+
+    Endpoints regress if their throughput shrank by more than a fraction
+    tolerance of the baseline's, or their latency grew by more than both
+    slack_ms and a fraction of the baseline's: tolerance of their p50, and
+    tail_tolerance of their p99, which varies more from run to run.
+    Endpoints the baseline lacks are not compared.
+    """
+    tolerances = (('p50_ms', tolerance), ('p99_ms', tail_tolerance))
+    lines = []
+    for driver, endpoints in sorted(run['drivers'].items()):
+        for name, summary in sorted(endpoints.items()):
+            before = baseline['drivers'].get(driver, {}).get(name)
+            if before is None:
+                continue
+
+            for metric, allowed in tolerances:
+                limit = max(
+                    before[metric] * (1 + allowed), before[metric] + slack_ms
+                )
+                if summary[metric] > limit:
+                    lines.append('{} {}: {} {:.2f} > {:.2f}'.format(
+                        driver, name, metric, summary[metric], before[metric]
+                    ))
+            if summary['throughput'] < before['throughput'] / (1 + tolerance):
+                lines.append('{} {}: throughput {:.0f}/s < {:.0f}/s'.format(
+                    driver, name, summary['throughput'], before['throughput']
+                ))
+    return lines
+
+
+def errors(run):
+    """Return a line for each endpoint with errors."""
+    return [
+        '{} {}: {} errors'.format(driver, name, summary['errors'])
+        for driver, endpoints in sorted(run['drivers'].items())
+        for name, summary in sorted(endpoints.items())
+        if summary['errors']
+    ]
+
+
+def table(driver, endpoints):
+    """Return a table of a driver's endpoint summaries, in order."""
+    lines = ['{}:'.format(driver), '  {:26} {:>10} {:>9} {:>9} {:>7}'.format(
+        'endpoint', 'requests/s', 'p50 ms', 'p99 ms', 'errors'
+    )]
+    lines.extend(
+        '  {:26} {:10.0f} {:9.2f} {:9.2f} {:7}'.format(
+            name, summary['throughput'], summary['p50_ms'],
+            summary['p99_ms'], summary['errors'],
+        )
+        for name, summary in endpoints.items()
+    )
+    return '\n'.join(lines)
+
+
+def load(path):
+    """Return a run saved as JSON."""
+    with open(path) as saved:
+        return json.load(saved)
+
+
+def save(run, path):
+    """Save a run as JSON."""
+    with open(path, 'w') as saved:
+        json.dump(run, saved, indent=2, sort_keys=True)
+        saved.write('\n')
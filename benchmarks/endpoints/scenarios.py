@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""The endpoints benchmarked, and the requests made of each.
+
+Each endpoint makes its nth request the same way every run, choosing users
+and groups at random from a generator seeded with n, however requests are
+spread over threads. Endpoints that delete prepare what they delete before
+they are timed, and endpoints that create make new names, so that each
+request does the same work.
+"""
+
+import json
+import random
+from collections import namedtuple
+
+from falcon_experiment.db import engine
+from falcon_experiment.models import Group, User, groups_to_users
+
+from benchmarks.endpoints.seed import email, insert
+
+#: A request, as given to a driver
+Request = namedtuple('Request', 'method path query_string body')
+
+#: Users created by each bulk POST /user
+BULK_SIZE = 100
+#: Users deleted by each DELETE /user
+DELETE_SIZE = 10
+#: Group ids of groups prepared for deletion start after this
+DELETED_GROUPS = 1000000
+
+
+class Endpoint(object):
+
+    """An endpoint, the requests made of it, and the statuses they expect.
+
+    request is called with the number of each request, and returns it.
+    prepare, if given, is called with the number of requests to be made,
+    before they are timed.
+    """
+
+    def __init__(self, name, request, expected=(200,), prepare=None):
+        self.name = name
+        self.request = request
+        self.expected = frozenset(expected)
+        self.prepare = prepare
+
+
+def get(path, query_string=''):
+    """Return a GET request."""
+    return Request('GET', path, query_string, None)
+
+
+def send(method, path, document, query_string=''):
+    """Return a request with a JSON document as its body."""
+    return Request(method, path, query_string, json.dumps(document))
+
+
+def prepare_users(prefix, group, count):
+    """Return a function creating users, each in a group, to be deleted."""
+    def prepare(requests):
+        with engine.begin() as connection:
+            insert(connection, User.__table__, (
+                {'email': '{}.{}@example.com'.format(prefix, number),
+                 'username': 'Doomed', 'version': 'seed'}
+                for number in range(requests * count)
+            ))
+            insert(connection, groups_to_users, (
+                {'group_id': group(number),
+                 'user_email': '{}.{}@example.com'.format(prefix, number)}
+                for number in range(requests * count)
+            ))
+    return prepare
+
+
+def endpoints(users, groups, members):
+    """Return the endpoints, for a database seeded with these numbers."""
+    def user(number):
+        return email(random.Random(number).randrange(users))
+
+    def two_users(number):
+        return [
+            email(chosen)
+            for chosen in random.Random(number).sample(range(users), 2)
+        ]
+
+    def change_members(number):
+        add, remove = two_users(number)
+        return {'add': [add], 'remove': [remove]}
+
+    def group(number):
+        return random.Random(number).randrange(groups) + 1
+
+    def prepare_groups(requests):
+        with engine.begin() as connection:
+            insert(connection, Group.__table__, (
+                {'id': DELETED_GROUPS + number,
+                 'name': 'Doomed {}'.format(number), 'version': 'seed'}
+                for number in range(requests)
+            ))
+            insert(connection, groups_to_users, (
+                {'group_id': DELETED_GROUPS + number,
+                 'user_email': email((number + member) % users)}
+                for number in range(requests)
+                for member in range(min(members, users))
+            ))
+
+    return [
+        Endpoint('GET /user', lambda number: get('/user', 'limit=50')),
+        Endpoint('POST /user', lambda number: send('POST', '/user', {
+            'email': 'created.{}@example.com'.format(number),
+            'username': 'Created',
+        }), expected=[201]),
+        Endpoint('POST /user bulk', lambda number: send('POST', '/user', [
+            {'email': 'bulk.{}.{}@example.com'.format(number, item),
+             'username': 'Bulk'}
+            for item in range(BULK_SIZE)
+        ])),
+        Endpoint('DELETE /user', lambda number: Request(
+            'DELETE', '/user', '&'.join(
+                'email=deleted.{}@example.com'.format(
+                    number * DELETE_SIZE + item
+                )
+                for item in range(DELETE_SIZE)
+            ), None,
+        ), prepare=prepare_users('deleted', group, DELETE_SIZE)),
+        Endpoint('GET /user/{email}', lambda number: get(
+            '/user/{}'.format(user(number))
+        )),
+        Endpoint('DELETE /user/{email}', lambda number: Request(
+            'DELETE', '/user/gone.{}@example.com'.format(number), '', None,
+        ), expected=[204], prepare=prepare_users('gone', group, 1)),
+        Endpoint('GET /user/{email}/groups', lambda number: get(
+            '/user/{}/groups'.format(user(number))
+        )),
+        Endpoint('GET /group', lambda number: get(
+            '/group', 'limit=50&include=member_count'
+        )),
+        Endpoint('POST /group', lambda number: send('POST', '/group', {
+            'name': 'Created {}'.format(number),
+            'users': [{'email': chosen} for chosen in two_users(number)],
+        }), expected=[201]),
+        Endpoint('GET /group/{id}', lambda number: get(
+            '/group/{}'.format(group(number))
+        )),
+        Endpoint('PATCH /group/{id}', lambda number: send(
+            'PATCH', '/group/{}'.format(group(number)),
+            change_members(number),
+        )),
+        Endpoint('DELETE /group/{id}', lambda number: Request(
+            'DELETE', '/group/{}'.format(DELETED_GROUPS + number), '', None,
+        ), expected=[204], prepare=prepare_groups),
+        Endpoint('GET /group/{id}/users', lambda number: get(
+            '/group/{}/users'.format(group(number)), 'limit=50'
+        )),
+        Endpoint('GET /metrics', lambda number: get('/metrics')),
+    ]
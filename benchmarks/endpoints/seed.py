@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Seed the database with users, groups and memberships, the same each run.
+
+User n is user.n@example.com, and group n, numbered from 1, is named
+Group n. Each group has the next members users after those of the group
+before it, wrapping around, so every user is in about the same number of
+groups.
+"""
+
+from itertools import islice
+
+from falcon_experiment import app
+from falcon_experiment.db import Session, engine
+from falcon_experiment.models import Group, Model, User, groups_to_users
+
+#: Rows inserted by each statement
+BATCH_SIZE = 10000
+
+
+def email(number):
+    """Return the email of a numbered user."""
+    return 'user.{}@example.com'.format(number)
+
+
+def insert(connection, table, rows):
+    """Insert rows in batches, as they are produced."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        connection.execute(table.insert(), batch)
+
+
+def seed(users, groups, members):
+    """Create the tables afresh, and fill them.
+
+    The caches of the app are cleared too, as they would otherwise hold
+    what was in the tables before.
+    """
+    Session.remove()
+    Model.metadata.drop_all(engine)
+    Model.metadata.create_all(engine)
+    with engine.begin() as connection:
+        insert(connection, User.__table__, (
+            {'email': email(number), 'username': 'User', 'version': 'seed'}
+            for number in range(users)
+        ))
+        insert(connection, Group.__table__, (
+            {'id': number, 'name': 'Group {}'.format(number),
+             'version': 'seed'}
+            for number in range(1, groups + 1)
+        ))
+        insert(connection, groups_to_users, (
+            {'group_id': group, 'user_email': email(
+                ((group - 1) * members + member) % users
+            )}
+            for group in range(1, groups + 1)
+            for member in range(min(members, users))
+        ))
+    app.cache.clear()
+    app.users.clear()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Compare the throughput of each codec on typical User and Group documents.
+
+Documents are dumped by the schemas, as the resources would dump them.
+"""
+
+import argparse
+import timeit
+from datetime import datetime
+
+from falcon_experiment.media import (
+    JSONCodec,
+    MessagePackCodec,
+    OrjsonCodec,
+    msgpack,
+    orjson,
+)
+from falcon_experiment.models import Group, User
+from falcon_experiment.schemas import GroupSchema, UserSchema
+
+
+def documents(members):
+    """Return a typical User document and a Group document with members."""
+    users = [
+        User(
+            email='user.{}@example.com'.format(number),
+            username='User {}'.format(number),
+            created=datetime.now(),
+        )
+        for number in range(members)
+    ]
+    group = Group(id=1, name='Group', created=datetime.now(), users=users)
+    return [
+        ('user', UserSchema().dump(users[0]).data),
+        ('group of {}'.format(members), GroupSchema().dump(group).data),
+    ]
+
+
+def main():
+    """Time encoding and decoding of each document with each codec."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--number', type=int, default=10000)
+    args = parser.parse_args()
+
+    codecs = [('json', JSONCodec())]
+    if orjson is not None:
+        codecs.append(('orjson', OrjsonCodec()))
+    if msgpack is not None:
+        codecs.append(('msgpack', MessagePackCodec()))
+
+    print('{:<10} {:<16} {:>8} {:>12} {:>12}'.format(
+        'codec', 'document', 'bytes', 'encodes/s', 'decodes/s'
+    ))
+    for name, document in documents(args.members):
+        for codec_name, codec in codecs:
+            encoded = codec.dumps(document)
+            encode = timeit.timeit(
+                lambda: codec.dumps(document), number=args.number
+            )
+            decode = timeit.timeit(
+                lambda: codec.loads(encoded), number=args.number
+            )
+            print('{:<10} {:<16} {:>8} {:>12.0f} {:>12.0f}'.format(
+                codec_name, name, len(encoded),
+                args.number / encode, args.number / decode,
+            ))
+
+
+if __name__ == '__main__':
+    main()
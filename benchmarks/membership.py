@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Compare changing a few members of a large group in two ways.
+
+The relationship way loads the group's users through the ORM and changes
+the collection, as replacing the whole list of users would. The PATCH way
+sends the emails to add and remove to PATCH /group/{id}, which inserts and
+deletes those memberships alone.
+"""
+
+import argparse
+import json
+import time
+from itertools import islice
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from falcon_experiment import app
+from falcon_experiment.db import Session, engine
+from falcon_experiment.models import Group, Model, User, groups_to_users
+
+
+def email(number):
+    """Return the email of a numbered user."""
+    return 'user.{}@example.com'.format(number)
+
+
+def seed(members, spare):
+    """Create a group of members, and spare users who are not in it."""
+    Model.metadata.drop_all(engine)
+    Model.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Group.__table__.insert(), {
+            'id': 1, 'name': 'Group', 'version': 'seed',
+        })
+        numbers = iter(range(members + spare))
+        while True:
+            batch = list(islice(numbers, 10000))
+            if not batch:
+                break
+            connection.execute(User.__table__.insert(), [
+                {'email': email(number), 'username': 'User', 'version': 'seed'}
+                for number in batch
+            ])
+            memberships = [
+                {'group_id': 1, 'user_email': email(number)}
+                for number in batch if number < members
+            ]
+            if memberships:
+                connection.execute(groups_to_users.insert(), memberships)
+
+
+def changes(members, spare, changed):
+    """Yield the emails to add and remove, swapping members with spares."""
+    while True:
+        for offset in range(0, spare, changed):
+            add = [email(members + offset + n) for n in range(changed)]
+            remove = [email(offset + n) for n in range(changed)]
+            yield add, remove
+            yield remove, add
+
+
+def relationship(add, remove):
+    """Change the members through the ORM relationship."""
+    group = Session.query(Group).get(1)
+    removed = set(remove)
+    users = [user for user in group.users if user.email not in removed]
+    users.extend(Session.query(User).filter(User.email.in_(add)))
+    group.users = users
+    Session.commit()
+    Session.remove()
+
+
+def patch(client):
+    """Return a function changing the members through PATCH."""
+    def change(add, remove):
+        response = client.patch(
+            '/group/1',
+            data=json.dumps({'add': add, 'remove': remove}),
+            content_type='application/json',
+        )
+        assert response.status == '200 OK', response.data
+    return change
+
+
+def run(change, pairs, number):
+    """Change the members number times, returning the seconds per change."""
+    start = time.perf_counter()
+    for add, remove in islice(pairs, number):
+        change(add, remove)
+    return (time.perf_counter() - start) / number
+
+
+def main():
+    """Time both ways of changing the members, and print a comparison."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--members', type=int, default=100000)
+    parser.add_argument('--changed', type=int, default=10)
+    parser.add_argument('--number', type=int, default=100)
+    parser.add_argument('--relationship-number', type=int, default=3)
+    args = parser.parse_args()
+
+    spare = args.changed * args.number
+    seed(args.members, spare)
+    client = Client(app.application, BaseResponse)
+    # Both ways take turns from the same changes, so each one has an effect
+    pairs = changes(args.members, spare, args.changed)
+    slow = run(relationship, pairs, args.relationship_number)
+    fast = run(patch(client), pairs, args.number)
+    count = Session.query(groups_to_users).count()
+    Session.remove()
+    assert count == args.members, count
+
+    print('group of {} members, {} added and {} removed a change'.format(
+        args.members, args.changed, args.changed
+    ))
+    print('relationship: {:10.2f} ms/change'.format(slow * 1000))
+    print('PATCH:        {:10.2f} ms/change'.format(fast * 1000))
+    print('speedup:      {:10.0f}x'.format(slow / fast))
+
+
+if __name__ == '__main__':
+    main()
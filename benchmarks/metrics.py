@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Measure the overhead of recording metrics on GET /user/{email}.
+
+Whole requests are too noisy to compare with and without the metrics
+middleware, the difference being smaller than their spread. Instead the
+fastest round of whole requests, served by the API as a WSGI application
+without a server or client, is compared with the fastest round of calls
+to the RequestMetrics hooks alone, given a request and response like the
+real ones. Exits non-zero if the overhead is over the limit.
+
+The app is measured as configured, so the user is served from the
+response cache, unless --no-cache is given to read it from the database.
+"""
+
+import argparse
+import sys
+import time
+
+from falcon.testing import create_environ
+
+from falcon_experiment import app
+from falcon_experiment.db import Session
+from falcon_experiment.models import User
+
+EMAIL = 'a.test@example.com'
+
+
+def call(api, environ):
+    """Call an API once, as a WSGI server would, reading the whole body."""
+    def start_response(status, headers):
+        pass
+
+    for _ in api(dict(environ), start_response):
+        pass
+
+
+def fastest(function, number, rounds):
+    """Return the seconds a call took, on average over the fastest round."""
+    best = float('inf')
+    for _ in range(rounds):
+        began = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - began) / number)
+    return best
+
+
+def main():
+    """Time requests and the metrics, and check the overhead is small."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=15)
+    parser.add_argument('--limit', type=float, default=2,
+                        help='greatest overhead allowed, in percent')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='read the user from the database every time')
+    args = parser.parse_args()
+
+    Session.add(User(email=EMAIL, username='A Test'))
+    Session.commit()
+    Session.remove()
+    if args.no_cache:
+        app.cache.capacity = 0
+
+    path = '/user/{}'.format(EMAIL)
+    environ = create_environ(path=path)
+    request = app.JSONRequest(dict(environ))
+    response = app.JSONResponse()
+    response.data = b''.join(app.api(dict(environ), lambda *args: None))
+    resource = app.api._router.find(path)[0]
+    middleware = app.RequestMetrics()
+
+    def record():
+        middleware.process_request(request, response)
+        middleware.process_response(request, response, resource)
+
+    seconds = fastest(
+        lambda: call(app.api, environ), args.number, args.rounds
+    )
+    overhead = fastest(record, args.number, args.rounds)
+    percent = overhead / seconds * 100
+    print('request: {:8.1f} us'.format(seconds * 1e6))
+    print('metrics: {:8.1f} us  {:.2f}%  (limit {}%)'.format(
+        overhead * 1e6, percent, args.limit
+    ))
+    if percent > args.limit:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
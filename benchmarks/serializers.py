@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Compare objects dumped per second by marshmallow and compiled dumps.
+
+Users and groups are dumped as objects, as the detail resources dump
+them, and as row mappings, as the collections dump them.
+"""
+
+import argparse
+import timeit
+from datetime import datetime
+
+from falcon_experiment.models import Group, User
+from falcon_experiment.schemas import GroupSchema, UserSchema
+from falcon_experiment.serializers import compile_dump
+
+
+def cases(members):
+    """Return the name, schema and object of each case to time."""
+    users = [
+        User(
+            email='user.{}@example.com'.format(number),
+            username='User {}'.format(number),
+            created=datetime.now(),
+        )
+        for number in range(members)
+    ]
+    group = Group(id=1, name='Group', created=datetime.now(), users=users)
+    row = {'id': 1, 'name': 'Group', 'created': datetime.now(),
+           'member_count': members}
+    return [
+        ('user', UserSchema(), users[0]),
+        ('user row', UserSchema(), vars(users[0])),
+        ('group', GroupSchema(exclude=['users']), group),
+        ('group row', GroupSchema(exclude=['users']), row),
+        # Each of the members is an object dumped too
+        ('group of {}'.format(members), GroupSchema(), group),
+    ]
+
+
+def main():
+    """Time dumping each case both ways, and print a comparison."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--number', type=int, default=10000)
+    args = parser.parse_args()
+
+    print('{:<16} {:>14} {:>14} {:>8}'.format(
+        'object', 'marshmallow/s', 'compiled/s', 'speedup'
+    ))
+    for name, schema, obj in cases(args.members):
+        dump = compile_dump(schema)
+        number = args.number
+        if name.startswith('group of'):
+            number = max(1, number // args.members)
+        marshmallow = timeit.timeit(lambda: schema.dump(obj), number=number)
+        compiled = timeit.timeit(lambda: dump(obj), number=number)
+        print('{:<16} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(
+            name, number / marshmallow, number / compiled,
+            marshmallow / compiled,
+        ))
+
+
+if __name__ == '__main__':
+    main()
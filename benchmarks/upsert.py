@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Compare creates per second of the native upsert and savepoint paths.
+
+Each create is committed on its own, as it would be by a POST request.
+"""
+
+import argparse
+import time
+
+from falcon_experiment import models
+from falcon_experiment.db import Session, engine
+from falcon_experiment.models import User
+
+
+def run(native_upsert, count):
+    """Create users one at a time, returning the creates per second."""
+    models.Model.metadata.drop_all(engine)
+    models.Model.metadata.create_all(engine)
+    models.Model.native_upsert = native_upsert
+
+    start = time.perf_counter()
+    for number in range(count):
+        email = 'user.{}@example.com'.format(number)
+        User.upsert(
+            email=email,
+            create_kwargs={'email': email, 'username': 'User'},
+        )
+        Session.commit()
+    elapsed = time.perf_counter() - start
+
+    Session.remove()
+    return count / elapsed
+
+
+def main():
+    """Run the benchmark for both paths and print a comparison."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=5000)
+    args = parser.parse_args()
+
+    fallback = run(False, args.count)
+    native = run(True, args.count)
+    print('get_one_or_create: {:10.0f} creates/s'.format(fallback))
+    print('native upsert:     {:10.0f} creates/s'.format(native))
+    print('speedup:           {:10.2f}x'.format(native / fallback))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,8 +20,13 @@ setup(
         'falcon',
         'marshmallow',
         'python-dateutil',
-        'sqlalchemy',
+        'sqlalchemy>=1.4,<2.0',
     ],
+    extras_require={
+        'asgi': ['aiosqlite'],
+        'msgpack': ['msgpack'],
+        'orjson': ['orjson'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
@@ -9,25 +9,245 @@ It contains:
     - the configuration code to set up the core Falcon API.
 """
 
-import json
+import hmac
+import logging
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
 
 from falcon import (
     API,
     HTTPBadRequest,
+    HTTPError,
     HTTPNotAcceptable,
+    HTTPRequestEntityTooLarge,
     HTTPUnsupportedMediaType,
     Request,
     Response,
 )
-
-from falcon_experiment import models
-from falcon_experiment.db import Session, engine
+from falcon.http_status import HTTPStatus
+
+from falcon_experiment import metrics, profiling, queries, settings, timing
+from falcon_experiment.cache import ExistenceCache, ResponseCache
+from falcon_experiment.coalesce import WriteCoalescer
+from falcon_experiment.db import Session, engine, intent, replicas
+from falcon_experiment.media import ItemTooLarge, chunk, is_lazy, registry
+from falcon_experiment.migrations import migrate
 from falcon_experiment.resources import (
     UserCollection,
     UserDetail,
+    UserGroupCollection,
     GroupCollection,
     GroupDetail,
+    GroupUserCollection,
+    Metrics,
 )
+from falcon_experiment.timing import timed
+
+logger = logging.getLogger(__name__)
+
+
+def status_code(response):
+    """Return the code of the status a response will be sent with.
+
+    Falcon calls the response middleware before it makes a response of an
+    error raised by the responder, so the status of the error being handled
+    is used, if there is one. Other errors will be served as 500.
+    """
+    error = sys.exc_info()[1]
+    if isinstance(error, (HTTPError, HTTPStatus)):
+        return error.status[:3]
+    elif error is not None:
+        return '500'
+    return response.status[:3]
+
+
+class Profiling(object):
+
+    """Falcon middleware to profile a sample of requests.
+
+    This object conforms to the Falcon middleware interface.
+
+    A fraction, rate, of requests are profiled at random, as are those whose
+    X-Profile header holds the token, if there is one. Each route's profiles
+    are merged with those taken within the window before them, which are
+    dumped to its files in the directory of the profiles from a thread of
+    their own, rather than while a response is made. It should be the first
+    middleware, so that the others are profiled too. It is only used if a
+    rate or a token is set, so that it costs nothing otherwise.
+    """
+
+    #: Header holding the token of requests asking to be profiled
+    header = 'X-Profile'
+
+    def __init__(self, profiles=None, rate=settings.PROFILE_RATE,
+                 token=settings.PROFILE_TOKEN, random=random.random):
+        if profiles is None:
+            profiles = profiling.Profiles(
+                profiling.profilers[settings.PROFILE_MODE]()
+            )
+        self.profiles = profiles
+        self.rate = rate
+        self.token = token
+        self.random = random
+
+    def process_request(self, request, response):
+        """Start profiling the request, if it is to be."""
+        if self.wants_profile(request) or self.random() < self.rate:
+            request.context['profile'] = self.profiles.profiler.start()
+
+    def wants_profile(self, request):
+        """Return whether a request asks to be profiled, with the token."""
+        if not self.token:
+            return False
+        given = request.get_header(self.header) or ''
+        return hmac.compare_digest(given.encode(), self.token.encode())
+
+    def process_response(self, request, response, resource):
+        """Stop profiling the request, and merge it into its route's."""
+        profile = request.context.pop('profile', None)
+        if profile is None:
+            return
+
+        sample = self.profiles.profiler.stop(profile)
+        route = '{}.{}'.format(
+            type(resource).__name__ if resource else 'none', request.method
+        )
+        self.profiles.add(route, sample)
+
+
+class RequestMetrics(object):
+
+    """Falcon middleware to record metrics of every request.
+
+    This object conforms to the Falcon middleware interface.
+
+    Requests are counted, and their latencies and the sizes of their bodies
+    observed, by the class of the resource serving them, and their method.
+    Bodies that are streamed are not observed. It should be the first
+    middleware, so that the latencies include the others.
+
+    Each thread keeps the series it records for each resource class, method
+    and status, so that recording a request only adds to them in place.
+    """
+
+    def __init__(self):
+        #: Each thread's series, by resource class, method and status
+        self.local = threading.local()
+
+    def process_request(self, request, response):
+        """Note when the request began."""
+        request.context['metrics_started'] = time.perf_counter()
+
+    def process_response(self, request, response, resource):
+        """Record the request's metrics."""
+        seconds = time.perf_counter() - request.context['metrics_started']
+        try:
+            recorded = self.local.series
+        except AttributeError:
+            recorded = self.local.series = {}
+        key = (type(resource), request.method, status_code(response))
+        series = recorded.get(key)
+        if series is None:
+            series = recorded[key] = self.series(resource, *key[1:])
+        count, latency, sizes = series
+
+        count[0] += 1
+        latency[bisect_left(metrics.latency.buckets, seconds)] += 1
+        latency[-1] += seconds
+        body = response.data if response.data is not None else response.body
+        if body is not None:
+            size = len(body)
+            sizes[bisect_left(metrics.sizes.buckets, size)] += 1
+            sizes[-1] += size
+
+    def series(self, resource, method, status):
+        """Return this thread's series of requests to a resource."""
+        labels = (
+            ('resource', type(resource).__name__ if resource else 'none'),
+            ('method', method),
+        )
+        return (
+            metrics.requests.series(labels + (('status', status),)),
+            metrics.latency.series(labels),
+            metrics.sizes.series(labels),
+        )
+
+
+class Timing(object):
+
+    """Falcon middleware to time where each request spends its time.
+
+    This object conforms to the Falcon middleware interface.
+
+    The time spent decoding the request, in the responder, loading and
+    dumping with the schemas, running SQL, and encoding the response, is
+    sent to the client in a Server-Timing header, in milliseconds. A line
+    is logged for each request, and requests slower than slow_seconds are
+    logged as warnings, along with their slowest SQL statements. It should
+    be the first middleware, so that it times the others too.
+    """
+
+    #: Phases of a request reported, in order
+    phases = ('decode', 'responder', 'load', 'dump', 'sql', 'encode')
+    #: Slowest statements logged for a slow request
+    slow_statements = 5
+
+    def __init__(self, slow_seconds=settings.SLOW_REQUEST_MS / 1000):
+        self.slow_seconds = slow_seconds
+
+    def process_request(self, request, response):
+        """Start timing the request."""
+        request.context['timings'] = timing.start()
+        request.context['started'] = time.perf_counter()
+
+    def process_resource(self, request, response, resource):
+        """Note when the responder is called."""
+        request.context['responder_started'] = time.perf_counter()
+
+    def process_response(self, request, response, resource):
+        """Stop timing the request, and report where its time went."""
+        timing.stop()
+        timings = request.context['timings']
+        now = time.perf_counter()
+        responder_started = request.context.get('responder_started')
+        if responder_started is not None:
+            timings.add('responder', now - responder_started)
+        total = now - request.context['started']
+
+        metrics = ['total;dur={:.3f}'.format(total * 1000)]
+        metrics.extend(
+            '{};dur={:.3f}'.format(phase, timings.phases[phase] * 1000)
+            for phase in self.phases if phase in timings.phases
+        )
+        metrics.append('queries;desc="{}"'.format(timings.queries))
+        response.set_header('Server-Timing', ', '.join(metrics))
+
+        fields = [
+            ('method', request.method),
+            ('path', request.path),
+            ('status', status_code(response)),
+            ('total_ms', '{:.3f}'.format(total * 1000)),
+            ('queries', timings.queries),
+        ]
+        fields.extend(
+            (phase + '_ms', '{:.3f}'.format(timings.phases[phase] * 1000))
+            for phase in self.phases if phase in timings.phases
+        )
+        line = ' '.join('{}={}'.format(name, value) for name, value in fields)
+        extra = {'timing': dict(fields)}
+        if total < self.slow_seconds:
+            logger.info(line, extra=extra)
+            return
+
+        statements = timings.slowest(self.slow_statements)
+        extra['timing']['statements'] = statements
+        logger.warning('slow request %s%s', line, ''.join(
+            '\n  {:.3f}ms {}'.format(seconds * 1000, ' '.join(sql.split()))
+            for seconds, sql in statements
+        ), extra=extra)
 
 
 class DBSession(object):
@@ -38,62 +258,159 @@ class DBSession(object):
 
     SQLAlchemy has a "unit of work" pattern, which means that changes are
     stored in a session that has to be commited. This middleware ensures that
-    a scoped session is created when a request starts, and that it is committed
-    and closed when the response is served.
+    the scoped session is committed and closed when the response is served.
+
+    The scoped session is only created when a responder first uses it, and
+    only checks out a connection from the pool when it first queries, so
+    requests that never reach the database never hold one. Requests whose
+    method is read only are not checked for changes, and end with a rollback,
+    while the transactions of other requests begin by taking SQLite's write
+    lock. The seconds the session held a connection for are recorded in the
+    request context as connection_held. Connections that resources check out
+    for themselves, such as those of streamed pages, are not counted.
+
+    Read only requests read from a replica, if there are any, unless the
+    client wrote within the last sticky_seconds. Clients that write are
+    given a cookie saying until when, so that they read their own writes.
     """
 
-    def process_resource(self, request, response, resource):
-        """Ensure incoming requests start a new DB session if routed."""
-        # Only create a session if we are routed to a resource
-        if resource is not None:
-            Session()
+    #: Methods of requests which should not change anything
+    read_only_methods = ('GET', 'HEAD', 'OPTIONS')
+    #: Cookie holding the time until which a client reads from the primary
+    sticky_cookie = 'primary_until'
+
+    def __init__(self, sticky_seconds=settings.REPLICA_STICKY_SECONDS):
+        self.sticky_seconds = sticky_seconds
+
+    def process_request(self, request, response):
+        """Note whether the request's transactions will write, and where to.
+
+        Reads go to the primary for requests that write, and for clients
+        that recently did, which are marked as sticky in the request context.
+        """
+        intent.write = request.method not in self.read_only_methods
+        request.context['sticky'] = self.is_sticky(request)
+        intent.primary = intent.write or request.context['sticky']
+
+    def is_sticky(self, request):
+        """Return whether a client's reads must still go to the primary."""
+        try:
+            until = float(request.cookies[self.sticky_cookie])
+        except (KeyError, ValueError):
+            return False
+        return until > time.time()
 
     def process_response(self, request, response, resource):
-        """Ensure the session is committed to and closed."""
-        # Check to see if we have done any work
-        if Session.deleted or Session.dirty or Session.new:
-            Session.commit()
+        """Ensure the session is committed to and closed, if it was used."""
+        wrote = getattr(intent, 'write', False)
+        if wrote and replicas and self.sticky_seconds:
+            response.set_cookie(
+                self.sticky_cookie,
+                str(int(time.time() + self.sticky_seconds)),
+                max_age=self.sticky_seconds,
+                secure=False,
+            )
+        intent.write = False
+        intent.primary = True
+        if not Session.registry.has():
+            request.context['connection_held'] = 0
+            return
+
+        session = Session()
+        try:
+            # Check to see if we have done any work
+            if request.method not in self.read_only_methods and (
+                session.deleted or session.dirty or session.new
+            ):
+                session.commit()
+        finally:
+            # Always remove and close the session
+            Session.remove()
 
-        # Always remove and close the session
-        Session.remove()
+        request.context['connection_held'] = session.info.get(
+            'connection_held', 0
+        )
 
 
-class RequireJSON(object):
+class RequireCodec(object):
 
-    """Falcon middleware to ensure communicate in JSON.
+    """Falcon middleware to ensure we communicate in a format we speak.
 
     This object conforms to the Falcon middleware interface.
 
     It ensures that clients who communicate with the API accept responses
-    in JSON, and that clients send us requests in JSON. It looks at the headers
-    set by the client, and does not check the body of a request, which is the
-    responsibility of the JSONRequest object.
+    in a media type we have a codec for, and that clients send us requests in
+    one. It looks at the headers set by the client, and does not check the
+    body of a request, which is the responsibility of the JSONRequest object.
+    The codecs chosen are set on the request and response. Requests for
+    paths served in a media type of their own are let through.
     """
 
+    #: Paths served in a media type of their own
+    exempt_paths = frozenset(['/metrics'])
+
+    def __init__(self, codecs=registry):
+        self.codecs = codecs
+
     def process_request(self, request, response):
-        """Ensure clients are sending and accepting JSON encoded bodies."""
-        if not request.client_accepts_json:
+        """Ensure clients are sending and accepting encodings we support."""
+        if request.path in self.exempt_paths:
+            return
+
+        response.codec = self.codecs.for_accept(request)
+        if response.codec is None:
             raise HTTPNotAcceptable(
-                'This API only supports responses encoded as JSON.',
+                'This API only supports responses encoded as {}.'.format(
+                    self.codecs.names
+                ),
             )
 
         if request.method in ('POST', 'PUT', 'PATCH'):
-            if 'application/json' not in request.content_type:
+            request.codec = self.codecs.for_content_type(request.content_type)
+            if request.codec is None:
                 raise HTTPUnsupportedMediaType(
-                    'This API only supports requests encoded as JSON.',
+                    'This API only supports requests encoded as {}.'.format(
+                        self.codecs.names
+                    ),
                 )
 
 
+def serialize_error(request, error):
+    """Encode the body of an HTTPError with the codec the client prefers.
+
+    Clients that accept none of our codecs, such as those refused by
+    RequireCodec, are answered with the default codec.
+    """
+    codec = registry.for_accept(request) or registry.default
+    return codec.media_type, codec.dumps(error.to_dict())
+
+
 class JSONRequest(Request):
 
-    """Provides DRY JSON deserialisation.
+    """Provides DRY deserialisation, of JSON unless another codec is chosen.
 
     Inherits from Falcon's request object and is passed to all responders.
     Must be passed in to the API class. Provides a document attribute on the
     request which will deserialise the body of the request.
+
+    Bodies larger than max_body_size are refused before any of them is read.
+    Responders that can handle arrays a piece at a time may instead call
+    stream_document, which accepts bodies of up to max_streamed_body_size,
+    whose items may each be no larger than max_body_size.
     """
 
-    __slots__ = ('_document',)
+    __slots__ = ('_document', 'codec')
+
+    #: Largest body in bytes that is read and decoded all at once
+    max_body_size = 1024 * 1024
+    #: Largest body in bytes of an array that is decoded item by item
+    max_streamed_body_size = 64 * 1024 * 1024
+    #: Bytes read from the stream at a time when decoding item by item
+    read_size = 64 * 1024
+
+    def __init__(self, env, options=None):
+        super(JSONRequest, self).__init__(env, options=options)
+        self.codec = registry.default
 
     @property
     def document(self):
@@ -108,71 +425,218 @@ class JSONRequest(Request):
         if not self.content_length:
             return
 
-        body = self.stream.read()
+        self.check_body_size(self.max_body_size)
+        body = self.stream.read(self.content_length)
         if not body:
             raise HTTPBadRequest(
                 'Empty request body',
-                'A valid JSON document is required.'
+                'A valid {} document is required.'.format(self.codec.name)
             )
 
         try:
-            self._document = json.loads(body.decode('utf-8'))
-        except (ValueError, UnicodeDecodeError):
-            raise HTTPBadRequest(
-                'Malformed JSON',
-                'Could not decode the request body. The '
-                'JSON was incorrect or not encoded as '
-                'UTF-8.'
-            )
+            with timed('decode'):
+                self._document = self.codec.loads(body)
+        except ValueError:
+            raise self.malformed()
+        else:
+            return self._document
+
+    def stream_document(self):
+        """Read from the request body, deserialising arrays item by item.
+
+        Returns an iterator over the items of the array if the body is one,
+        in which case the body is read as the iterator is consumed. Any other
+        document is read and deserialised whole, as with document.
+        """
+        try:
+            return self._document
+        except AttributeError:
+            pass
+
+        if not self.content_length:
+            return
+
+        self.check_body_size(self.max_streamed_body_size)
+        decoder = self.codec.decoder(
+            self.stream, self.content_length, self.read_size,
+            max_item_size=self.max_body_size,
+        )
+        try:
+            if decoder.is_array():
+                return self.decode_items(decoder)
+
+            self.check_body_size(self.max_body_size)
+            with timed('decode'):
+                self._document = self.codec.loads(decoder.rest())
+        except ValueError:
+            raise self.malformed()
         else:
             return self._document
 
+    def decode_items(self, decoder):
+        """Yield the items of an array, raising Bad Request if invalid."""
+        items = iter(decoder)
+        while True:
+            try:
+                with timed('decode'):
+                    item = next(items)
+            except StopIteration:
+                return
+            except ItemTooLarge:
+                raise HTTPRequestEntityTooLarge(
+                    'Request body item too large',
+                    'Each item of the request body may be no more than {} '
+                    'bytes.'.format(self.max_body_size),
+                )
+            except ValueError:
+                raise self.malformed()
+            yield item
+
+    def check_body_size(self, limit):
+        """Refuse a body larger than the limit, going by its content length."""
+        if self.content_length > limit:
+            raise HTTPRequestEntityTooLarge(
+                'Request body too large',
+                'The request body may be no more than {} bytes.'.format(
+                    limit
+                ),
+            )
+
+    def malformed(self):
+        """Return the error for a body that is not a valid document."""
+        return HTTPBadRequest(
+            'Malformed {}'.format(self.codec.name),
+            'Could not decode the request body. It was not '
+            'valid {}.'.format(self.codec.name)
+        )
+
+
+def stream(head, chunks):
+    """Yield the chunks already encoded, and then the rest as they come."""
+    yield from head
+    yield from chunks
+
 
 class JSONResponse(Response):
 
-    """Provides DRY JSON serialsation.
+    """Provides DRY serialisation, to JSON unless another codec is chosen.
 
     Inherits from Falcon's response object and is passed to all responsders.
     Must be passed in to the API class. Provides a document attribute which
     when set serialises to JSON behind the scenes.
+
+    Documents are normally encoded whole. An iterator, or a dictionary with
+    iterators or callables as members, is instead encoded a chunk at a time
+    and streamed, unless the whole document turns out to be small.
     """
 
-    __slots__ = ('_document',)
+    __slots__ = ('_document', 'codec')
+
+    #: Size in bytes of each chunk of a streamed document
+    chunk_size = 8 * 1024
+    #: Lazy documents encoding to no more than this are not streamed
+    stream_threshold = 64 * 1024
+
+    def __init__(self):
+        super(JSONResponse, self).__init__()
+        self.codec = registry.default
 
     @property
     def document(self):
-        """Set this attribute to python types to serialise to JSON."""
+        """Set this attribute to python types to serialise."""
         return self._document
 
     @document.setter
     def document(self, value):
-        self._document = value
-        self.data = json.dumps(self._document).encode('utf-8')
+        with timed('encode'):
+            self.encode(value)
 
     @document.deleter
     def document(self):
         del self._document
 
+    def encode(self, value):
+        """Encode a document, or the head of it if it is to be streamed."""
+        self._document = value
+        self.set_header('Content-Type', self.codec.media_type)
+        if not is_lazy(value):
+            self.data = self.codec.dumps(self._document)
+            return
+
+        chunks = chunk(self.codec.iterencode(value), self.chunk_size)
+        head = []
+        length = 0
+        for encoded in chunks:
+            head.append(encoded)
+            length += len(encoded)
+            if length > self.stream_threshold:
+                self.stream = stream(head, chunks)
+                return
+
+        self.data = b''.join(head)
+
+
+# Create all our Models in the DB, or bring an existing DB up to date
+migrate(engine)
+
+# Shared by the resources, so that writes to one invalidate the others
+cache = ResponseCache()
+# Emails of the users known to exist, checked by group writes
+users = ExistenceCache(
+    queries.user_emails,
+    capacity=settings.USER_CACHE_SIZE,
+    ttl=settings.USER_CACHE_TTL,
+)
+# Served at /metrics
+metrics.caches.update(response=cache, users=users)
+# Commits concurrent user creates together, if configured to
+coalescer = None
+if settings.COALESCE_DELAY:
+    coalescer = WriteCoalescer(
+        max_items=settings.COALESCE_MAX_ITEMS,
+        max_delay=settings.COALESCE_DELAY / 1000,
+    )
+
 
-# Create all our Models in the DB
-models.Model.metadata.create_all(engine)
+def create_api(middleware):
+    """Create an API with the given middleware, routed to our resources."""
+    api = API(
+        middleware=middleware,
+        # Custom request and response objects
+        request_type=JSONRequest,
+        response_type=JSONResponse,
+    )
+    api.set_error_serializer(serialize_error)
+
+    # Configure routes
+    api.add_route('/user', UserCollection(cache, users, coalescer))
+    api.add_route('/user/{email}', UserDetail(cache, users))
+    api.add_route('/user/{email}/groups', UserGroupCollection())
+    api.add_route('/group', GroupCollection(cache, users))
+    api.add_route('/group/{id}', GroupDetail(cache, users))
+    api.add_route('/group/{id}/users', GroupUserCollection())
+    api.add_route('/metrics', Metrics())
+    return api
+
+
+def default_middleware():
+    """Return the middleware of the application, in order.
 
-api = application = API(
+    Requests are only profiled if a rate or token for them is set.
+    """
     # Ordering of middleware is important
-    middleware=[
-        RequireJSON(),
+    middleware = [
+        RequestMetrics(),
+        Timing(),
+        RequireCodec(),
         DBSession(),
-    ],
-    # Custom request and response objects
-    request_type=JSONRequest,
-    response_type=JSONResponse,
-)
+    ]
+    if settings.PROFILE_RATE or settings.PROFILE_TOKEN:
+        middleware.insert(0, Profiling())
+    return middleware
+
 
-# Configure routes
-api.add_route('/user', UserCollection())
-api.add_route('/user/{email}', UserDetail())
-api.add_route('/group', GroupCollection())
-api.add_route('/group/{id}', GroupDetail())
+api = application = create_api(middleware=default_middleware())
 
 if __name__ == '__main__':
     # For debugging and development
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""The application served over ASGI, with async responders.
+
+Falcon 0.3 only speaks WSGI, so AsyncAPI adapts its API to ASGI. The body
+of each request is read, and made into a WSGI environment for the request
+object, which is routed by Falcon's router to responders that are awaited.
+Requests, responses, codecs and errors are those of the WSGI application.
+
+Serve it with any ASGI server, e.g.:
+
+    uvicorn falcon_experiment.asgi:asgi_application
+"""
+
+import inspect
+import io
+import sys
+
+from falcon import API, HTTPError
+from falcon.http_status import HTTPStatus
+
+from falcon_experiment import async_db
+from falcon_experiment.app import (
+    DBSession,
+    JSONRequest,
+    JSONResponse,
+    RequireCodec,
+    serialize_error,
+)
+from falcon_experiment.async_resources import (
+    GroupCollection,
+    GroupDetail,
+    UserCollection,
+    UserDetail,
+)
+from falcon_experiment.models import Model
+
+
+async def maybe_await(value):
+    """Return a value, awaiting it first if it is awaitable."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def read_body(receive, limit):
+    """Read the body of a request, and its length.
+
+    No more than limit and one bytes are kept, so that a body too large
+    can be refused, going by its length, without holding all of it.
+    """
+    chunks = []
+    length = 0
+    more = True
+    while more:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        if length <= limit:
+            chunks.append(chunk[:limit + 1 - length])
+        length += len(chunk)
+        more = message.get('more_body', False)
+    return b''.join(chunks), length
+
+
+def environ(scope, body, length):
+    """Return a WSGI environment for an ASGI request and its body."""
+    server = scope.get('server') or ('localhost', 80)
+    env = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in env:
+            value = '{},{}'.format(env[name], value)
+        env[name] = value
+    if length or 'CONTENT_LENGTH' in env:
+        # The length read, in case the client sent none or lied
+        env['CONTENT_LENGTH'] = str(length)
+    return env
+
+
+class AsyncAPI(API):
+
+    """A Falcon API served over ASGI, whose responders may be coroutines.
+
+    Middleware methods may be coroutines too. Unlike Falcon's API, the
+    response middleware is called after the response to an error is made,
+    so it sees the status the client will, and is only called for the
+    middleware whose request method was. Streamed bodies are read whole
+    before they are sent. Coroutine functions given as on_startup and
+    on_shutdown are awaited when the server starts and stops.
+    """
+
+    def __init__(self, on_startup=(), on_shutdown=(), **kwargs):
+        super(AsyncAPI, self).__init__(**kwargs)
+        self.on_startup = list(on_startup)
+        self.on_shutdown = list(on_shutdown)
+
+    async def __call__(self, scope, receive, send):
+        """ASGI application method."""
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        body, length = await read_body(
+            receive, self._request_type.max_body_size
+        )
+        request = self._request_type(
+            environ(scope, body, length), options=self.req_options
+        )
+        response = self._response_type()
+        resource = None
+        called = []
+        try:
+            try:
+                for component in self._middleware:
+                    process_request, _, _ = component
+                    if process_request is not None:
+                        await maybe_await(process_request(request, response))
+                    called.append(component)
+
+                responder, params, resource = self._get_responder(request)
+                for _, process_resource, _ in called:
+                    if process_resource is not None:
+                        await maybe_await(
+                            process_resource(request, response, resource)
+                        )
+
+                await maybe_await(responder(request, response, **params))
+            except HTTPStatus as status:
+                self._compose_status_response(request, response, status)
+            except HTTPError as error:
+                self._compose_error_response(request, response, error)
+        finally:
+            for _, _, process_response in reversed(called):
+                if process_response is not None:
+                    await maybe_await(
+                        process_response(request, response, resource)
+                    )
+
+        await self.send_response(request, response, send)
+
+    async def send_response(self, request, response, send):
+        """Send a response, setting its length and type as Falcon does."""
+        if (
+            request.method == 'HEAD' or
+            response.status in self._BODILESS_STATUS_CODES
+        ):
+            body = b''
+        else:
+            self._set_content_length(response)
+            body = b''.join(
+                chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                for chunk in self._get_body(response)
+            )
+
+        media_type = self._media_type if body else None
+        await send({
+            'type': 'http.response.start',
+            'status': int(response.status.split(' ', 1)[0]),
+            'headers': [
+                (name.encode('latin-1'), value.encode('latin-1'))
+                for name, value in response._wsgi_headers(media_type)
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        """Run the startup and shutdown coroutines, as the server says to."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                for startup in self.on_startup:
+                    await startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for shutdown in self.on_shutdown:
+                    await shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+class AsyncDBSession(object):
+
+    """Falcon middleware to control the AsyncSession of each request.
+
+    This object conforms to the Falcon middleware interface, with a
+    coroutine for its response method, so must be used with AsyncAPI.
+
+    It is the DBSession of the ASGI application. The session is scoped to
+    the request, and only created when a responder first uses it. Requests
+    whose method is read only end with a rollback, while the transactions of
+    other requests begin by taking SQLite's write lock, and are committed
+    if their session has changes. Replicas are not read from.
+    """
+
+    #: Methods of requests which should not change anything
+    read_only_methods = DBSession.read_only_methods
+
+    def process_request(self, request, response):
+        """Scope a session to the request, noting whether it will write."""
+        request.context['session_scope'] = async_db.scope.set(object())
+        request.context['writing'] = async_db.writing.set(
+            request.method not in self.read_only_methods
+        )
+
+    async def process_response(self, request, response, resource):
+        """Ensure the session is committed to and closed, if it was used."""
+        try:
+            if async_db.Session.registry.has():
+                session = async_db.Session()
+                if async_db.writing.get() and (
+                    session.deleted or session.dirty or session.new
+                ):
+                    await session.commit()
+        finally:
+            # Always remove and close the session
+            await async_db.Session.remove()
+            async_db.writing.reset(request.context.pop('writing'))
+            async_db.scope.reset(request.context.pop('session_scope'))
+
+
+async def create_tables():
+    """Create the tables of the models, if they do not exist.
+
+    Databases in files are brought up to date by importing the app, which
+    migrates them. In memory databases are private to the async engine's
+    connection, so need their tables created there.
+    """
+    async with async_db.engine.begin() as connection:
+        await connection.run_sync(Model.metadata.create_all)
+
+
+def create_asgi_api(middleware):
+    """Create an ASGI API with the given middleware, and our resources."""
+    api = AsyncAPI(
+        middleware=middleware,
+        # Custom request and response objects
+        request_type=JSONRequest,
+        response_type=JSONResponse,
+        on_startup=[create_tables],
+        on_shutdown=[async_db.engine.dispose],
+    )
+    api.set_error_serializer(serialize_error)
+
+    # Configure routes
+    api.add_route('/user', UserCollection())
+    api.add_route('/user/{email}', UserDetail())
+    api.add_route('/group', GroupCollection())
+    api.add_route('/group/{id}', GroupDetail())
+    return api
+
+
+asgi_application = create_asgi_api(
+    # Ordering of middleware is important
+    middleware=[
+        RequireCodec(),
+        AsyncDBSession(),
+    ],
+)
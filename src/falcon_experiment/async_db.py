@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Configuration for SQLAlchemy's asyncio extension, for the ASGI app.
+
+The async engine is created from the same settings as the engine in db, with
+the async driver of the database: aiosqlite for SQLite. Connections to
+SQLite are set up by the same hooks, and begin IMMEDIATE in requests that
+will write, as they do there.
+
+An event loop serves many requests at once in one thread, so sessions are
+scoped to the request being served rather than the thread, by a context
+variable the AsyncDBSession middleware sets. Asyncio runs each request in a
+task with a context of its own.
+"""
+
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_scoped_session,
+    create_async_engine,
+)
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from falcon_experiment import settings
+from falcon_experiment.db import do_connect, is_sqlite_memory, set_pragmas
+
+#: Async drivers of each database backend
+DRIVERS = {
+    'sqlite': 'aiosqlite',
+    'postgresql': 'asyncpg',
+}
+
+
+def async_url(url):
+    """Return a database URL with the async driver of its backend."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in DRIVERS:
+        raise ValueError('No async driver is known for {}'.format(backend))
+    return url.set(drivername='{}+{}'.format(backend, DRIVERS[backend]))
+
+
+def engine_options(url):
+    """Return the keyword arguments to create an async engine with.
+
+    An in memory SQLite database lives as long as its one connection, so
+    the pool keeps just the one, which requests take turns with.
+    """
+    if is_sqlite_memory(url):
+        return {
+            'poolclass': AsyncAdaptedQueuePool,
+            'pool_size': 1,
+            'max_overflow': 0,
+        }
+
+    return {
+        'poolclass': AsyncAdaptedQueuePool,
+        'pool_size': settings.POOL_SIZE,
+        'max_overflow': settings.MAX_OVERFLOW,
+        'pool_recycle': settings.POOL_RECYCLE,
+        'pool_timeout': settings.POOL_TIMEOUT,
+    }
+
+
+def create(url=settings.DATABASE_URL):
+    """Create an async engine for a database URL, as db.create does."""
+    url = async_url(url)
+    engine = create_async_engine(url, **engine_options(url))
+    if url.get_backend_name() == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', do_connect)
+        event.listen(engine.sync_engine, 'begin', do_begin)
+        if not is_sqlite_memory(url):
+            event.listen(engine.sync_engine, 'connect', set_pragmas)
+    return engine
+
+
+def do_begin(conn):
+    """Emit our own BEGIN, IMMEDIATE in requests that will write.
+
+    See db.do_begin.
+    """
+    if writing.get():
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    else:
+        conn.exec_driver_sql("BEGIN")
+
+
+# Whether the request's transactions will write, and the request a session
+# is scoped to, set by the AsyncDBSession
+writing = ContextVar('writing', default=False)
+scope = ContextVar('scope', default=None)
+engine = create()
+session_factory = sessionmaker(
+    bind=engine, class_=AsyncSession, expire_on_commit=False
+)
+# Create a session registry
+Session = async_scoped_session(session_factory, scopefunc=scope.get)
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""REST resources with async responders, for the ASGI application.
+
+They serve the same documents as the resources of the WSGI application,
+with the same Core statements, run on the request's AsyncSession, so other
+requests are served while one waits on the database. Unlike those, their
+responses are not cached, pages are read whole rather than streamed, and
+users are created one at a time.
+"""
+
+from collections import OrderedDict
+
+from falcon import (
+    HTTP_CREATED,
+    HTTP_NO_CONTENT,
+    HTTPBadRequest,
+    HTTPInvalidParam,
+    HTTPNotFound,
+)
+from marshmallow import ValidationError
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from falcon_experiment import queries
+from falcon_experiment.async_db import Session
+from falcon_experiment.models import (
+    Group,
+    UnknownUsers,
+    User,
+    groups_to_users,
+    new_version,
+)
+from falcon_experiment.resources import (
+    decode_cursor,
+    encode_cursor,
+    etag,
+    get_page_size,
+    not_modified,
+)
+from falcon_experiment.schemas import (
+    GroupMembersSchema,
+    GroupSchema,
+    UserSchema,
+    dump_group,
+    dump_user,
+)
+
+
+def load(schema, document):
+    """Load a document with a schema, raising Bad Request if it is invalid."""
+    try:
+        return schema.load(document).data
+    except ValidationError as error:
+        raise HTTPBadRequest('Invalid document submitted', error.messages)
+
+
+async def first(statement, **params):
+    """Return the first row of a statement as a mapping, or None."""
+    row = (await Session.execute(statement, params)).first()
+    return None if row is None else row._mapping
+
+
+async def validate_existing(emails):
+    """Raise Bad Request unless users exist with the given emails."""
+    emails = set(emails)
+    if not emails:
+        return
+
+    existing = set((await Session.execute(
+        select([User.email]).where(User.email.in_(emails))
+    )).scalars())
+    do_not_exist = emails - existing
+    if do_not_exist:
+        raise HTTPBadRequest('Invalid document submitted', {'_schema': [
+            'Users: {} do not exist'.format(do_not_exist.__repr__())
+        ]})
+
+
+async def add_members(group_id, emails):
+    """Add users to a group by email, as Group.add_members does.
+
+    Users deleted since they were validated raise Bad Request, rather than
+    being left as memberships of users that do not exist.
+    """
+    result = await Session.execute(Group.insert_members(group_id, emails))
+    if result.rowcount < len(emails):
+        existing = set((await Session.execute(
+            select([User.email]).where(User.email.in_(emails))
+        )).scalars())
+        raise HTTPBadRequest('Invalid document submitted', {'_schema': [
+            str(UnknownUsers(set(emails) - existing))
+        ]})
+
+
+async def insert_unless_exists(statement):
+    """Execute an INSERT in a savepoint, returning whether it inserted.
+
+    An INSERT conflicting with an existing row is rolled back alone.
+    """
+    try:
+        async with Session.begin_nested():
+            await Session.execute(statement)
+    except IntegrityError:
+        return False
+    return True
+
+
+async def touch(table, key, ids):
+    """Give rows new versions, for changes made outside of their table."""
+    if ids:
+        await Session.execute(
+            table.update().where(key.in_(ids)).values(version=new_version())
+        )
+
+
+async def read_page(request, query, dump, column, name):
+    """Return a document listing a page of rows selected by a keyset query.
+
+    The query is given the key to page after, by column, and the page size,
+    and selects one row more, so we know whether another page follows.
+    """
+    limit = get_page_size(request)
+    rows = (await Session.execute(
+        query(after=decode_cursor(request, column), limit=limit + 1)
+    )).mappings().all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return OrderedDict([
+        (name, [dump(row) for row in rows]),
+        ('next', encode_cursor(rows[-1][column.key]) if more else None),
+    ])
+
+
+class GroupCollection(object):
+
+    """Defines HTTP methods for acting on a collection of Groups."""
+
+    includes = {'member_count'}
+
+    async def on_get(self, request, response):
+        """List Groups a page at a time, ordered by id."""
+        include = set(request.get_param_as_list('include') or [])
+        if not include <= self.includes:
+            message = 'Only {} may be included.'.format(
+                ', '.join(sorted(self.includes))
+            )
+            raise HTTPInvalidParam(message, 'include')
+
+        def query(after, limit):
+            query = Group.keyset_page(Group.id, after=after, limit=limit)
+            if 'member_count' in include:
+                query = Group.with_member_count(query)
+            return query
+
+        response.document = await read_page(
+            request, query, dump_group, Group.id, 'groups'
+        )
+
+    async def on_post(self, request, response):
+        """Create a new Group, unless one has its name."""
+        schema = GroupSchema(context={'bulk': True, 'check_users': False})
+        data = load(schema, request.document)
+        emails = {user['email'] for user in data.get('users', [])}
+        await validate_existing(emails)
+
+        created = await insert_unless_exists(
+            Group.__table__.insert().values(name=data['name'])
+        )
+        id = await Session.scalar(
+            select([Group.id]).where(Group.name == data['name'])
+        )
+        if created and emails:
+            await add_members(id, emails)
+        await Session.commit()
+        response.document = {
+            'uri': 'http://localhost:8000/group/{}'.format(id)
+        }
+        response.status = HTTP_CREATED
+
+
+class GroupDetail(object):
+
+    """Defines HTTP methods for acting on an individual Group."""
+
+    async def on_get(self, request, response, id):
+        """Retrieve a Group."""
+        if request.if_none_match is not None:
+            version = await Session.scalar(queries.GROUP_VERSION, {'id': id})
+            if version is None:
+                raise HTTPNotFound
+            if not_modified(request, response, etag(version, response)):
+                return
+
+        group = await first(queries.GROUP, id=id)
+        if group is None:
+            raise HTTPNotFound
+
+        document = dump_group(group)
+        # Members are listed by email alone, so never load them as Users
+        document['users'] = [
+            {'email': email} for email in (await Session.execute(
+                queries.MEMBER_EMAILS, {'id': id}
+            )).scalars()
+        ]
+        response.etag = etag(group['version'], response)
+        response.document = document
+
+    async def on_delete(self, request, response, id):
+        """Delete a Group, and its memberships without loading them."""
+        await Session.execute(groups_to_users.delete().where(
+            groups_to_users.c.group_id == id
+        ))
+        result = await Session.execute(
+            Group.__table__.delete().where(Group.id == id)
+        )
+        if not result.rowcount:
+            raise HTTPNotFound
+
+        await Session.commit()
+        response.status = HTTP_NO_CONTENT
+
+    async def on_patch(self, request, response, id):
+        """Add and remove members of a Group, leaving the rest untouched."""
+        group_id = await Session.scalar(
+            select([Group.id]).where(Group.id == id)
+        )
+        if group_id is None:
+            raise HTTPNotFound
+
+        schema = GroupMembersSchema(context={'check_users': False})
+        data = load(schema, request.document or {})
+        await validate_existing(data['add'])
+
+        members = groups_to_users.c.group_id == group_id
+        add = set(data['add'])
+        if add:
+            add.difference_update((await Session.execute(
+                select([groups_to_users.c.user_email]).where(
+                    members
+                ).where(groups_to_users.c.user_email.in_(add))
+            )).scalars())
+        if add:
+            await add_members(group_id, add)
+        removed = 0
+        if data['remove']:
+            result = await Session.execute(groups_to_users.delete().where(
+                members
+            ).where(groups_to_users.c.user_email.in_(data['remove'])))
+            removed = result.rowcount
+        if add or removed:
+            await touch(Group.__table__, Group.id, [group_id])
+            await Session.commit()
+
+        response.document = {'added': len(add), 'removed': removed}
+
+
+class UserCollection(object):
+
+    """Defines HTTP methods for acting on a collection of Users."""
+
+    async def on_get(self, request, response):
+        """List Users a page at a time, ordered by email."""
+        def query(after, limit):
+            return User.keyset_page(User.email, after=after, limit=limit)
+
+        response.document = await read_page(
+            request, query, dump_user, User.email, 'users'
+        )
+
+    async def on_post(self, request, response):
+        """Create a new User, unless one has its email."""
+        document = request.document
+        if isinstance(document, list):
+            raise HTTPBadRequest(
+                'Invalid document submitted',
+                'Users may only be created one at a time.',
+            )
+
+        data = load(UserSchema(context={'bulk': True}), document)
+        await insert_unless_exists(User.__table__.insert().values(**data))
+        await Session.commit()
+        response.document = {
+            'uri': 'http://localhost:8000/user/{}'.format(data['email'])
+        }
+        response.status = HTTP_CREATED
+
+
+class UserDetail(object):
+
+    """Defines HTTP methods for acting on an individual User."""
+
+    async def on_get(self, request, response, email):
+        """Retrieve a User."""
+        if request.if_none_match is not None:
+            version = await Session.scalar(
+                queries.USER_VERSION, {'email': email}
+            )
+            if version is None:
+                raise HTTPNotFound
+            if not_modified(request, response, etag(version, response)):
+                return
+
+        user = await first(queries.USER, email=email)
+        if user is None:
+            raise HTTPNotFound
+
+        response.etag = etag(user['version'], response)
+        response.document = dump_user(user)
+
+    async def on_delete(self, request, response, email):
+        """Delete a User, and its memberships without loading them."""
+        memberships = groups_to_users.c.user_email == email
+        group_ids = list((await Session.execute(
+            select([groups_to_users.c.group_id]).where(memberships)
+        )).scalars())
+        await Session.execute(groups_to_users.delete().where(memberships))
+        result = await Session.execute(
+            User.__table__.delete().where(User.email == email)
+        )
+        if not result.rowcount:
+            raise HTTPNotFound
+
+        # Documents of the groups the user was in list them
+        await touch(Group.__table__, Group.id, group_ids)
+        await Session.commit()
+        response.status = HTTP_NO_CONTENT
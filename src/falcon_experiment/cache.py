@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""In-process caches of responses and of which users exist.
+
+Each process has caches of its own, so their times to live bound how stale
+another process's writes may leave them.
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from falcon_experiment.db import session_factory
+
+
+class Cache(object):
+
+    """Base class of caches whose entries writes invalidate."""
+
+    def invalidate(self, *keys):
+        """Drop whatever is cached for the keys."""
+        raise NotImplementedError
+
+    def invalidate_on_commit(self, session, *keys):
+        """Drop whatever is cached for the keys now, and on commit.
+
+        Another request may cache a key again before our changes to it are
+        committed, so it is dropped a second time once they are. Should the
+        changes be rolled back instead, nothing is lost but a cache hit.
+        """
+        self.invalidate(*keys)
+        session.info.setdefault('invalidate', []).append((self, keys))
+
+
+class ResponseCache(Cache):
+
+    """A least recently used cache of responses, with a time to live.
+
+    Responses are keyed by the URI of the resource and the media type they
+    are encoded in, and may be anything the resource needs to serve them
+    again, such as a body and its ETag. Writes invalidate the URIs they
+    affect, all media types at once. Each process has a cache of its own, so
+    the time to live bounds how stale another process's writes may leave a
+    document. A capacity of zero disables the cache.
+    """
+
+    def __init__(self, capacity=1024, ttl=60, clock=time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def stats(self):
+        """Return the counters of cache activity, and the current size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'size': len(self.entries),
+        }
+
+    def get(self, uri, media_type):
+        """Return the response cached for a URI in a media type, or None."""
+        key = (uri, media_type)
+        with self.lock:
+            try:
+                response, expires = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return
+
+            if expires <= self.clock():
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def set(self, uri, media_type, response):
+        """Cache the response for a URI in a media type."""
+        if not self.capacity:
+            return
+
+        key = (uri, media_type)
+        with self.lock:
+            self.entries[key] = (response, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            self.keys.setdefault(uri, set()).add(key)
+            while len(self.entries) > self.capacity:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        """Remove an entry. The lock must be held."""
+        del self.entries[key]
+        keys = self.keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.keys[key[0]]
+
+    def clear(self):
+        """Drop every cached response."""
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+
+    def invalidate(self, *uris):
+        """Drop the responses cached for the URIs, in every media type."""
+        with self.lock:
+            for uri in uris:
+                for key in self.keys.pop(uri, ()):
+                    del self.entries[key]
+
+
+class BloomFilter(object):
+
+    """A set of strings which may claim to contain ones it does not.
+
+    It never denies containing a string that was added, and claims to
+    contain others at about the error rate while it holds no more than its
+    capacity. It takes around ten bits a string at a 1% error rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(
+            8, int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        """Return the positions of the bits set for a string."""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [
+            (first + number * second) % self.size
+            for number in range(self.hashes)
+        ]
+
+    def add(self, key):
+        """Add a string."""
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        """Return whether the string may have been added."""
+        return all(
+            self.bits[position >> 3] & 1 << (position & 7)
+            for position in self.positions(key)
+        )
+
+
+class ExistenceCache(Cache):
+
+    """Remembers which keys, such as user emails, exist in the database.
+
+    Keys known to exist are kept in a least recently used cache, with a
+    time to live. Keys not in a Bloom filter of every key are known not to
+    exist. The filter is loaded from the database by calling load, which
+    must return every key, and loaded again once it has lived for the time
+    to live. Only keys neither cache can answer for are looked up.
+
+    Creates must be added to the cache and deletes invalidated. Keys
+    another process creates may be wrongly denied, and keys it deletes
+    wrongly said to exist, until the filter is next loaded or the keys'
+    entries expire: up to the time to live, and as long again as a load
+    takes. Writes that depend on keys existing must check them again as
+    they write. A capacity of zero disables the cache.
+    """
+
+    def __init__(self, load, capacity=0, ttl=60, error_rate=0.01,
+                 clock=time.monotonic):
+        self.load = load
+        self.capacity = capacity
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.bloom = None
+        self.bloom_expires = None
+        self.lock = threading.Lock()
+        self.loading = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negatives = 0
+
+    @property
+    def stats(self):
+        """Return the counters of cache activity, and the current size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'negatives': self.negatives,
+            'size': len(self.entries),
+        }
+
+    def existing(self, keys, lookup):
+        """Return the set of keys that exist.
+
+        lookup is called with the keys the cache cannot answer for, and
+        must return the set of them that exist.
+        """
+        if not self.capacity:
+            return lookup(keys)
+
+        bloom = self.load_bloom()
+        now = self.clock()
+        existing = set()
+        unknown = []
+        with self.lock:
+            for key in keys:
+                expires = self.entries.get(key)
+                if expires is not None and expires > now:
+                    self.entries.move_to_end(key)
+                    existing.add(key)
+                    self.hits += 1
+                elif key not in bloom:
+                    self.negatives += 1
+                else:
+                    unknown.append(key)
+                    self.misses += 1
+
+        if unknown:
+            found = lookup(unknown)
+            self.add(*found)
+            existing.update(found)
+        return existing
+
+    def load_bloom(self):
+        """Return the Bloom filter, loading it if it has expired.
+
+        Only one thread loads the filter at a time. Others keep using the
+        expired filter meanwhile, and wait only if there is none yet.
+        """
+        with self.lock:
+            bloom = self.bloom
+            if bloom is not None and self.bloom_expires > self.clock():
+                return bloom
+
+        if not self.loading.acquire(blocking=bloom is None):
+            return bloom
+        try:
+            with self.lock:
+                # Loaded by another thread while we waited
+                if (self.bloom is not None and
+                        self.bloom_expires > self.clock()):
+                    return self.bloom
+
+            keys = list(self.load())
+            # Leave room for as many keys again to be created
+            bloom = BloomFilter(2 * len(keys), self.error_rate)
+            for key in keys:
+                bloom.add(key)
+            with self.lock:
+                self.bloom = bloom
+                self.bloom_expires = self.clock() + self.ttl
+            return bloom
+        finally:
+            self.loading.release()
+
+    def add(self, *keys):
+        """Record that keys exist, such as those just created."""
+        if not self.capacity:
+            return
+
+        expires = self.clock() + self.ttl
+        with self.lock:
+            for key in keys:
+                if self.bloom is not None:
+                    self.bloom.add(key)
+                self.entries[key] = expires
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forget every key, loading the Bloom filter again when next used."""
+        with self.lock:
+            self.entries.clear()
+            self.bloom = None
+
+    def invalidate(self, *keys):
+        """Forget that keys exist, such as those just deleted.
+
+        Keys cannot be taken out of the Bloom filter, which only means they
+        are looked up again until it is next loaded.
+        """
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+@event.listens_for(session_factory, 'after_commit')
+def invalidate_committed(session):
+    """Invalidate keys whose changes have just been committed."""
+    for cache, keys in session.info.pop('invalidate', ()):
+        cache.invalidate(*keys)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Group commit of writes from concurrent requests, in one transaction.
+
+Every commit takes SQLite's single write lock, and syncs to disk, so
+requests that each commit their own small write queue up behind each other.
+A WriteCoalescer instead gathers the writes of concurrent requests, and
+commits them together.
+
+The first request to submit a write while none are pending leads a batch.
+It waits for up to max_delay seconds, or until max_items writes have been
+submitted, then runs them all in its own scoped session, and commits once.
+Each write runs in a savepoint of its own, so one that fails is rolled back
+alone, and its error raised in the request that submitted it. The others
+wait for the leader, and get their results back once the shared commit has
+finished. Should the commit fail, every write in the batch fails with it.
+
+Writes are functions run in the leader's thread, so must use the scoped
+session, and return plain values rather than instances of models bound to
+it. The requests that submit them must not have begun writing in their own
+transactions, which would hold the write lock the leader needs.
+"""
+
+import sys
+import threading
+
+from falcon_experiment.db import Session
+
+
+class Write(object):
+
+    """A write submitted to a batch, which is done once it is committed."""
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def run(self):
+        """Run the write in a savepoint, keeping its value or error."""
+        try:
+            with Session.begin_nested():
+                self.value = self.function(*self.args)
+        except Exception:
+            self.error = sys.exc_info()[1]
+
+    def result(self):
+        """Wait for the write to be committed, and return its value."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Batch(object):
+
+    """Writes to be committed together, filled until full or flushed."""
+
+    def __init__(self):
+        self.writes = []
+        self.full = threading.Event()
+
+
+class WriteCoalescer(object):
+
+    """Commits the writes of concurrent requests in shared transactions."""
+
+    def __init__(self, max_items=100, max_delay=0.002):
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.batch = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+
+    @property
+    def stats(self):
+        """Return the counters of batches committed and writes in them."""
+        return {'batches': self.batches, 'writes': self.writes}
+
+    def submit(self, function, *args):
+        """Run function(*args) in a shared transaction, returning its value.
+
+        Returns once the transaction has been committed, raising whatever
+        the function raised, or the commit did.
+        """
+        write = Write(function, args)
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = Batch()
+            batch.writes.append(write)
+            if len(batch.writes) >= self.max_items:
+                # Later writes start a new batch, led by another request
+                self.batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.max_delay)
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+            self.flush(batch.writes)
+
+        return write.result()
+
+    def flush(self, writes):
+        """Run the writes of a batch and commit them, then wake the writers.
+
+        Runs in the thread of the request leading the batch.
+        """
+        try:
+            for write in writes:
+                write.run()
+            Session.commit()
+        except Exception:
+            Session.rollback()
+            error = sys.exc_info()[1]
+            for write in writes:
+                write.error = write.error or error
+        finally:
+            with self.lock:
+                self.batches += 1
+                self.writes += len(writes)
+            for write in writes:
+                write.done.set()
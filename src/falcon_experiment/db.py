@@ -1,18 +1,104 @@
 # -*- coding: utf-8 -*-
-"""Configuration for SQLAlchemy."""
+"""Configuration for SQLAlchemy.
+
+The engine is created from the settings module. In memory SQLite databases
+are private to each connection, so SQLAlchemy keeps one connection per
+thread for them and there is no pool to configure. File backed SQLite
+databases get a pool of connections, each set up with the SQLite pragmas
+from the settings, so that several worker processes can share a database.
+
+Reads may be spread over read only replicas of the database, each with an
+engine of its own. Sessions send everything to the primary database, unless
+the thread has said that its reads may go to a replica. Keeping replicas up
+to date is left to the database.
+"""
+
+import random
+import threading
+import time
 
 from sqlalchemy import create_engine, event
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session as BaseSession, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
+from falcon_experiment import settings
 
-engine = create_engine('sqlite:///:memory:')
-session_factory = sessionmaker(bind=engine)
-# Create a session registry
-Session = scoped_session(session_factory)
+
+def is_sqlite_memory(url):
+    """Return whether a database URL is for an in memory SQLite database."""
+    return url.get_backend_name() == 'sqlite' and (
+        url.database in (None, '', ':memory:')
+    )
+
+
+class TimedQueuePool(QueuePool):
+
+    """A QueuePool adding up the seconds spent getting connections from it.
+
+    This includes waiting for a connection to be checked in when the pool
+    is exhausted, and opening new ones.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.wait_seconds = 0
+
+    def _do_get(self):
+        began = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            self.wait_seconds += time.perf_counter() - began
+
+
+def engine_options(url):
+    """Return the keyword arguments to create an engine for a URL with."""
+    if is_sqlite_memory(url):
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': settings.POOL_SIZE,
+        'max_overflow': settings.MAX_OVERFLOW,
+        'pool_recycle': settings.POOL_RECYCLE,
+        'pool_timeout': settings.POOL_TIMEOUT,
+    }
+    if url.get_backend_name() == 'sqlite':
+        # SQLAlchemy would not pool connections to SQLite files by default,
+        # and pooled connections are shared between threads
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
+def sqlite_pragmas():
+    """Return the pragmas set on connections to SQLite files, in order."""
+    return [
+        ('journal_mode', settings.SQLITE_JOURNAL_MODE),
+        ('synchronous', settings.SQLITE_SYNCHRONOUS),
+        ('busy_timeout', settings.SQLITE_BUSY_TIMEOUT),
+        ('mmap_size', settings.SQLITE_MMAP_SIZE),
+    ]
+
+
+def create(url=settings.DATABASE_URL, replica=False):
+    """Create an engine for a database URL, configured by the settings.
+
+    Connections to SQLite replicas refuse to write.
+    """
+    url = make_url(url)
+    engine = create_engine(url, **engine_options(url))
+    if url.get_backend_name() == 'sqlite':
+        event.listen(engine, 'connect', do_connect)
+        event.listen(engine, 'begin', do_begin)
+        if not is_sqlite_memory(url):
+            event.listen(engine, 'connect', set_pragmas)
+        if replica:
+            event.listen(engine, 'connect', set_query_only)
+    return engine
 
 
 # Crazy hacks to make SQLite savepoints work with pysqlite/sqlalchemy.
-@event.listens_for(engine, "connect")
 def do_connect(dbapi_connection, connection_record):
     """
     Disable pysqlite's emitting of the BEGIN statement entirely.
@@ -22,7 +108,103 @@ def do_connect(dbapi_connection, connection_record):
     dbapi_connection.isolation_level = None
 
 
-@event.listens_for(engine, "begin")
 def do_begin(conn):
-    """Emit our own BEGIN."""
-    conn.execute("BEGIN")
+    """Emit our own BEGIN.
+
+    Transactions begin IMMEDIATE, taking the write lock up front, on threads
+    that have said they will write. SQLite cannot wait for a deferred
+    transaction that has read to take the lock, so would fail it at once
+    with "database is locked" as soon as another connection was writing.
+    """
+    if getattr(intent, 'write', False):
+        conn.execute("BEGIN IMMEDIATE")
+    else:
+        conn.execute("BEGIN")
+
+
+def set_pragmas(dbapi_connection, connection_record):
+    """Set the pragmas from the settings on a new SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in sqlite_pragmas():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+    finally:
+        cursor.close()
+
+
+def set_query_only(dbapi_connection, connection_record):
+    """Stop a new SQLite connection from writing to the database."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA query_only = ON')
+    finally:
+        cursor.close()
+
+
+def reading_replica():
+    """Return whether this thread reads from a replica, not the primary."""
+    return bool(replicas) and not getattr(intent, 'primary', True)
+
+
+def read_engine():
+    """Return the engine this thread should read from.
+
+    A random replica is chosen if the thread has said it may read from one,
+    and the primary engine otherwise.
+    """
+    if reading_replica():
+        return random.choice(replicas)
+    return engine
+
+
+class RoutingSession(BaseSession):
+
+    """A session reading from a replica when its thread allows it.
+
+    The replica is chosen when the session first needs a connection, and
+    kept for its life, so that its reads are consistent with each other.
+    Flushes always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        """Return the engine to execute on, a replica or the primary."""
+        if self._flushing:
+            return engine
+
+        bind = self.info.get('bind')
+        if bind is None:
+            bind = self.info['bind'] = read_engine()
+        return bind
+
+
+# Whether this thread's transactions will write, and whether they must read
+# from the primary database, set by the DBSession
+intent = threading.local()
+engine = create()
+replicas = [create(url, replica=True) for url in settings.REPLICA_URLS]
+session_factory = sessionmaker(bind=engine, class_=RoutingSession)
+# Create a session registry
+Session = scoped_session(session_factory)
+
+
+@event.listens_for(session_factory, 'after_begin')
+def check_out(session, transaction, connection):
+    """Note when a session first holds a connection in a transaction."""
+    session.info.setdefault('checked_out', time.monotonic())
+
+
+@event.listens_for(session_factory, 'after_transaction_end')
+def check_in(session, transaction):
+    """Add the time a connection was held to the session's total.
+
+    Sessions return their connections to the pool when their outermost
+    transaction ends, by commit, rollback or close.
+    """
+    if transaction.parent is not None:
+        return
+
+    checked_out = session.info.pop('checked_out', None)
+    if checked_out is not None:
+        session.info['connection_held'] = session.info.get(
+            'connection_held', 0
+        ) + time.monotonic() - checked_out
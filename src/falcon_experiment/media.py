@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""Codecs to de/serialise documents in each media type the API speaks.
+
+JSON is always available, using orjson when it is installed. MessagePack
+is available when msgpack is installed. The request and response objects
+and the RequireCodec middleware find codecs in the registry at the bottom
+of this module.
+"""
+
+import codecs
+import json
+import re
+from collections import OrderedDict
+from collections.abc import Iterator
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class ItemTooLarge(ValueError):
+
+    """Raised by decoders for an item larger than they may hold at once."""
+
+
+def is_lazy(document):
+    """Return whether a document, or any of its members, is evaluated lazily.
+
+    Only the top level of a document is checked.
+    """
+    if isinstance(document, dict):
+        return any(
+            isinstance(value, Iterator) or callable(value)
+            for value in document.values()
+        )
+    return isinstance(document, Iterator)
+
+
+def materialise(document):
+    """Evaluate the lazy members of a document, in order."""
+    if isinstance(document, dict) and is_lazy(document):
+        return OrderedDict(
+            (key, materialise(value)) for key, value in document.items()
+        )
+    elif isinstance(document, Iterator):
+        return list(document)
+    elif callable(document):
+        return materialise(document())
+    return document
+
+
+def chunk(pieces, size):
+    """Join encoded pieces of a document into chunks of a given size."""
+    buffered = []
+    length = 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield b''.join(buffered)
+            buffered = []
+            length = 0
+
+    if buffered:
+        yield b''.join(buffered)
+
+
+class Codec(object):
+
+    """De/serialises documents in one media type.
+
+    Subclasses must implement dumps, loads and decoder, and may implement
+    iterencode to encode lazy documents without evaluating them first.
+    """
+
+    #: The media type of the documents, as sent in Content-Type headers
+    media_type = None
+    #: The name of the format, for error messages
+    name = None
+
+    def dumps(self, document):
+        """Serialise a document to bytes."""
+        raise NotImplementedError
+
+    def loads(self, data):
+        """Deserialise a document, raising ValueError if it is malformed."""
+        raise NotImplementedError
+
+    def iterencode(self, document):
+        """Serialise a document a piece at a time.
+
+        By default a lazy document is evaluated, then serialised whole.
+        """
+        yield self.dumps(materialise(document))
+
+    def decoder(self, stream, length, read_size, max_item_size=None):
+        """Return a decoder to read a document from a stream.
+
+        Decoders must have an is_array method, to tell whether the document
+        is an array, iterate over the items of an array as they are read, and
+        return the rest of the stream for loads from a rest method. They
+        raise ItemTooLarge for an item larger than max_item_size, if given.
+        """
+        raise NotImplementedError
+
+
+def item_read_size(size, held, max_item_size):
+    """Return how much more of an item to read, having read held of it.
+
+    Reads stop just past max_item_size, if it is given, so ItemTooLarge is
+    raised if the item is still not whole by then.
+    """
+    if max_item_size is None:
+        return size
+    if held > max_item_size:
+        raise ItemTooLarge('An item is over {}'.format(max_item_size))
+    return min(size, max_item_size + 1 - held)
+
+
+class ArrayDecoder(object):
+
+    """Decodes a JSON array from a stream, one item at a time.
+
+    Only as much of the stream is held in memory as it takes to decode the
+    item currently being read, which may be no more than max_item_size
+    characters if it is given. An item is decoded again from its start each
+    time more of it is read, so the blocks read double in size until it is
+    whole, keeping the work done linear in its size.
+    """
+
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, stream, length, read_size, max_item_size=None):
+        self.stream = stream
+        self.remaining = length
+        self.read_size = read_size
+        self.max_item_size = max_item_size
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+
+    def read(self, size=None):
+        """Add the next block of the stream to the buffer, if there is one.
+
+        Blocks are read_size bytes, unless another size is given.
+        """
+        if not self.remaining:
+            return False
+
+        data = self.stream.read(min(size or self.read_size, self.remaining))
+        if not data:
+            raise ValueError('The request body ended early')
+
+        self.remaining -= len(data)
+        self.buffer = self.buffer[self.position:] + self.utf8.decode(
+            data, final=not self.remaining
+        )
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace, returning the next character or '' at the end."""
+        while True:
+            self.position = self.whitespace.match(
+                self.buffer, self.position
+            ).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                return ''
+
+    def expect(self, characters):
+        """Consume the next character, which must be one of those given."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError('Expected one of {!r}'.format(characters))
+        self.position += 1
+        return character
+
+    def is_array(self):
+        """Return whether the document is an array."""
+        return self.peek() == '['
+
+    def rest(self):
+        """Read and return whatever is left of the stream."""
+        while self.read():
+            pass
+        return self.buffer[self.position:]
+
+    def decode(self):
+        """Decode the next value in the stream."""
+        self.peek()
+        size = self.read_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(
+                    self.buffer, self.position
+                )
+            except ValueError:
+                # The rest of the buffer is all of the item read so far
+                held = len(self.buffer) - self.position
+                if not self.read(
+                    item_read_size(size, held, self.max_item_size)
+                ):
+                    raise
+                size *= 2
+                continue
+
+            # Items end at a comma or bracket. Until we see one, the end of a
+            # number like 1.5e10 may still be on its way.
+            following = self.whitespace.match(self.buffer, end).end()
+            if self.buffer[following:following + 1] in (',', ']') or (
+                not self.read()
+            ):
+                self.position = end
+                return value
+
+    def __iter__(self):
+        """Yield each item of the array."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+        else:
+            while True:
+                yield self.decode()
+                if self.expect(',]') == ']':
+                    break
+
+        if self.peek():
+            raise ValueError('Extra data after the array')
+
+
+class JSONCodec(Codec):
+
+    """De/serialises JSON using the standard library.
+
+    Lazy documents are serialised as they are evaluated: dictionaries key by
+    key, iterators as arrays one item at a time, and callables only once
+    encoding reaches them, so a document may end with something learnt while
+    iterating over an earlier member. Anything else, including each item of
+    an iterator, is serialised whole.
+    """
+
+    media_type = 'application/json'
+    name = 'JSON'
+
+    def dumps(self, document):
+        """Serialise a document to bytes."""
+        return json.dumps(document).encode('utf-8')
+
+    def loads(self, data):
+        """Deserialise a document, raising ValueError if it is malformed."""
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def iterencode(self, document):
+        """Serialise a document a piece at a time."""
+        if isinstance(document, dict):
+            separator = b'{'
+            for key, value in document.items():
+                yield separator + self.dumps(key) + b': '
+                yield from self.iterencode(value)
+                separator = b', '
+            yield b'}' if document else b'{}'
+        elif isinstance(document, Iterator):
+            separator = b'['
+            for item in document:
+                yield separator + self.dumps(item)
+                separator = b', '
+            yield b'[]' if separator == b'[' else b']'
+        elif callable(document):
+            yield from self.iterencode(document())
+        else:
+            yield self.dumps(document)
+
+    def decoder(self, stream, length, read_size, max_item_size=None):
+        """Return a decoder to read a document from a stream."""
+        return ArrayDecoder(stream, length, read_size, max_item_size)
+
+
+class OrjsonCodec(JSONCodec):
+
+    """De/serialises JSON using orjson, which is several times faster."""
+
+    def dumps(self, document):
+        """Serialise a document to bytes."""
+        return orjson.dumps(document)
+
+    def loads(self, data):
+        """Deserialise a document, raising ValueError if it is malformed."""
+        return orjson.loads(data)
+
+
+class MessagePackDecoder(object):
+
+    """Decodes a MessagePack array from a stream, one item at a time.
+
+    As with ArrayDecoder, items may be no more than max_item_size bytes if
+    it is given, and the blocks read double in size until an item is whole.
+    """
+
+    def __init__(self, stream, length, read_size, max_item_size=None):
+        self.stream = stream
+        self.remaining = length
+        self.read_size = read_size
+        self.max_item_size = max_item_size
+        self.head = None
+        self.unpacker = msgpack.Unpacker(raw=False)
+
+    def read(self, size=None):
+        """Read the next block of the stream, of read_size bytes by default."""
+        data = self.stream.read(min(size or self.read_size, self.remaining))
+        if not data:
+            raise ValueError('The request body ended early')
+        self.remaining -= len(data)
+        return data
+
+    def is_array(self):
+        """Return whether the document is an array."""
+        if self.head is None:
+            self.head = self.read() if self.remaining else b''
+
+        # Fixed size, 16 and 32 bit array type markers
+        marker = self.head[:1]
+        return b'\x90' <= marker <= b'\x9f' or marker in (b'\xdc', b'\xdd')
+
+    def rest(self):
+        """Read and return whatever is left of the stream."""
+        self.is_array()
+        data = [self.head]
+        while self.remaining:
+            data.append(self.read())
+        return b''.join(data)
+
+    def unpack(self, unpack):
+        """Unpack the next value, feeding in more of the stream as needed."""
+        size = self.read_size
+        fed = 0
+        while True:
+            try:
+                return unpack()
+            except msgpack.OutOfData:
+                if not self.remaining:
+                    raise ValueError('The request body ended early')
+                data = self.read(
+                    item_read_size(size, fed, self.max_item_size)
+                )
+                fed += len(data)
+                self.unpacker.feed(data)
+                size *= 2
+            except msgpack.UnpackException as error:
+                raise ValueError(str(error))
+
+    def __iter__(self):
+        """Yield each item of the array."""
+        if not self.is_array():
+            raise ValueError('Expected an array')
+
+        self.unpacker.feed(self.head)
+        length = self.unpack(self.unpacker.read_array_header)
+        for _ in range(length):
+            yield self.unpack(self.unpacker.unpack)
+
+        if not self.remaining:
+            try:
+                self.unpacker.unpack()
+            except msgpack.OutOfData:
+                return
+        raise ValueError('Extra data after the array')
+
+
+class MessagePackCodec(Codec):
+
+    """De/serialises MessagePack.
+
+    MessagePack arrays start with their length, so lazy documents are
+    evaluated before they are serialised.
+    """
+
+    media_type = 'application/msgpack'
+    name = 'MessagePack'
+
+    def dumps(self, document):
+        """Serialise a document to bytes."""
+        return msgpack.packb(document, use_bin_type=True)
+
+    def loads(self, data):
+        """Deserialise a document, raising ValueError if it is malformed."""
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except msgpack.UnpackException as error:
+            raise ValueError(str(error))
+
+    def decoder(self, stream, length, read_size, max_item_size=None):
+        """Return a decoder to read a document from a stream."""
+        return MessagePackDecoder(stream, length, read_size, max_item_size)
+
+
+class Registry(object):
+
+    """The codecs the API speaks, in order of preference.
+
+    The first codec registered is the default, used when a client will
+    accept anything.
+    """
+
+    def __init__(self):
+        self.codecs = OrderedDict()
+
+    def register(self, codec):
+        """Add a codec, replacing any other codec for its media type."""
+        self.codecs[codec.media_type] = codec
+
+    @property
+    def default(self):
+        """Return the codec used unless a client asks for another."""
+        return next(iter(self.codecs.values()))
+
+    @property
+    def names(self):
+        """Return the names of the formats we speak, for error messages."""
+        return ' or '.join(codec.name for codec in self.codecs.values())
+
+    def for_content_type(self, content_type):
+        """Return the codec for a Content-Type header, or None."""
+        if not content_type:
+            return
+        media_type = content_type.split(';', 1)[0].strip().lower()
+        return self.codecs.get(media_type)
+
+    def for_accept(self, request):
+        """Return the codec a client prefers by its Accept header, or None."""
+        if request.accept == '*/*':
+            return self.default
+
+        # When the client has no preference, the last media type wins
+        media_type = request.client_prefers(list(reversed(self.codecs)))
+        if media_type is not None:
+            return self.codecs[media_type]
+
+
+registry = Registry()
+registry.register(JSONCodec() if orjson is None else OrjsonCodec())
+if msgpack is not None:
+    registry.register(MessagePackCodec())
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""Metrics of the application, exposed in the Prometheus text format.
+
+Counters and histograms are recorded by each thread into a shard of its
+own, so recording takes no lock: only the thread owning a shard ever
+writes to it. Shards are summed when the metrics are rendered, which may
+see a thread's latest observation half recorded, a histogram's count
+without its sum, say, but never loses one. Callback metrics, such as the
+gauges of the connection pools and the stats of the caches, are read from
+functions when rendered.
+
+Series are identified by their labels, a tuple of (name, value) pairs,
+which must take few distinct values, as every one is kept forever.
+"""
+
+import threading
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+from falcon_experiment.db import engine, replicas, session_factory
+
+#: The media type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: Seconds a request may take, as histogram bucket upper bounds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+#: Bytes a response body may be, as histogram bucket upper bounds
+SIZE_BUCKETS = tuple(2 ** power for power in range(6, 25, 2))
+
+
+def format_labels(labels, extra=()):
+    """Format labels as Prometheus does, e.g. {method="GET"}."""
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"'
+        ).replace('\n', '\\n'))
+        for name, value in labels
+    ))
+
+
+def format_value(value):
+    """Format a number as Prometheus does."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+
+    """The metrics of the application, and every thread's shard of them.
+
+    The shards of threads that have ended are folded into one, so that
+    servers starting a thread for each connection do not pile them up.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        #: Threads and their shards
+        self.shards = []
+        #: The values of threads that have ended, summed
+        self.retired = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Register a metric to be rendered, returning it."""
+        metric.registry = self
+        self.metrics.append(metric)
+        return metric
+
+    def shard(self):
+        """Return this thread's shard, a dictionary of metric values."""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.retire()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def series(self, metric, labels, initial):
+        """Return this thread's values of a metric's series.
+
+        The values are a list, updated in place, which starts as initial.
+        """
+        shard = self.shard()
+        series = shard.get(metric)
+        if series is None:
+            series = shard[metric] = {}
+        values = series.get(labels)
+        if values is None:
+            values = series[labels] = initial
+        return values
+
+    def retire(self):
+        """Fold the shards of threads that have ended into the retired one.
+
+        Must be called with the lock held.
+        """
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+
+            for metric, series in shard.items():
+                retired = self.retired.setdefault(metric, {})
+                for labels, value in series.items():
+                    retired[labels] = metric.merge(retired.get(labels), value)
+        self.shards = live
+
+    def collect(self, metric):
+        """Return the values of a metric's series, summed over the shards."""
+        with self.lock:
+            self.retire()
+            totals = {
+                labels: metric.merge(None, value)
+                for labels, value in self.retired.get(metric, {}).items()
+            }
+            shards = [shard for _, shard in self.shards]
+        for shard in shards:
+            for labels, value in list(shard.get(metric, {}).items()):
+                totals[labels] = metric.merge(totals.get(labels), value)
+        return totals
+
+    def render(self):
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(object):
+
+    """A count that only goes up, such as of requests served."""
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.registry = None
+
+    def series(self, labels=()):
+        """Return this thread's count of a series, to be added to in place.
+
+        Counts are kept in lists of one item, so that callers recording
+        the same series often may hold on to it.
+        """
+        return self.registry.series(self, labels, [0])
+
+    def inc(self, labels=(), amount=1):
+        """Add an amount to the count of a series."""
+        self.series(labels)[0] += amount
+
+    def merge(self, total, value):
+        """Add a shard's value of a series to the total so far."""
+        return list(value) if total is None else [total[0] + value[0]]
+
+    def render(self):
+        """Return the lines of each series."""
+        return [
+            '{}{} {}'.format(
+                self.name, format_labels(labels), format_value(value[0])
+            )
+            for labels, value in sorted(self.registry.collect(self).items())
+        ]
+
+
+class Histogram(object):
+
+    """Observations counted into buckets, such as of request latencies."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.registry = None
+
+    def series(self, labels=()):
+        """Return this thread's counts of a series, to be added to in place.
+
+        There is a count for each bucket and +Inf, then the sum.
+        """
+        return self.registry.series(
+            self, labels, [0] * (len(self.buckets) + 1) + [0]
+        )
+
+    def observe(self, value, labels=()):
+        """Count an observation of a series in its bucket."""
+        counts = self.series(labels)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def merge(self, total, value):
+        """Add a shard's counts of a series to the totals so far."""
+        if total is None:
+            return list(value)
+        return [mine + theirs for mine, theirs in zip(total, value)]
+
+    def render(self):
+        """Return the lines of each series, with cumulative bucket counts."""
+        lines = []
+        for labels, counts in sorted(self.registry.collect(self).items()):
+            cumulative = 0
+            bounds = self.buckets + (float('inf'),)
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(labels, [('le', format_value(bound))]),
+                    cumulative,
+                ))
+            lines.append('{}_sum{} {}'.format(
+                self.name, format_labels(labels), format_value(counts[-1])
+            ))
+            lines.append('{}_count{} {}'.format(
+                self.name, format_labels(labels), cumulative
+            ))
+        return lines
+
+
+class Callback(object):
+
+    """A metric read when rendered, from a function returning each series.
+
+    The function returns pairs of labels and values. The metric is a gauge
+    unless given another type.
+    """
+
+    def __init__(self, name, help, function, type='gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = type
+        self.registry = None
+
+    def render(self):
+        """Return the lines of each series."""
+        return [
+            '{}{} {}'.format(
+                self.name, format_labels(labels), format_value(value)
+            )
+            for labels, value in self.function()
+        ]
+
+
+def engines():
+    """Return the name and engine of the primary and of each replica."""
+    named = [('primary', engine)]
+    named.extend(
+        ('replica{}'.format(number), replica)
+        for number, replica in enumerate(replicas)
+    )
+    return named
+
+
+def pool_gauge(attribute):
+    """Return a function reading a gauge from each engine's pool.
+
+    Pools without the gauge, such as those of in memory SQLite databases,
+    are left out.
+    """
+    def read():
+        for name, bound in engines():
+            value = getattr(bound.pool, attribute, None)
+            if callable(value):
+                value = value()
+            if value is not None:
+                yield (('engine', name),), value
+    return read
+
+
+def cache_stat(stat):
+    """Return a function reading a stat from each cache that keeps it."""
+    def read():
+        for name, cache in sorted(caches.items()):
+            stats = cache.stats
+            if stat in stats:
+                yield (('cache', name),), stats[stat]
+    return read
+
+
+#: Caches whose stats are exposed, by name, added by the app
+caches = {}
+registry = Registry()
+requests = registry.register(Counter(
+    'http_requests_total', 'Requests served, by resource, method and status.'
+))
+latency = registry.register(Histogram(
+    'http_request_duration_seconds', 'Seconds taken to serve requests.',
+    LATENCY_BUCKETS,
+))
+sizes = registry.register(Histogram(
+    'http_response_size_bytes', 'Bytes of response bodies not streamed.',
+    SIZE_BUCKETS,
+))
+commits = registry.register(Counter(
+    'db_session_commits_total', 'Session transactions committed.'
+))
+rollbacks = registry.register(Counter(
+    'db_session_rollbacks_total', 'Session transactions rolled back.'
+))
+registry.register(Callback(
+    'db_pool_size', 'Connections the pool keeps open.', pool_gauge('size')
+))
+registry.register(Callback(
+    'db_pool_checked_out', 'Connections checked out of the pool.',
+    pool_gauge('checkedout'),
+))
+registry.register(Callback(
+    'db_pool_overflow', 'Connections open beyond the pool size.',
+    pool_gauge('overflow'),
+))
+registry.register(Callback(
+    'db_pool_wait_seconds_total', 'Seconds spent waiting for connections.',
+    pool_gauge('wait_seconds'), type='counter',
+))
+registry.register(Callback(
+    'cache_hits_total', 'Lookups answered by the cache.',
+    cache_stat('hits'), type='counter',
+))
+registry.register(Callback(
+    'cache_misses_total', 'Lookups the cache could not answer.',
+    cache_stat('misses'), type='counter',
+))
+registry.register(Callback(
+    'cache_negatives_total', 'Lookups answered as absent by a Bloom filter.',
+    cache_stat('negatives'), type='counter',
+))
+registry.register(Callback(
+    'cache_evictions_total', 'Entries dropped to make room for others.',
+    cache_stat('evictions'), type='counter',
+))
+registry.register(Callback(
+    'cache_expirations_total', 'Entries dropped as they outlived the TTL.',
+    cache_stat('expirations'), type='counter',
+))
+registry.register(Callback(
+    'cache_entries', 'Entries held in the cache.', cache_stat('size'),
+))
+
+
+@event.listens_for(session_factory, 'after_begin')
+def note_begin(session, transaction, connection):
+    """Note that a session's transaction holds a connection."""
+    if transaction.parent is None:
+        session.info['transaction_began'] = True
+
+
+@event.listens_for(session_factory, 'after_commit')
+def count_commit(session):
+    """Count a committed session transaction, but not a savepoint."""
+    if not session.in_nested_transaction():
+        commits.inc()
+        session.info['transaction_committed'] = True
+
+
+@event.listens_for(session_factory, 'after_transaction_end')
+def count_rollback(session, transaction):
+    """Count a session transaction that ended without being committed.
+
+    Sessions closed with a transaction still open, as the DBSession closes
+    those of read only requests, roll it back.
+    """
+    if transaction.parent is not None:
+        return
+
+    began = session.info.pop('transaction_began', False)
+    committed = session.info.pop('transaction_committed', False)
+    if began and not committed:
+        rollbacks.inc()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Migrations of databases created by earlier versions of the models.
+
+New databases are created whole from the models, and recorded as having
+every migration applied. Existing databases have the migrations they lack
+applied in order, each in a transaction of its own, and recorded in the
+schema_migrations table. Run them against the configured database with:
+
+    python -m falcon_experiment.migrations
+"""
+
+from collections import OrderedDict
+
+from sqlalchemy import (
+    Column,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    select,
+    text,
+)
+
+from falcon_experiment import models
+
+# Kept apart from the models' metadata, so dropping the models keeps it
+metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations',
+    metadata,
+    Column('name', String, primary_key=True),
+)
+
+
+def index_memberships(connection):
+    """Key, index and correctly type groups_to_users, and index group names.
+
+    Duplicate memberships are dropped. Groups sharing a name with an older
+    group have their id appended to their name, so that names are unique.
+    """
+    groups_to_users = models.groups_to_users
+    connection.execute(text(
+        'ALTER TABLE groups_to_users RENAME TO groups_to_users_old'
+    ))
+    groups_to_users.create(connection)
+    connection.execute(text(
+        'INSERT INTO groups_to_users (group_id, user_email) '
+        'SELECT DISTINCT group_id, user_email FROM groups_to_users_old '
+        'WHERE group_id IS NOT NULL AND user_email IS NOT NULL'
+    ))
+    connection.execute(text('DROP TABLE groups_to_users_old'))
+
+    connection.execute(text(
+        "UPDATE groups SET name = name || ' (' || id || ')' "
+        'WHERE id NOT IN (SELECT min(id) FROM groups GROUP BY name)'
+    ))
+    for index in models.Group.__table__.indexes:
+        index.create(connection)
+
+
+#: Every migration by name, in the order they are applied
+MIGRATIONS = OrderedDict([
+    ('0001_index_memberships', index_memberships),
+])
+
+
+def migrate(engine):
+    """Bring a database up to date with the models, returning what was run.
+
+    Returns the names of the migrations applied.
+    """
+    with engine.begin() as connection:
+        existing = inspect(connection).get_table_names()
+        metadata.create_all(connection)
+        if 'groups' not in existing:
+            # A new database, which needs no migrating
+            models.Model.metadata.create_all(connection)
+            connection.execute(schema_migrations.insert(), [
+                {'name': name} for name in MIGRATIONS
+            ])
+            return []
+
+        applied = {
+            name for name, in connection.execute(select([
+                schema_migrations.c.name
+            ]))
+        }
+
+    pending = [name for name in MIGRATIONS if name not in applied]
+    for name in pending:
+        with engine.begin() as connection:
+            MIGRATIONS[name](connection)
+            connection.execute(schema_migrations.insert(), {'name': name})
+
+    # Create any tables added to the models since
+    models.Model.metadata.create_all(engine)
+    return pending
+
+
+if __name__ == '__main__':
+    from falcon_experiment.db import engine
+
+    for name in migrate(engine):
+        print('Applied {}'.format(name))
@@ -1,28 +1,74 @@
 # -*- coding: utf-8 -*-
 """Models are defined here using SQLAlchemy."""
 
+import uuid
 from datetime import datetime
+from itertools import islice
 
 from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
+    UniqueConstraint,
+    func,
+    literal,
+    select,
 )
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from sqlalchemy.orm import (
+    backref,
+    make_transient_to_detached,
+    relationship,
+)
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound
 
 from falcon_experiment.db import Session
 
 
+# Dialects with INSERT ... ON CONFLICT, and the first version to support it
+UPSERT_DIALECTS = {
+    'postgresql': (postgresql.insert, (9, 5)),
+    'sqlite': (sqlite.insert, (3, 24)),
+}
+
+# Bound parameters a statement may have, as SQLite allowed before 3.32
+MAX_PARAMETERS = 999
+
+
+def new_version():
+    """Return a new random version for a row.
+
+    Versions are random rather than counted, so that a row deleted and
+    created again does not repeat the versions it had before.
+    """
+    return uuid.uuid4().hex
+
+
+class UnknownUsers(ValueError):
+
+    """Users that were to be made members of a group do not exist."""
+
+    def __init__(self, emails):
+        super(UnknownUsers, self).__init__(
+            'Users: {} do not exist'.format(emails.__repr__())
+        )
+        self.emails = emails
+
+
 class QueryMixin(object):
 
     """Mixin for common query patterns."""
 
+    #: Set to False to always use get_one_or_create in upsert
+    native_upsert = True
+
     @classmethod
     def get_one_or_create(cls, create_kwargs=None, **kwargs):
         """Race free django-style get or create."""
@@ -41,18 +87,224 @@ class QueryMixin(object):
                 Session.rollback()
                 return query.one()
 
+    @classmethod
+    def touch(cls, ids, batch_size=500):
+        """Give rows new versions, for changes made outside of their table."""
+        primary_key = cls.__mapper__.primary_key[0]
+        ids = iter(ids)
+        while True:
+            batch = list(islice(ids, batch_size))
+            if not batch:
+                return
+
+            Session.execute(
+                cls.__table__.update().where(
+                    primary_key.in_(batch)
+                ).values(version=new_version())
+            )
+
+    @classmethod
+    def upsert(cls, create_kwargs=None, **kwargs):
+        """Race free get or create, using INSERT ... ON CONFLICT DO NOTHING.
+
+        Unlike get_one_or_create, a create needs no savepoint: the row is
+        inserted first, and only if it already existed, or a concurrent
+        insert of it beat ours, does the INSERT do nothing and we select
+        it. A create so takes one statement. Falls back to
+        get_one_or_create when the database has no native upsert, or when
+        the columns we look up by are not unique.
+        """
+        insert = cls.upsert_insert(kwargs)
+        if insert is None:
+            return cls.get_one_or_create(create_kwargs, **kwargs)
+
+        values = dict(kwargs, **(create_kwargs or {}))
+        columns = cls.__table__.columns
+        result = Session.execute(insert.values({
+            key: value for key, value in values.items() if key in columns
+        }))
+        if not result.rowcount:
+            return Session.query(cls).filter_by(**kwargs).one()
+
+        # Build the instance from what we inserted, rather than selecting it
+        row = dict(result.last_inserted_params())
+        for column, value in zip(
+            cls.__table__.primary_key, result.inserted_primary_key
+        ):
+            row[column.key] = value
+
+        new = cls(**row)
+        make_transient_to_detached(new)
+        Session.add(new)
+        for key, value in values.items():
+            if key not in columns:
+                # The row is new, so its collections start out empty
+                set_committed_value(new, key, [])
+                setattr(new, key, value)
+
+        return new
+
+    @classmethod
+    def upsert_insert(cls, kwargs):
+        """Return an INSERT ... ON CONFLICT DO NOTHING for the given lookup.
+
+        Returns None if a native upsert cannot be used.
+        """
+        if not cls.native_upsert:
+            return
+
+        dialect = Session.get_bind().dialect
+        try:
+            insert, version = UPSERT_DIALECTS[dialect.name]
+        except KeyError:
+            return
+
+        if (dialect.server_version_info or ()) < version:
+            return
+
+        names = set(kwargs)
+        table = cls.__table__
+        unique = [{column.name for column in table.primary_key}]
+        unique.extend(
+            {column.name for column in constraint.columns}
+            for constraint in table.constraints
+            if isinstance(constraint, UniqueConstraint)
+        )
+        unique.extend(
+            {column.name for column in index.columns}
+            for index in table.indexes if index.unique
+        )
+        if names not in unique:
+            return
+
+        return insert(table).on_conflict_do_nothing(index_elements=names)
+
+    @classmethod
+    def bulk_create(cls, key, rows, batch_size=500):
+        """Insert many rows at once, skipping any whose key already exists.
+
+        Rows are dictionaries of column values, and may be any iterable, so
+        they can be inserted as they are produced. Each batch costs one query
+        for the keys already present and one multi-row INSERT for the rest,
+        all within the current transaction. Returns the set of keys that
+        were inserted.
+
+        Where the database has a native upsert, the INSERT does nothing for
+        rows another transaction inserted since they were looked up, rather
+        than failing the batch, and those rows are not counted as inserted.
+        Databases that cannot return the keys an INSERT inserted, such as
+        SQLite, count none of such a batch, though as SQLite's writers take
+        turns, its rows can only be missed by a lookup that went wrong.
+        Batches are made small enough to keep within the bound parameters
+        SQLite allows a statement, a value for each column of each row.
+        """
+        batch_size = min(
+            batch_size, MAX_PARAMETERS // len(cls.__table__.columns)
+        )
+        insert = cls.upsert_insert([key.key])
+        returning = False
+        if insert is None:
+            insert = cls.__table__.insert()
+        else:
+            returning = Session.get_bind().dialect.full_returning
+
+        created = set()
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            new = {}
+            for row in batch:
+                if row[key.key] not in created:
+                    new.setdefault(row[key.key], row)
+
+            for existing in cls.existing(key, new, batch_size):
+                del new[existing]
+
+            if not new:
+                continue
+
+            statement = insert.values(list(new.values()))
+            if returning:
+                created.update(
+                    Session.execute(statement.returning(key)).scalars()
+                )
+            elif Session.execute(statement).rowcount == len(new):
+                created.update(new)
+
+        return created
+
+    @classmethod
+    def existing(cls, key, values, batch_size=500):
+        """Return the set of values of a key that some row has.
+
+        Values are looked up batch_size at a time, as very long IN lists
+        make for slow plans.
+        """
+        existing = set()
+        values = iter(values)
+        while True:
+            batch = list(islice(values, batch_size))
+            if not batch:
+                return existing
+
+            query = Session.query(key).filter(key.in_(batch))
+            existing.update(value for value, in query)
+
+    @classmethod
+    def keyset_page(cls, key, after=None, limit=None, query=None):
+        """Select rows ordered by a unique key, starting after a given value.
+
+        Keyset pagination costs the same however deep a client pages, unlike
+        OFFSET which has the database walk every row it skips. Rows are
+        selected from the whole table, unless another select is given.
+        """
+        if query is None:
+            query = cls.__table__.select()
+        query = query.order_by(key)
+        if after is not None:
+            query = query.where(key > after)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+
+class VersionMixin(object):
+
+    """Mixin to version rows, changing the version whenever a row is updated.
+
+    Versions make cheap strong ETags, as they can be selected on their own.
+    """
+
+    version = Column(String(32), nullable=False, default=new_version)
+
+    @declared_attr
+    def __mapper_args__(cls):
+        """Have the ORM set a new version on every update."""
+        return {
+            'version_id_col': cls.version,
+            'version_id_generator': lambda version: new_version(),
+        }
+
 
 Model = declarative_base(cls=QueryMixin)
 
 groups_to_users = Table(
     'groups_to_users',
     Model.metadata,
-    Column('group_id', Integer, ForeignKey('groups.id')),
-    Column('user_email', Integer, ForeignKey('users.email'))
+    # The primary key indexes memberships by group, and makes them unique
+    Column('group_id', Integer, ForeignKey('groups.id'), primary_key=True),
+    Column(
+        'user_email', String, ForeignKey('users.email'), primary_key=True
+    ),
+    # Index memberships by user too
+    Index('ix_groups_to_users_user_email', 'user_email'),
 )
 
 
-class Group(Model):
+class Group(VersionMixin, Model):
 
     """A Group is a container for users."""
 
@@ -60,13 +312,108 @@ class Group(Model):
 
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, default=datetime.now())
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, unique=True, index=True)
     users = relationship(
         'User',
         secondary='groups_to_users',
         backref=backref('groups', lazy='dynamic')
     )
 
+    @classmethod
+    def with_member_count(cls, query):
+        """Add the number of members of each group to a select of groups.
+
+        Counts come from one aggregate over the association table, so the
+        users relationship is never loaded.
+        """
+        member_count = func.count(groups_to_users.c.user_email)
+        return query.add_columns(
+            member_count.label('member_count'),
+        ).select_from(
+            cls.__table__.outerjoin(groups_to_users),
+        ).group_by(cls.id)
+
+    @classmethod
+    def member_emails(cls, id):
+        """Select the emails of a group's members, without loading users."""
+        return select([groups_to_users.c.user_email]).where(
+            groups_to_users.c.group_id == id
+        ).order_by(groups_to_users.c.user_email)
+
+    @classmethod
+    def insert_members(cls, id, emails):
+        """Insert the memberships of a group of the users that exist.
+
+        The users are selected from their table as they are inserted, so
+        fewer rows than emails are inserted if some do not exist.
+        """
+        users = User.__table__
+        return groups_to_users.insert().from_select(
+            ['group_id', 'user_email'],
+            select([
+                literal(id, groups_to_users.c.group_id.type), users.c.email,
+            ]).where(users.c.email.in_(emails)),
+        )
+
+    @classmethod
+    def add_members(cls, id, emails, batch_size=500):
+        """Add users to a group by email, returning how many were added.
+
+        Memberships are inserted directly, batch_size at a time, skipping
+        those the group already has, so the group's other members are never
+        loaded. Memberships are inserted from the users table, so whatever
+        a cache said, users that do not exist raise UnknownUsers.
+        """
+        added = 0
+        emails = iter(emails)
+        while True:
+            batch = set(islice(emails, batch_size))
+            if not batch:
+                return added
+
+            query = select([groups_to_users.c.user_email]).where(
+                groups_to_users.c.group_id == id
+            ).where(groups_to_users.c.user_email.in_(batch))
+            batch.difference_update(
+                email for email, in Session.execute(query)
+            )
+            if batch:
+                result = Session.execute(cls.insert_members(id, batch))
+                if result.rowcount < len(batch):
+                    raise UnknownUsers(
+                        batch - cls.existing(User.email, batch)
+                    )
+                added += len(batch)
+
+    @classmethod
+    def remove_members(cls, id, emails, batch_size=500):
+        """Remove users from a group by email, returning how many were."""
+        removed = 0
+        emails = iter(emails)
+        while True:
+            batch = list(islice(emails, batch_size))
+            if not batch:
+                return removed
+
+            result = Session.execute(groups_to_users.delete().where(
+                groups_to_users.c.group_id == id
+            ).where(groups_to_users.c.user_email.in_(batch)))
+            removed += result.rowcount
+
+    @classmethod
+    def delete_one(cls, id):
+        """Delete a group and its memberships, returning whether it existed.
+
+        Memberships are deleted in one statement, rather than loaded.
+        """
+        Session.execute(groups_to_users.delete().where(
+            groups_to_users.c.group_id == id
+        ))
+        result = Session.execute(
+            cls.__table__.delete().where(cls.id == id)
+        )
+        return bool(result.rowcount)
+
     def __repr__(self):
         """Return a human-readable representation of the object."""
         return '<Group(name="{name}")>'.format(
@@ -74,7 +421,7 @@ class Group(Model):
         )
 
 
-class User(Model):
+class User(VersionMixin, Model):
 
     """
     A basic User.
@@ -88,6 +435,42 @@ class User(Model):
     created = Column(DateTime, default=datetime.now())
     username = Column(String, nullable=False)
 
+    @classmethod
+    def in_group(cls, group_id):
+        """Select the users in a group, for keyset_page."""
+        return select([cls.__table__]).select_from(
+            cls.__table__.join(groups_to_users)
+        ).where(groups_to_users.c.group_id == group_id)
+
+    @classmethod
+    def delete_many(cls, emails, batch_size=500):
+        """Delete users and their memberships, a batch of emails at a time.
+
+        Each batch takes a few set based statements, however many groups
+        its users are in. Returns the set of emails deleted, and the set of
+        ids of the groups they were in, whose versions are left to the
+        caller to touch.
+        """
+        deleted = set()
+        group_ids = set()
+        emails = iter(emails)
+        while True:
+            batch = list(islice(emails, batch_size))
+            if not batch:
+                return deleted, group_ids
+
+            memberships = groups_to_users.c.user_email.in_(batch)
+            group_ids.update(group_id for group_id, in Session.execute(
+                select([groups_to_users.c.group_id]).where(
+                    memberships
+                ).distinct()
+            ))
+            deleted.update(cls.existing(cls.email, batch, batch_size))
+            Session.execute(groups_to_users.delete().where(memberships))
+            Session.execute(
+                cls.__table__.delete().where(cls.email.in_(batch))
+            )
+
     def __repr__(self):
         """Return a human-readable representation of the object."""
         return '<User(email="{email}")>'.format(
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""Profiles of a sample of requests, for the Profiling middleware.
+
+A profiler profiles a request from the token start returns until stop is
+given it back, which returns a sample. CPUProfiler samples are cProfile
+profiles of where the request's thread spent its time; MemoryProfiler
+samples are the bytes allocated by each stack while the request was served
+and still held when it ended. Profiles merges the samples of each route
+taken within a rolling window, and dumps them to files: pstats files of CPU
+samples, for python -m pstats or snakeviz, and collapsed stack files of
+either, one "frame;frame;frame value" line per stack, for flamegraph.pl or
+speedscope.
+"""
+
+import atexit
+import cProfile
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+from falcon_experiment import settings
+
+logger = logging.getLogger(__name__)
+
+
+def frame_name(filename, lineno, name=None):
+    """Return the name of a frame in a collapsed stack."""
+    if filename == '~':
+        # A builtin, whose name says what it is
+        label = name
+    else:
+        label = '{}:{}'.format(os.path.basename(filename), lineno)
+        if name is not None:
+            label = '{}:{}'.format(label, name)
+    return label.replace(';', ',').replace(' ', '_')
+
+
+def collapse(stats, max_depth=64, min_seconds=1e-6):
+    """Return the microseconds spent in each stack of pstats Stats.
+
+    cProfile only records which function called which, not whole stacks,
+    so the stacks are rebuilt by walking down from the functions nothing
+    called, sharing out each function's time among its callers in
+    proportion to the time spent on their calls. Recursion is cut short,
+    as are stacks deeper than max_depth or shorter than min_seconds.
+    """
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(function)
+    roots = [
+        function for function, (_, _, _, _, callers) in stats.stats.items()
+        if not any(caller in stats.stats for caller in callers)
+    ]
+
+    stacks = Counter()
+
+    def walk(function, path, names, share):
+        _, _, own, total, _ = stats.stats[function]
+        names = names + (frame_name(*function),)
+        if own * share:
+            stacks[';'.join(names)] += own * share
+        if len(names) >= max_depth:
+            return
+
+        for callee in callees.get(function, ()):
+            callee_total = stats.stats[callee][3]
+            if callee in path or not callee_total:
+                continue
+            called = stats.stats[callee][4][function][3]
+            if called * share >= min_seconds:
+                walk(
+                    callee, path | {callee}, names,
+                    share * called / callee_total,
+                )
+
+    for root in roots:
+        walk(root, frozenset([root]), (), 1.0)
+    return Counter({
+        stack: int(seconds * 1e6) for stack, seconds in stacks.items()
+        if int(seconds * 1e6)
+    })
+
+
+def write_atomically(path, write):
+    """Write a file by calling write with a temporary path, then moving it.
+
+    Readers never see a file half written, nor two writers' files mixed.
+    """
+    directory = os.path.dirname(path)
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(handle)
+    try:
+        write(temporary)
+        os.replace(temporary, path)
+    except Exception:
+        os.unlink(temporary)
+        raise
+
+
+def write_collapsed(stacks, path):
+    """Write stacks and their values to a collapsed stack file."""
+    with open(path, 'w') as output:
+        for stack, value in sorted(stacks.items()):
+            output.write('{} {}\n'.format(stack, value))
+
+
+class CPUProfiler(object):
+
+    """Profiles where the time of a request's thread goes, with cProfile.
+
+    Only the thread serving the request is profiled, so requests profiled
+    concurrently do not see each other.
+    """
+
+    kind = 'cpu'
+
+    def start(self):
+        """Start profiling this thread, returning the profile."""
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        """Stop a profile, returning it as the sample."""
+        profile.disable()
+        return profile
+
+    def merge(self, merged, sample):
+        """Add a sample to merged pstats Stats, or None, returning them."""
+        if merged is None:
+            return pstats.Stats(sample)
+        merged.add(sample)
+        return merged
+
+    def combine(self, merged):
+        """Return new pstats Stats of several merged samples together."""
+        stats = pstats.Stats()
+        stats.add(*merged)
+        return stats
+
+    def dump(self, stats, path):
+        """Write merged samples to a pstats and a collapsed stack file.
+
+        Returns the paths written.
+        """
+        write_atomically(path + '.pstats', stats.dump_stats)
+        write_atomically(
+            path + '.folded',
+            lambda temporary: write_collapsed(collapse(stats), temporary),
+        )
+        return [path + '.pstats', path + '.folded']
+
+
+class MemoryProfiler(object):
+
+    """Profiles the memory requests allocate and hold, with tracemalloc.
+
+    Allocations are traced, with stacks of up to frames frames, from when
+    the first profiled request starts until the last one profiled at the
+    same time stops, as tracing is global to the process. Allocations by
+    other threads in the meantime are counted in the sample too.
+    """
+
+    kind = 'memory'
+
+    def __init__(self, frames=settings.PROFILE_FRAMES):
+        self.frames = frames
+        self.lock = threading.Lock()
+        #: Requests being profiled
+        self.profiling = 0
+        #: Whether this profiler started tracing, and so should stop it
+        self.started = False
+        self.filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+
+    def start(self):
+        """Start tracing allocations, returning a snapshot of them so far."""
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self.started = True
+            self.profiling += 1
+        return tracemalloc.take_snapshot().filter_traces(self.filters)
+
+    def stop(self, before):
+        """Return the bytes each stack allocated since a snapshot.
+
+        Tracing stops if this profiler started it, and no other request is
+        being profiled.
+        """
+        after = tracemalloc.take_snapshot().filter_traces(self.filters)
+        with self.lock:
+            self.profiling -= 1
+            if self.started and not self.profiling:
+                tracemalloc.stop()
+                self.started = False
+
+        stacks = Counter()
+        for difference in after.compare_to(before, 'traceback'):
+            if difference.size_diff > 0:
+                stacks[';'.join(
+                    frame_name(frame.filename, frame.lineno)
+                    for frame in difference.traceback
+                )] += difference.size_diff
+        return stacks
+
+    def merge(self, merged, sample):
+        """Add a sample to merged stacks, or None, returning them."""
+        if merged is None:
+            merged = Counter()
+        merged.update(sample)
+        return merged
+
+    def combine(self, merged):
+        """Return new stacks of several merged samples together."""
+        stacks = Counter()
+        for sample in merged:
+            stacks.update(sample)
+        return stacks
+
+    def dump(self, stacks, path):
+        """Write merged samples to a collapsed stack file.
+
+        Returns the paths written.
+        """
+        write_atomically(
+            path + '.folded',
+            lambda temporary: write_collapsed(stacks, temporary),
+        )
+        return [path + '.folded']
+
+
+#: Profilers by the kind of profile they take
+profilers = {
+    profiler.kind: profiler for profiler in (CPUProfiler, MemoryProfiler)
+}
+
+
+class Profiles(object):
+
+    """The samples of each route taken within the last window seconds.
+
+    Samples are merged as they are added, into one of buckets spans of the
+    window, so the window rolls on a bucket at a time and merging a sample
+    costs the same however many came before it. The routes that changed
+    are dumped every interval seconds by a thread of their own, started by
+    the first sample, and when the process exits, unless interval is 0.
+    Each route's merged samples are dumped to files named after the route
+    and the kind of profile in the directory, replacing those of before.
+    """
+
+    def __init__(self, profiler, directory=settings.PROFILE_DIRECTORY,
+                 window=settings.PROFILE_WINDOW,
+                 interval=settings.PROFILE_INTERVAL, buckets=10,
+                 clock=time.monotonic):
+        self.profiler = profiler
+        self.directory = directory
+        self.window = window
+        self.interval = interval
+        self.buckets = buckets
+        self.clock = clock
+        self.lock = threading.Lock()
+        #: Indexes and merged samples of the buckets of each route, in order
+        self.merged = {}
+        #: Routes with samples added since they were dumped
+        self.changed = set()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def bucket(self):
+        """Return the index of the bucket the window is now in."""
+        return int(self.clock() // (self.window / self.buckets))
+
+    def expire(self, route, bucket):
+        """Forget the buckets of a route that have left the window."""
+        merged = self.merged.get(route, ())
+        while merged and merged[0][0] <= bucket - self.buckets:
+            merged.popleft()
+
+    def add(self, route, sample):
+        """Merge a sample of a route into its bucket."""
+        bucket = self.bucket()
+        with self.lock:
+            merged = self.merged.setdefault(route, deque())
+            if merged and merged[-1][0] == bucket:
+                merged[-1][1] = self.profiler.merge(merged[-1][1], sample)
+            else:
+                merged.append([bucket, self.profiler.merge(None, sample)])
+            self.expire(route, bucket)
+            self.changed.add(route)
+            if self.interval and self.thread is None:
+                self.start()
+
+    def start(self):
+        """Start dumping changed routes every interval, and at exit."""
+        self.thread = threading.Thread(
+            target=self.run, name='profiles', daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the thread dumping changed routes, dumping them one last time.
+
+        Returns the paths written.
+        """
+        self.stopped.set()
+        return self.dump_changed()
+
+    def run(self):
+        """Dump changed routes every interval, logging any failure."""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.dump_changed()
+            except Exception:
+                logger.exception('Could not dump profiles')
+
+    def dump_changed(self):
+        """Dump the routes with samples added since they were dumped.
+
+        Returns the paths written.
+        """
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        paths = []
+        for route in sorted(changed):
+            paths.extend(self.dump(route))
+        return paths
+
+    def dump(self, route):
+        """Dump the samples of a route in the window, returning the paths."""
+        bucket = self.bucket()
+        with self.lock:
+            self.expire(route, bucket)
+            merged = [sample for _, sample in self.merged.get(route, ())]
+            if not merged:
+                return []
+            # Merged samples change as more are added, so are copied here
+            combined = self.profiler.combine(merged)
+
+        os.makedirs(self.directory, exist_ok=True)
+        return self.profiler.dump(combined, os.path.join(
+            self.directory, '{}.{}'.format(route, self.profiler.kind)
+        ))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Read only queries using SQLAlchemy Core, for the GET endpoints.
+
+Loading through the ORM builds a mapped instance for every row, and tracks
+it in the session's identity map, only for us to dump a few of its
+columns. These queries select the columns alone, and return rows as
+mappings, which the compiled dump functions read directly.
+
+Each statement is built once, with bound parameters for the values that
+vary, so SQLAlchemy compiles it on first use and finds it in the engine's
+compiled cache after. Queries run on the scoped session's connection, in
+its transaction, without touching its identity map.
+"""
+
+from sqlalchemy import bindparam, select
+
+from falcon_experiment.db import Session
+from falcon_experiment.models import Group, User
+
+USER = select([User.__table__]).where(User.email == bindparam('email'))
+USER_VERSION = select([User.version]).where(User.email == bindparam('email'))
+GROUP = select([Group.__table__]).where(Group.id == bindparam('id'))
+GROUP_VERSION = select([Group.version]).where(Group.id == bindparam('id'))
+MEMBER_EMAILS = Group.member_emails(bindparam('id'))
+USER_EMAILS = select([User.email])
+
+
+def execute(statement, **params):
+    """Execute a statement on the session's connection, returning rows."""
+    return Session.connection().execute(statement, params)
+
+
+def first(statement, **params):
+    """Return the first row of a statement as a mapping, or None."""
+    row = execute(statement, **params).first()
+    return None if row is None else row._mapping
+
+
+def user(email):
+    """Return the row of a user, or None."""
+    return first(USER, email=email)
+
+
+def user_emails():
+    """Return the email of every user."""
+    return [email for email, in execute(USER_EMAILS)]
+
+
+def user_version(email):
+    """Return the version of a user, or None."""
+    return execute(USER_VERSION, email=email).scalar()
+
+
+def group(id):
+    """Return the row of a group, or None."""
+    return first(GROUP, id=id)
+
+
+def group_version(id):
+    """Return the version of a group, or None."""
+    return execute(GROUP_VERSION, id=id).scalar()
+
+
+def member_emails(id):
+    """Return the emails of the members of a group, in order."""
+    return [email for email, in execute(MEMBER_EMAILS, id=id)]
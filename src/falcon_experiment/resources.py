@@ -1,35 +1,247 @@
 # -*- coding: utf-8 -*-
 """REST resources are defined according the Falcon responder interface."""
 
+import base64
+import functools
+import json
+from collections import OrderedDict
+from collections.abc import Iterator
+
 from falcon import (
     HTTP_CREATED,
     HTTP_NO_CONTENT,
+    HTTP_NOT_MODIFIED,
     HTTPBadRequest,
+    HTTPInvalidParam,
     HTTPNotFound,
 )
 from marshmallow import ValidationError
 
-from falcon_experiment.db import Session
+from falcon_experiment import metrics, queries
+from falcon_experiment.db import Session, reading_replica
 from falcon_experiment.models import (
     Group,
+    UnknownUsers,
     User,
 )
 from falcon_experiment.schemas import (
+    GroupMembersSchema,
     GroupSchema,
     UserSchema,
+    dump_group,
+    dump_user,
 )
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(key):
+    """Encode the last key of a page as an opaque cursor for the client."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode()
+
+
+def decode_cursor(request, column):
+    """Decode the cursor query parameter back into a key, if one was sent.
+
+    Cursors are opaque to clients, but not tamper proof, so keys that are
+    not of the type of the column paged by are refused.
+    """
+    cursor = request.get_param('cursor')
+    if cursor is None:
+        return
+
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        key = None
+    if type(key) is not column.type.python_type:
+        raise HTTPInvalidParam('The cursor is not valid.', 'cursor')
+    return key
+
+
+def get_page_size(request):
+    """Read the limit query parameter, bounded to the maximum page size."""
+    limit = request.get_param_as_int('limit', min=1, max=MAX_PAGE_SIZE)
+    return limit or DEFAULT_PAGE_SIZE
+
+
+def etag(version, response):
+    """Return a strong ETag for a version of a resource, as it is encoded."""
+    media_type = response.codec.media_type.rsplit('/', 1)[-1]
+    return '"{}-{}"'.format(version, media_type)
+
+
+def not_modified(request, response, etag):
+    """Respond with Not Modified if the client's If-None-Match matches.
+
+    Returns whether it did. If-None-Match is compared weakly, as RFC 7232
+    says it must be.
+    """
+    response.etag = etag
+    header = request.if_none_match
+    if header is None:
+        return False
+
+    tags = {tag.strip() for tag in header.split(',')}
+    tags = {tag[2:] if tag.startswith('W/') else tag for tag in tags}
+    if etag in tags or '*' in tags:
+        response.status = HTTP_NOT_MODIFIED
+        return True
+    return False
+
+
+def cache_response(responder):
+    """Serve the documents of a responder from its resource's cache.
+
+    Documents are cached with their ETags, so that clients revalidating a
+    cached document are answered without touching the database. Only
+    documents encoded whole are cached, and errors never are.
+
+    Documents read from a replica may lag the primary, so are not cached.
+    Clients reading their own writes, which the DBSession marks as sticky,
+    are never served from the cache, which may hold what was read before
+    their write by another process, but their reads of the primary fill it.
+    """
+    @functools.wraps(responder)
+    def cached_responder(self, request, response, **params):
+        media_type = response.codec.media_type
+        cached = None
+        if not request.context.get('sticky'):
+            cached = self.cache.get(request.path, media_type)
+        if cached is not None:
+            body, tag = cached
+            if not not_modified(request, response, tag):
+                response.data = body
+                response.content_type = media_type
+            return
+
+        responder(self, request, response, **params)
+        if response.data is not None and not reading_replica():
+            self.cache.set(
+                request.path, media_type, (response.data, response.etag)
+            )
+
+    return cached_responder
+
+
+def create_user(data):
+    """Create a user from loaded data, unless one exists, returning its email.
+
+    Submitted to a WriteCoalescer, to be committed with other writes.
+    """
+    user = User.upsert(email=data['email'], create_kwargs=data)
+    Session.flush()
+    return user.email
+
+
+def delete_users(emails, cache, users):
+    """Delete users and commit, returning the set of emails deleted.
+
+    The groups the users were in are given new versions, and the cached
+    documents of the users and groups are invalidated, as are the users in
+    the existence cache.
+    """
+    deleted, group_ids = User.delete_many(emails)
+    # Documents of the groups the users were in list them
+    Group.touch(group_ids)
+    cache.invalidate_on_commit(Session, *(
+        '/user/{}'.format(email) for email in deleted
+    ))
+    cache.invalidate_on_commit(Session, *(
+        '/group/{}'.format(group_id) for group_id in group_ids
+    ))
+    users.invalidate_on_commit(Session, *deleted)
+    # Changes made through Core leave the session clean
+    Session.commit()
+    return deleted
+
+
+class Page(object):
+
+    """A page of rows selected by a keyset query, dumped as they are read.
+
+    One row more than the page size is selected so we know whether another
+    page follows. Rows are read from a server side cursor on a connection of
+    their own, since a streamed response body is only iterated once the
+    responder and middleware have finished with the scoped session. That
+    connection is to the engine the session reads from, so a replica the
+    request counted rows on also serves its pages, from the same snapshot.
+    """
+
+    def __init__(self, query, dump, key, limit):
+        self.engine = Session.get_bind()
+        self.query = query
+        self.dump = dump
+        self.key = key
+        self.limit = limit
+        self.last = None
+        self.more = False
+
+    def __iter__(self):
+        """Yield each row of the page, dumped by the dump function."""
+        connection = self.engine.connect().execution_options(
+            stream_results=True
+        )
+        try:
+            rows = connection.execute(self.query)
+            for count, row in enumerate(rows):
+                if count == self.limit:
+                    self.more = True
+                    break
+                row = row._mapping
+                self.last = row[self.key]
+                yield self.dump(row)
+            rows.close()
+        finally:
+            connection.close()
+
+    def next_cursor(self):
+        """Return the cursor of the following page, once this one is read."""
+        if self.more:
+            return encode_cursor(self.last)
+
+    def document(self, name):
+        """Return a document listing the page, to be encoded lazily."""
+        return OrderedDict([
+            (name, iter(self)),
+            ('next', self.next_cursor),
+        ])
+
 
 class GroupCollection(object):
 
     """Defines HTTP methods for acting on a collection of Groups."""
 
-    # def on_get(self, request, response):
-    #     response.document = db.all()
+    includes = {'member_count'}
+
+    def __init__(self, cache, users):
+        self.cache = cache
+        self.users = users
+
+    def on_get(self, request, response):
+        """List Groups a page at a time, ordered by id."""
+        include = set(request.get_param_as_list('include') or [])
+        if not include <= self.includes:
+            message = 'Only {} may be included.'.format(
+                ', '.join(sorted(self.includes))
+            )
+            raise HTTPInvalidParam(message, 'include')
+
+        limit = get_page_size(request)
+        query = Group.keyset_page(
+            Group.id,
+            after=decode_cursor(request, Group.id),
+            limit=limit + 1,
+        )
+        if 'member_count' in include:
+            query = Group.with_member_count(query)
+        page = Page(query, dump_group, 'id', limit)
+        response.document = page.document('groups')
 
     def on_post(self, request, response):
         """Create a new Group."""
-        schema = GroupSchema()
+        schema = GroupSchema(context={'users': self.users})
         try:
             result = schema.load(request.document)
         except ValidationError as error:
@@ -42,6 +254,7 @@ class GroupCollection(object):
         Session.add(group)
         # Commit early to return the id in the uri
         Session.commit()
+        self.cache.invalidate('/group/{}'.format(group.id))
         response.document = {
             'uri': 'http://localhost:8000/group/{}'.format(group.id)
         }
@@ -52,71 +265,331 @@ class GroupDetail(object):
 
     """Defines HTTP methods for acting on an individual Group."""
 
+    #: Set to False to read groups through the ORM rather than Core
+    core_reads = True
+
+    def __init__(self, cache, users):
+        self.cache = cache
+        self.users = users
+
+    @cache_response
     def on_get(self, request, response, id):
         """Retrieve a Group."""
-        schema = GroupSchema()
-        group = Session.query(Group).get(id)
-        if group is None:
+        # Revalidate by version alone, before loading the group and members
+        if request.if_none_match is not None:
+            if self.core_reads:
+                version = queries.group_version(id)
+            else:
+                version = Session.query(Group.version).filter_by(
+                    id=id
+                ).scalar()
+            if version is None:
+                raise HTTPNotFound
+            if not_modified(request, response, etag(version, response)):
+                return
+
+        read = self.read(id)
+        if read is None:
             raise HTTPNotFound
 
-        response.document = schema.dump(group).data
+        document, version = read
+        # Members are listed by email alone, so never load them as Users
+        document['users'] = [
+            {'email': email} for email in queries.member_emails(id)
+        ]
+        response.etag = etag(version, response)
+        response.document = document
+
+    def read(self, id):
+        """Return the document of a Group and its version, or None.
+
+        The group is read as a row through Core, or loaded through the ORM
+        if core_reads is off.
+        """
+        if self.core_reads:
+            group = queries.group(id)
+            if group is not None:
+                return dump_group(group), group['version']
+        else:
+            group = Session.query(Group).get(id)
+            if group is not None:
+                return dump_group(group), group.version
 
     def on_delete(self, request, response, id):
-        """Delete a Group."""
-        group = Session.query(Group).get(id)
-        if group is None:
+        """Delete a Group, and its memberships without loading them."""
+        if not Group.delete_one(id):
             raise HTTPNotFound
 
-        Session.delete(group)
+        self.cache.invalidate_on_commit(Session, request.path)
+        # Changes made through Core leave the session clean
+        Session.commit()
         response.status = HTTP_NO_CONTENT
 
+    def on_patch(self, request, response, id):
+        """Add and remove members of a Group, leaving the rest untouched.
+
+        Only the memberships named are inserted or deleted, so the cost of
+        a change does not grow with the size of the group.
+        """
+        group_id = Session.query(Group.id).filter_by(id=id).scalar()
+        if group_id is None:
+            raise HTTPNotFound
+
+        schema = GroupMembersSchema(context={'users': self.users})
+        try:
+            result = schema.load(request.document or {})
+        except ValidationError as error:
+            raise HTTPBadRequest(
+                'Invalid document submitted',
+                error.messages,
+            )
+
+        try:
+            added = Group.add_members(group_id, result.data['add'])
+        except UnknownUsers as error:
+            raise HTTPBadRequest(
+                'Invalid document submitted', {'add': [str(error)]}
+            )
+        removed = Group.remove_members(group_id, result.data['remove'])
+        if added or removed:
+            Group.touch([group_id])
+            self.cache.invalidate_on_commit(Session, request.path)
+            # Changes made through Core leave the session clean
+            Session.commit()
+
+        response.document = {'added': added, 'removed': removed}
+
+
+class GroupUserCollection(object):
+
+    """Defines HTTP methods for acting on the Users in a Group."""
+
+    def on_get(self, request, response, id):
+        """List the Users in a Group a page at a time, ordered by email."""
+        if Session.query(Group.id).filter_by(id=id).scalar() is None:
+            raise HTTPNotFound
+
+        limit = get_page_size(request)
+        query = User.keyset_page(
+            User.email,
+            after=decode_cursor(request, User.email),
+            limit=limit + 1,
+            query=User.in_group(id),
+        )
+        page = Page(query, dump_user, 'email', limit)
+        response.document = page.document('users')
+
 
 class UserCollection(object):
 
-    """Defines HTTP methods for acting on a collection of Users."""
+    """Defines HTTP methods for acting on a collection of Users.
+
+    Users created one at a time are committed together with those of
+    concurrent requests if given a WriteCoalescer.
+    """
+
+    def __init__(self, cache, users, coalescer=None):
+        self.cache = cache
+        self.users = users
+        self.coalescer = coalescer
 
-    # def on_get(self, request, response):
-    #     response.document = db.all()
+    def on_get(self, request, response):
+        """List Users a page at a time, ordered by email."""
+        limit = get_page_size(request)
+        query = User.keyset_page(
+            User.email,
+            after=decode_cursor(request, User.email),
+            limit=limit + 1,
+        )
+        page = Page(query, dump_user, 'email', limit)
+        response.document = page.document('users')
 
     def on_post(self, request, response):
-        """Create a new User."""
-        schema = UserSchema()
+        """Create a new User, or many Users from a list."""
+        document = request.stream_document()
+        if isinstance(document, Iterator):
+            return self.on_post_bulk(request, response, document)
+
+        # Coalesced users are loaded as data, to be created by the leader
+        schema = UserSchema(context={'bulk': self.coalescer is not None})
         try:
-            result = schema.load(request.document)
+            result = schema.load(document)
         except ValidationError as error:
             raise HTTPBadRequest(
                 'Invalid document submitted',
                 error.messages,
             )
 
-        user = result.data
-        Session.add(user)
-        # Commit early to return the id in the uri
-        Session.commit()
+        if self.coalescer is not None:
+            email = self.coalescer.submit(create_user, result.data)
+        else:
+            user = result.data
+            Session.add(user)
+            # Commit early to return the id in the uri
+            Session.commit()
+            email = user.email
+
+        self.cache.invalidate('/user/{}'.format(email))
+        self.users.add(email)
         response.document = {
-            'uri': 'http://localhost:8000/user/{}'.format(user.email)
+            'uri': 'http://localhost:8000/user/{}'.format(email)
         }
         response.status = HTTP_CREATED
 
+    def on_post_bulk(self, request, response, documents):
+        """Create many Users in one transaction, reporting on each of them.
+
+        Users are validated and inserted in batches while the request body is
+        still being read. Invalid users are reported and skipped rather than
+        failing the whole request, as are users whose email is already taken.
+        """
+        users = []
+        valid = self.load_each(documents, users)
+        created = User.bulk_create(User.email, valid)
+        Session.commit()
+        self.cache.invalidate(*('/user/{}'.format(email) for email in created))
+        self.users.add(*created)
+
+        statuses = []
+        for user in users:
+            if isinstance(user, ValidationError):
+                statuses.append({'status': 'invalid', 'errors': user.messages})
+                continue
+
+            email = user['email']
+            statuses.append({
+                'status': 'created' if email in created else 'exists',
+                'uri': 'http://localhost:8000/user/{}'.format(email),
+            })
+            # Later duplicates of an email in the same request already exist
+            created.discard(email)
+
+        response.document = {'users': statuses}
+
+    def on_delete(self, request, response):
+        """Delete many Users at once, given as email parameters.
+
+        Users are deleted in one transaction, and those that do not exist
+        are reported rather than failing the whole request.
+        """
+        emails = request.get_param_as_list('email', required=True)
+        emails = list(OrderedDict.fromkeys(emails))
+        if len(emails) > MAX_PAGE_SIZE:
+            raise HTTPInvalidParam(
+                'No more than {} users may be deleted at once.'.format(
+                    MAX_PAGE_SIZE
+                ),
+                'email',
+            )
+
+        deleted = delete_users(emails, self.cache, self.users)
+        response.document = {'users': [
+            {
+                'email': email,
+                'status': 'deleted' if email in deleted else 'not found',
+            }
+            for email in emails
+        ]}
+
+    def load_each(self, documents, users):
+        """Yield each valid user, recording every user or error in a list."""
+        # Our schemas are strict, so a load with many=True would stop at the
+        # first invalid user. Load them one at a time to report on each.
+        schema = UserSchema(context={'bulk': True})
+        for document in documents:
+            try:
+                user = schema.load(document).data
+            except ValidationError as error:
+                users.append(error)
+            else:
+                users.append(user)
+                yield user
+
 
 class UserDetail(object):
 
     """Defines HTTP methods for acting on an individual User."""
 
+    #: Set to False to read users through the ORM rather than Core
+    core_reads = True
+
+    def __init__(self, cache, users):
+        self.cache = cache
+        self.users = users
+
+    @cache_response
     def on_get(self, request, response, email):
         """Retrieve a User."""
-        schema = UserSchema()
-        user = Session.query(User).get(email)
-        if user is None:
+        # Revalidate by version alone, before loading the user
+        if request.if_none_match is not None:
+            if self.core_reads:
+                version = queries.user_version(email)
+            else:
+                version = Session.query(User.version).filter_by(
+                    email=email
+                ).scalar()
+            if version is None:
+                raise HTTPNotFound
+            if not_modified(request, response, etag(version, response)):
+                return
+
+        read = self.read(email)
+        if read is None:
             raise HTTPNotFound
 
-        response.document = schema.dump(user).data
+        document, version = read
+        response.etag = etag(version, response)
+        response.document = document
+
+    def read(self, email):
+        """Return the document of a User and its version, or None.
+
+        The user is read as a row through Core, or loaded through the ORM
+        if core_reads is off.
+        """
+        if self.core_reads:
+            user = queries.user(email)
+            if user is not None:
+                return dump_user(user), user['version']
+        else:
+            user = Session.query(User).get(email)
+            if user is not None:
+                return dump_user(user), user.version
 
     def on_delete(self, request, response, email):
-        """Delete a User."""
+        """Delete a User, and its memberships without loading them."""
+        if not delete_users([email], self.cache, self.users):
+            raise HTTPNotFound
+
+        response.status = HTTP_NO_CONTENT
+
+
+class UserGroupCollection(object):
+
+    """Defines HTTP methods for acting on the Groups a User is in."""
+
+    def on_get(self, request, response, email):
+        """List the Groups a User is in a page at a time, ordered by id."""
         user = Session.query(User).get(email)
         if user is None:
             raise HTTPNotFound
 
-        Session.delete(user)
-        response.status = HTTP_NO_CONTENT
+        limit = get_page_size(request)
+        query = Group.keyset_page(
+            Group.id,
+            after=decode_cursor(request, Group.id),
+            limit=limit + 1,
+            query=user.groups.statement,
+        )
+        page = Page(query, dump_group, 'id', limit)
+        response.document = page.document('groups')
+
+
+class Metrics(object):
+
+    """Defines HTTP methods for the metrics of the application."""
+
+    def on_get(self, request, response):
+        """Render the metrics in the Prometheus text format."""
+        response.data = metrics.registry.render().encode('utf-8')
+        response.content_type = metrics.CONTENT_TYPE
@@ -1,15 +1,75 @@
 # -*- coding: utf-8 -*-
 """Schemas for API endpoints, implemented using Marshmallow."""
-from marshmallow import Schema, fields, post_load, pre_load, ValidationError
+import functools
+
+from marshmallow import (
+    Schema,
+    fields,
+    post_load,
+    pre_load,
+    validates,
+    validates_schema,
+    ValidationError,
+)
 
 from falcon_experiment.db import Session
 from falcon_experiment.models import (
     Group,
     User,
 )
+from falcon_experiment.serializers import compile_dump
+from falcon_experiment.timing import timed, timed_function
+
+
+def validate_existing(emails, cache=None):
+    """Validate that users exist with the given emails.
+
+    Emails are looked up in batches, through the existence cache if given.
+    """
+    emails = set(emails)
+    lookup = functools.partial(User.existing, User.email)
+    if cache is None:
+        existing = lookup(emails)
+    else:
+        existing = cache.existing(emails, lookup)
+    do_not_exist = emails - existing
+    if do_not_exist:
+        raise ValidationError(
+            'Users: {} do not exist'.format(do_not_exist.__repr__())
+        )
+
+
+def unique_users(users):
+    """Return loaded users without repeats of an email, in order.
+
+    Users are loaded as dicts by bulk loads, and as Users otherwise.
+    """
+    seen = set()
+    unique = []
+    for user in users:
+        email = user['email'] if isinstance(user, dict) else user.email
+        if email not in seen:
+            seen.add(email)
+            unique.append(user)
+    return unique
+
+
+class TimedSchema(Schema):
+
+    """Schema whose loads and dumps are timed as phases of the request."""
 
+    def load(self, *args, **kwargs):
+        """Load data, timed as the load phase."""
+        with timed('load'):
+            return super(TimedSchema, self).load(*args, **kwargs)
 
-class BaseSchema(Schema):
+    def dump(self, *args, **kwargs):
+        """Dump objects, timed as the dump phase."""
+        with timed('dump'):
+            return super(TimedSchema, self).dump(*args, **kwargs)
+
+
+class BaseSchema(TimedSchema):
 
     """Base Schema class for DRY enforcement of resource attributes."""
 
@@ -28,24 +88,74 @@ class GroupSchema(BaseSchema):
     users = fields.Nested(
         'UserSchema', many=True, exclude=['created', 'username']
     )
+    member_count = fields.Int(dump_only=True)
 
     @pre_load(pass_many=True)
     def validate_users(self, data, many):
-        """Validate that the submitted users all exist."""
+        """Validate that the submitted users all exist.
+
+        Users are looked up through the existence cache given in the context
+        as users, if any. They are not looked up if check_users is False in
+        the context, for callers that look them up themselves.
+        """
+        if self.context.get('check_users') is False:
+            return
+
         users = data.get('users', [])
-        users = {user['email'] for user in users}
-        query = Session.query(User).filter(User.email.in_(users))
-        do_not_exist = users - {user.email for user in query.all()}
-        if do_not_exist:
-            raise ValidationError(
-                'Users: {} do not exist'.format(do_not_exist.__repr__())
-            )
+        validate_existing(
+            (user['email'] for user in users), self.context.get('users')
+        )
 
     @post_load
     def make_object(self, data):
-        """After validating incoming data will output an object."""
+        """After validating incoming data will output an object.
+
+        A user listed more than once is made a member once. Bulk loads keep
+        the validated data, to be inserted by the caller.
+        """
+        if 'users' in data:
+            data['users'] = unique_users(data['users'])
+        if self.context.get('bulk'):
+            return data
+
         name = data['name']
-        return Group.get_one_or_create(name=name, create_kwargs=data)
+        return Group.upsert(name=name, create_kwargs=data)
+
+
+class GroupMembersSchema(TimedSchema):
+
+    """Schema to load changes to the members of a Group, by email."""
+
+    add = fields.List(fields.Email(), missing=list)
+    remove = fields.List(fields.Email(), missing=list)
+
+    class Meta(object):
+        strict = True
+
+    @validates('add')
+    def validate_add(self, emails):
+        """Validate that the users to add all exist.
+
+        Users are not looked up if check_users is False in the context.
+        """
+        if self.context.get('check_users') is not False:
+            validate_existing(emails, self.context.get('users'))
+
+    @validates_schema
+    def validate_disjoint(self, data):
+        """Validate that no user is both added and removed.
+
+        Documents that are not objects are already refused, but schema
+        validators are still run, with data of None.
+        """
+        if not isinstance(data, dict):
+            return
+
+        both = set(data.get('add', ())) & set(data.get('remove', ()))
+        if both:
+            raise ValidationError(
+                'Users: {} are both added and removed'.format(both.__repr__())
+            )
 
 
 class UserSchema(BaseSchema):
@@ -57,6 +167,29 @@ class UserSchema(BaseSchema):
 
     @post_load
     def make_object(self, data):
-        """After validating incoming data will output an object."""
+        """After validating incoming data will output an object.
+
+        Bulk loads keep the validated data, to be inserted all at once.
+        Users only named by email, as members of a group, must exist: they
+        are selected again here, whatever the existence cache said.
+        """
+        if self.context.get('bulk'):
+            return data
+
         email = data['email']
-        return User.get_one_or_create(email=email, create_kwargs=data)
+        if 'username' not in data:
+            user = Session.query(User).filter_by(email=email).one_or_none()
+            if user is None:
+                raise ValidationError(
+                    'Users: {} do not exist'.format({email}.__repr__())
+                )
+            return user
+
+        return User.upsert(email=email, create_kwargs=data)
+
+
+# Dump functions compiled once from the schemas, as the resources use them
+dump_user = timed_function('dump', compile_dump(UserSchema()))
+dump_group = timed_function(
+    'dump', compile_dump(GroupSchema(exclude=['users']))
+)
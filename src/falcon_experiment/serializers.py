@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""Dump functions compiled from schemas, to skip marshmallow at runtime.
+
+Marshmallow works out how to dump each field of each object as it goes,
+through several layers of generic calls. compile_dump does that work once,
+generating the source of a function specialised to a schema's fields, and
+compiling it. The function returns what the schema's dump would return as
+its data, key for key and in the same order.
+
+Only the fields and options our schemas use are supported, and compiling
+any other raises a CompileError. Unlike marshmallow, compiled functions do
+not validate the values they dump, such as emails, as every value we dump
+was validated when it was loaded.
+"""
+
+from collections import OrderedDict
+from datetime import timezone
+
+from marshmallow import fields
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+from marshmallow.schema import Schema
+
+missing = fields.missing_
+
+#: Field types compiled by their format, which subclasses may not share
+NUMBER_FIELDS = (fields.Number, fields.Integer, fields.Float)
+STRING_FIELDS = (fields.String, fields.Str, fields.Email)
+DATETIME_FIELDS = (fields.DateTime, fields.LocalDateTime)
+ISO_FORMATS = ('iso', 'iso8601')
+
+
+class CompileError(TypeError):
+
+    """A schema uses something compile_dump does not support."""
+
+
+def text(value):
+    """Return a value as text, as String fields dump it."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def isoformat(value):
+    """Format a datetime in ISO 8601 as UTC, treating naive ones as UTC."""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc).isoformat()
+    return value.astimezone(timezone.utc).isoformat()
+
+
+def local_isoformat(value):
+    """Format a datetime in ISO 8601 in its own timezone, naive ones as UTC.
+
+    This is how fields with localtime set, such as LocalDateTime, dump.
+    """
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc).isoformat()
+    return value.isoformat()
+
+
+def get_item(obj, key):
+    """Return a key of an object, or its attribute, as marshmallow would."""
+    try:
+        return obj[key]
+    except (KeyError, AttributeError, IndexError, TypeError):
+        value = getattr(obj, key, missing)
+        return value() if callable(value) else value
+
+
+class Compiler(object):
+
+    """Generates the source of the dump functions of a schema.
+
+    Nested schemas are compiled into functions of their own. Constants the
+    source refers to are collected in its namespace.
+    """
+
+    def __init__(self):
+        self.functions = []
+        self.namespace = {
+            'missing': missing,
+            'text': text,
+            'isoformat': isoformat,
+            'local_isoformat': local_isoformat,
+            'get_item': get_item,
+            'OrderedDict': OrderedDict,
+        }
+
+    @property
+    def source(self):
+        """Return the source of every function compiled."""
+        return '\n'.join(self.functions)
+
+    def constant(self, value):
+        """Add a value to the namespace, returning the name it is bound to."""
+        name = '_{}'.format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def function(self, schema):
+        """Compile the dump functions of a schema, returning the entry point.
+
+        Objects with __getitem__ are dumped by a function looking up their
+        keys, and the rest by one looking up their attributes.
+        """
+        self.check(schema)
+        dumped = self.fields(schema)
+        name = 'dump_{}'.format(len(self.functions))
+        lines = []
+        for style in ('items', 'attributes'):
+            lines.append('def {}_{}(obj):'.format(name, style))
+            lines.extend(self.body(schema, dumped, style))
+
+        lines.extend([
+            'def {}(obj):'.format(name),
+            '    if hasattr(obj, "__getitem__"):',
+            '        return {}_items(obj)'.format(name),
+            '    return {}_attributes(obj)'.format(name),
+        ])
+        if schema.many:
+            lines.extend([
+                'def {}_many(objs):'.format(name),
+                '    if objs is None:',
+                '        return {}(objs)'.format(name),
+                '    return [{}(obj) for obj in objs]'.format(name),
+            ])
+            name += '_many'
+
+        self.functions.append('\n'.join(lines))
+        return name
+
+    def check(self, schema):
+        """Raise a CompileError if a schema dumps in ways we do not compile."""
+        processors = schema.__processors__
+        if any(processors.get((tag, many)) for tag in (PRE_DUMP, POST_DUMP)
+               for many in (True, False)):
+            raise CompileError('Dump processors are not supported')
+        if schema.opts.fields or schema.opts.additional:
+            raise CompileError('Inferred fields are not supported')
+        if type(schema).get_attribute is not Schema.get_attribute or (
+            schema.__accessor__ is not None
+        ):
+            raise CompileError('Custom accessors are not supported')
+        if schema.extra:
+            raise CompileError('Extra data is not supported')
+
+    def fields(self, schema):
+        """Return the key, attribute, expression and default of each field.
+
+        Fields are returned in the order the schema dumps them. Defaults are
+        given as expressions too, or None if a field has no default.
+        """
+        dumped = []
+        for name, field in schema.fields.items():
+            if field.load_only:
+                continue
+
+            attribute = field.attribute or name
+            if '.' in attribute:
+                raise CompileError('Dotted attributes are not supported')
+
+            default = None
+            if field.default is not missing:
+                default = self.constant(field.default)
+                if callable(field.default):
+                    default += '()'
+
+            dumped.append((
+                schema.prefix + (field.dump_to or name),
+                attribute,
+                self.expression(schema, field),
+                default,
+            ))
+        return dumped
+
+    def body(self, schema, dumped, style):
+        """Return the lines of the body of a function dumping one object."""
+        lines = ['    result = {}'.format(
+            'OrderedDict()' if schema.ordered else '{}'
+        )]
+        for key, attribute, expression, default in dumped:
+            if style == 'items':
+                lines.append('    value = get_item(obj, {!r})'.format(
+                    attribute
+                ))
+            else:
+                lines.extend([
+                    '    value = getattr(obj, {!r}, missing)'.format(
+                        attribute
+                    ),
+                    '    if callable(value):',
+                    '        value = value()',
+                ])
+
+            if default is None:
+                lines.extend([
+                    '    if value is not missing:',
+                    '        result[{!r}] = {}'.format(key, expression),
+                ])
+            else:
+                lines.extend([
+                    '    if value is missing:',
+                    '        result[{!r}] = {}'.format(key, default),
+                    '    else:',
+                    '        result[{!r}] = {}'.format(key, expression),
+                ])
+        lines.append('    return result')
+        return lines
+
+    def expression(self, schema, field):
+        """Return an expression dumping a field's value, named value."""
+        kind = type(field)
+        if kind in STRING_FIELDS:
+            return 'None if value is None else text(value)'
+        elif kind in NUMBER_FIELDS:
+            # Marshmallow dumps missing numbers as the string of missing
+            if field.as_string:
+                raise CompileError('Numbers as strings are not supported')
+            return 'None if value is None else {}(value)'.format(
+                self.constant(field.num_type)
+            )
+        elif kind in DATETIME_FIELDS:
+            dateformat = field.dateformat or field.DEFAULT_FORMAT
+            if dateformat in ISO_FORMATS:
+                formatted = '{}(value)'.format(
+                    'local_isoformat' if field.localtime else 'isoformat'
+                )
+            elif dateformat in field.DATEFORMAT_SERIALIZATION_FUNCS:
+                raise CompileError('Only ISO 8601 dates are supported')
+            else:
+                formatted = 'value.strftime({!r})'.format(dateformat)
+            return 'None if value is None else {}'.format(formatted)
+        elif kind is fields.Nested:
+            if isinstance(field.only, str):
+                raise CompileError('Nested fields of one field are not '
+                                   'supported')
+            nested = self.function(field.schema)
+            return 'None if value is None else {}(value)'.format(nested)
+        raise CompileError('{} fields are not supported'.format(
+            kind.__name__
+        ))
+
+
+def compile_dump(schema):
+    """Compile a schema into a function dumping objects as it would.
+
+    The function takes an object, or a collection of them if the schema
+    has many set, and returns the data schema.dump would.
+    """
+    compiler = Compiler()
+    name = compiler.function(schema)
+    namespace = compiler.namespace
+    filename = '<compiled {}>'.format(type(schema).__name__)
+    exec(compile(compiler.source, filename, 'exec'), namespace)
+    return namespace[name]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Settings of the application, read from the environment.
+
+Each setting may be overridden by an environment variable of the same name,
+prefixed with FALCON_EXPERIMENT_, e.g. FALCON_EXPERIMENT_DATABASE_URL. The
+environment is read once, when this module is first imported.
+"""
+
+import os
+
+PREFIX = 'FALCON_EXPERIMENT_'
+
+
+def setting(name, default, cast=str):
+    """Return a setting from the environment, or its default."""
+    value = os.environ.get(PREFIX + name)
+    if value is None:
+        return default
+    return cast(value)
+
+
+def url_list(value):
+    """Return a list of URLs from a comma separated string of them."""
+    return [url.strip() for url in value.split(',') if url.strip()]
+
+
+#: The database to connect to, as an SQLAlchemy URL
+DATABASE_URL = setting('DATABASE_URL', 'sqlite:///:memory:')
+
+#: Read only replicas of the database, as comma separated SQLAlchemy URLs
+REPLICA_URLS = setting('REPLICA_URLS', [], url_list)
+#: Seconds after a client writes that its reads go to the primary database
+REPLICA_STICKY_SECONDS = setting('REPLICA_STICKY_SECONDS', 5, int)
+
+#: Connections kept open in the pool
+POOL_SIZE = setting('POOL_SIZE', 5, int)
+#: Connections opened beyond the pool size when it is exhausted
+MAX_OVERFLOW = setting('MAX_OVERFLOW', 10, int)
+#: Seconds after which connections are replaced, or -1 to keep them
+POOL_RECYCLE = setting('POOL_RECYCLE', -1, int)
+#: Seconds to wait for a connection when the pool is exhausted
+POOL_TIMEOUT = setting('POOL_TIMEOUT', 30, int)
+
+# Pragmas set on each connection to a file backed SQLite database
+#: WAL lets readers carry on while another process writes
+SQLITE_JOURNAL_MODE = setting('SQLITE_JOURNAL_MODE', 'WAL')
+#: NORMAL only syncs at checkpoints when in WAL mode
+SQLITE_SYNCHRONOUS = setting('SQLITE_SYNCHRONOUS', 'NORMAL')
+#: Milliseconds to wait for another process's lock before failing
+SQLITE_BUSY_TIMEOUT = setting('SQLITE_BUSY_TIMEOUT', 5000, int)
+#: Bytes of the database to memory map, or 0 to read it with system calls
+SQLITE_MMAP_SIZE = setting('SQLITE_MMAP_SIZE', 256 * 1024 * 1024, int)
+
+#: Emails of users known to exist cached per process, or 0 to not cache them
+USER_CACHE_SIZE = setting('USER_CACHE_SIZE', 0, int)
+#: Seconds before the cache of users is loaded again from the database
+USER_CACHE_TTL = setting('USER_CACHE_TTL', 60, int)
+
+#: Milliseconds to gather concurrent user creates for, to commit them
+#: together, or 0 to commit each one alone
+COALESCE_DELAY = setting('COALESCE_DELAY', 0, float)
+#: Most user creates to commit together
+COALESCE_MAX_ITEMS = setting('COALESCE_MAX_ITEMS', 100, int)
+
+#: Milliseconds after which requests are logged as slow, with their SQL
+SLOW_REQUEST_MS = setting('SLOW_REQUEST_MS', 500, float)
+
+#: Fraction of requests to profile, from 0 to 1
+PROFILE_RATE = setting('PROFILE_RATE', 0, float)
+#: Requests with this in their X-Profile header are profiled, unless empty
+PROFILE_TOKEN = setting('PROFILE_TOKEN', '')
+#: What profiles measure: cpu, with cProfile, or memory, with tracemalloc
+PROFILE_MODE = setting('PROFILE_MODE', 'cpu')
+#: Directory profiles are written to, one set of files per route
+PROFILE_DIRECTORY = setting('PROFILE_DIRECTORY', 'profiles')
+#: Seconds for which each route's profiles are merged into its files
+PROFILE_WINDOW = setting('PROFILE_WINDOW', 300, int)
+#: Seconds between dumps of the profiles of routes that were sampled
+PROFILE_INTERVAL = setting('PROFILE_INTERVAL', 10, float)
+#: Most frames of each stack allocating memory kept by memory profiles
+PROFILE_FRAMES = setting('PROFILE_FRAMES', 25, int)
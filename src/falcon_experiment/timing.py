@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Timings of where a request spends its time, for the Timing middleware.
+
+The middleware starts a Timings for each request, as this thread's
+current one. Code that does work worth timing, such as decoding a body or
+dumping a document, wraps it in timed, which adds the seconds it takes to
+the current Timings under a phase name. It costs next to nothing when no
+Timings is current. SQL statements run on any of our engines are timed
+and counted by the listeners at the bottom of this module.
+
+Work done after the response middleware has run, such as reading the rows
+of a streamed page and encoding them, is not timed.
+"""
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#: The Timings of the request this thread is serving, if any
+local = threading.local()
+
+
+class Timings(object):
+
+    """The seconds spent in each phase of a request, and its SQL statements.
+
+    Phases may overlap. The responder's time includes any decoding,
+    dumping, encoding and SQL it does. A phase timed again within itself,
+    such as a schema loading a nested schema, is only timed once.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.active = set()
+        self.queries = 0
+        self.statements = []
+
+    @contextmanager
+    def phase(self, phase):
+        """Time the body of a with statement as a phase."""
+        if phase in self.active:
+            yield
+            return
+
+        self.active.add(phase)
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.active.discard(phase)
+            self.add(phase, time.perf_counter() - began)
+
+    def add(self, phase, seconds):
+        """Add seconds to the time spent in a phase."""
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def add_statement(self, statement, seconds):
+        """Count an SQL statement and the seconds it took."""
+        self.queries += 1
+        self.add('sql', seconds)
+        self.statements.append((seconds, statement))
+
+    def slowest(self, count):
+        """Return the slowest statements and their seconds, slowest first."""
+        return sorted(
+            self.statements, key=lambda statement: statement[0], reverse=True
+        )[:count]
+
+
+def current():
+    """Return the Timings of this thread's request, or None."""
+    return getattr(local, 'timings', None)
+
+
+def start():
+    """Start timing a request in this thread, returning its Timings."""
+    local.timings = Timings()
+    return local.timings
+
+
+def stop():
+    """Stop timing this thread's request, returning its Timings or None."""
+    timings = current()
+    local.timings = None
+    return timings
+
+
+@contextmanager
+def timed(phase):
+    """Time the body of a with statement as a phase of the current request."""
+    timings = current()
+    if timings is None:
+        yield
+        return
+
+    with timings.phase(phase):
+        yield
+
+
+def timed_function(phase, function):
+    """Wrap a function, timing its calls as a phase of the current request."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        timings = current()
+        if timings is None:
+            return function(*args, **kwargs)
+
+        with timings.phase(phase):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(connection, cursor, statement, parameters,
+                          context, executemany):
+    """Note when a statement began, if the request is being timed."""
+    if current() is not None:
+        connection.info['began'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(connection, cursor, statement, parameters,
+                         context, executemany):
+    """Add the time a statement took to the timings of the request."""
+    began = connection.info.pop('began', None)
+    timings = current()
+    if began is not None and timings is not None:
+        timings.add_statement(statement, time.perf_counter() - began)
@@ -22,3 +22,5 @@ def db(scope='session'):
 def client(db):
     """Provide a client using werkzeug for simulating HTTP."""
     yield Client(app.application, BaseResponse)
+    app.cache.clear()
+    app.users.clear()
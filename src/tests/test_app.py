@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Tests for the request and response objects."""
+
+import json
+import logging
+
+import pytest
+from falcon.testing import create_environ
+from sqlalchemy import event
+
+from falcon_experiment.app import (
+    DBSession,
+    JSONRequest,
+    JSONResponse,
+    Timing,
+)
+from falcon_experiment.db import Session, engine
+from falcon_experiment.models import User
+
+
+@pytest.yield_fixture
+def checkouts():
+    """Count the connections checked out of the pool."""
+    counted = []
+
+    def count(dbapi_connection, connection_record, connection_proxy):
+        counted.append(connection_record)
+
+    event.listen(engine, 'checkout', count)
+    yield counted
+    event.remove(engine, 'checkout', count)
+
+
+def request(method):
+    """Return a request with a method, as passed to middleware."""
+    return JSONRequest(create_environ(method=method))
+
+
+def test_document_eager():
+    """Test that ordinary documents are encoded whole."""
+    response = JSONResponse()
+    response.document = {'users': [{'email': 'a.test@example.com'}]}
+    assert response.stream is None
+    assert json.loads(response.data.decode()) == {
+        'users': [{'email': 'a.test@example.com'}],
+    }
+
+
+def test_document_lazy_small():
+    """Test that lazy documents under the stream threshold are not streamed."""
+    response = JSONResponse()
+    response.document = iter([1, 2, 3])
+    assert response.stream is None
+    assert json.loads(response.data.decode()) == [1, 2, 3]
+
+
+def test_document_lazy_streamed():
+    """Test that lazy documents over the stream threshold are streamed."""
+    items = list(range(JSONResponse.stream_threshold))
+    response = JSONResponse()
+    response.document = {'items': iter(items)}
+    assert response.data is None
+    chunks = list(response.stream)
+    assert len(chunks) > 1
+    assert json.loads(b''.join(chunks).decode()) == {'items': items}
+
+
+def test_session_unused(checkouts):
+    """Test that requests which never use the session hold no connection."""
+    req = request('POST')
+    DBSession().process_response(req, JSONResponse(), None)
+    assert not Session.registry.has()
+    assert req.context['connection_held'] == 0
+    assert checkouts == []
+
+
+def test_session_connection_held(db, checkouts):
+    """Test that the time the session held a connection is recorded."""
+    req = request('GET')
+    Session.query(User).all()
+    DBSession().process_response(req, JSONResponse(), None)
+    assert not Session.registry.has()
+    assert req.context['connection_held'] > 0
+    assert len(checkouts) == 1
+
+
+def test_session_read_only_rolled_back(db):
+    """Test that read only requests never commit changes."""
+    Session.add(User(email='a.test@example.com', username='atest'))
+    DBSession().process_response(request('GET'), JSONResponse(), None)
+    assert Session.query(User).count() == 0
+    Session.remove()
+
+
+def test_session_committed(db):
+    """Test that other requests commit their changes."""
+    Session.add(User(email='a.test@example.com', username='atest'))
+    DBSession().process_response(request('POST'), JSONResponse(), None)
+    assert Session.query(User).count() == 1
+    Session.remove()
+
+
+def test_timing_header(client):
+    """Test that where a request's time went is sent in Server-Timing."""
+    response = client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    metrics = [
+        metric.split(';')[0]
+        for metric in response.headers['Server-Timing'].split(', ')
+    ]
+    assert metrics == [
+        'total', 'decode', 'responder', 'load', 'sql', 'encode', 'queries'
+    ]
+
+    response = client.get('/user/a.test@example.com')
+    assert 'dump;dur=' in response.headers['Server-Timing']
+    # BEGIN, and the SELECT of the user
+    assert 'queries;desc="2"' in response.headers['Server-Timing']
+
+
+def test_timing_slow_logged(db, caplog):
+    """Test that slow requests are logged with their slowest SQL."""
+    req = request('GET')
+    resp = JSONResponse()
+    middleware = Timing(slow_seconds=0)
+    middleware.process_request(req, resp)
+    middleware.process_resource(req, resp, None)
+    Session.query(User).all()
+    Session.remove()
+    with caplog.at_level(logging.INFO):
+        middleware.process_response(req, resp, None)
+
+    record, = caplog.records
+    assert record.levelno == logging.WARNING
+    assert 'queries=2' in record.getMessage()
+    assert 'SELECT users.version' in record.getMessage()
+    assert record.timing['statements'][0][1].startswith('SELECT')
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Tests for the ASGI application and its async resources."""
+
+import asyncio
+import json
+from collections import namedtuple
+
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+from falcon_experiment import async_db, async_resources  # noqa: E402
+from falcon_experiment.asgi import asgi_application, create_tables  # noqa
+
+Response = namedtuple('Response', 'status headers body')
+
+
+class Client(object):
+
+    """Sends requests to the ASGI application, on an event loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    async def send(self, method, path, document=None, query_string='',
+                   headers=None, body=None):
+        """Send a request, returning its Response."""
+        if document is not None:
+            body = json.dumps(document).encode()
+        headers = dict(headers or {})
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/json')
+            headers['Content-Length'] = str(len(body))
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string.encode(),
+            'headers': [
+                (name.lower().encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+        messages = [{'type': 'http.request', 'body': body or b''}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi_application(scope, receive, send)
+        start, body = sent
+        return Response(
+            start['status'],
+            {
+                name.decode(): value.decode()
+                for name, value in start['headers']
+            },
+            json.loads(body['body'].decode()) if body['body'] else None,
+        )
+
+    def __getattr__(self, method):
+        """Return a function sending a request with a method, and waiting."""
+        def request(*args, **kwargs):
+            return self.loop.run_until_complete(
+                self.send(method.upper(), *args, **kwargs)
+            )
+        return request
+
+
+@pytest.yield_fixture
+def client():
+    """Provide a client of the ASGI application, with the tables created."""
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(create_tables())
+    yield Client(loop)
+    # Closes the connection to the in memory database, so drops it
+    loop.run_until_complete(async_db.engine.dispose())
+    loop.close()
+
+
+def create_user(client, email):
+    """Create a user, asserting that it was."""
+    response = client.post('/user', {'email': email, 'username': 'Test'})
+    assert response.status == 201
+
+
+def test_lifespan():
+    """Test that the server's lifespan events are answered."""
+    messages = [
+        {'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(
+        asgi_application({'type': 'lifespan'}, receive, send)
+    )
+    loop.close()
+    assert sent == [
+        'lifespan.startup.complete', 'lifespan.shutdown.complete',
+    ]
+
+
+def test_create_and_get_user(client):
+    """Test that users are created, read, and revalidated by ETag."""
+    create_user(client, 'a.test@example.com')
+    response = client.get('/user/a.test@example.com')
+    assert response.status == 200
+    assert response.body['email'] == 'a.test@example.com'
+    assert response.headers['content-type'] == 'application/json'
+
+    response = client.get('/user/a.test@example.com', headers={
+        'If-None-Match': response.headers['etag'],
+    })
+    assert response.status == 304
+    assert response.body is None
+
+
+def test_errors(client):
+    """Test that errors are answered as the WSGI application does."""
+    response = client.get('/user/nobody@example.com')
+    assert response.status == 404
+
+    response = client.post('/user', {'email': 'not an email'})
+    assert response.status == 400
+    assert response.body['title'] == 'Invalid document submitted'
+
+    response = client.post('/user', body=b'{')
+    assert response.status == 400
+
+    response = client.get('/user', headers={'Accept': 'text/html'})
+    assert response.status == 406
+
+    response = client.delete('/user')
+    assert response.status == 405
+
+
+def test_body_too_large(client):
+    """Test that bodies larger than the limit are refused."""
+    response = client.post('/user', body=b' ' * (1024 * 1024 + 1))
+    assert response.status == 413
+
+
+def test_user_pages(client):
+    """Test that users are listed a page at a time."""
+    for number in range(3):
+        create_user(client, 'user.{}@example.com'.format(number))
+
+    response = client.get('/user', query_string='limit=2')
+    assert [user['email'] for user in response.body['users']] == [
+        'user.0@example.com', 'user.1@example.com',
+    ]
+    response = client.get(
+        '/user', query_string='limit=2&cursor=' + response.body['next']
+    )
+    assert [user['email'] for user in response.body['users']] == [
+        'user.2@example.com',
+    ]
+    assert response.body['next'] is None
+
+
+def test_group_members(client):
+    """Test that groups are created with members, and changed."""
+    for name in ('a', 'b', 'c'):
+        create_user(client, '{}.test@example.com'.format(name))
+    response = client.post('/group', {'name': 'Group', 'users': [
+        {'email': 'a.test@example.com'}, {'email': 'b.test@example.com'},
+    ]})
+    assert response.status == 201
+    path = '/' + response.body['uri'].split('/', 3)[-1]
+
+    response = client.patch(path, {
+        'add': ['c.test@example.com'], 'remove': ['a.test@example.com'],
+    })
+    assert response.body == {'added': 1, 'removed': 1}
+    response = client.get(path)
+    assert response.body['name'] == 'Group'
+    assert response.body['users'] == [
+        {'email': 'b.test@example.com'}, {'email': 'c.test@example.com'},
+    ]
+
+    response = client.get('/group', query_string='include=member_count')
+    assert response.body['groups'][0]['member_count'] == 2
+
+
+def test_group_unknown_users(client):
+    """Test that groups may only be given users that exist."""
+    response = client.post('/group', {'name': 'Group', 'users': [
+        {'email': 'nobody@example.com'},
+    ]})
+    assert response.status == 400
+    response = client.get('/group')
+    assert response.body['groups'] == []
+
+
+def test_group_users_deleted_since_validated(client, monkeypatch):
+    """Test that users gone when memberships are written are refused."""
+    async def validate_existing(emails):
+        pass
+
+    response = client.post('/group', {'name': 'Group', 'users': []})
+    path = '/' + response.body['uri'].split('/', 3)[-1]
+    # As if the users were deleted after they were validated
+    monkeypatch.setattr(
+        async_resources, 'validate_existing', validate_existing
+    )
+
+    response = client.patch(path, {'add': ['nobody@example.com']})
+    assert response.status == 400
+    assert response.body['description'] == {'_schema': [
+        "Users: {'nobody@example.com'} do not exist"
+    ]}
+    response = client.post('/group', {'name': 'Other', 'users': [
+        {'email': 'nobody@example.com'},
+    ]})
+    assert response.status == 400
+    response = client.get('/group')
+    assert [group['name'] for group in response.body['groups']] == ['Group']
+    assert client.get(path).body['users'] == []
+
+
+def test_deletes(client):
+    """Test that deleting a user changes its groups' ETags."""
+    create_user(client, 'a.test@example.com')
+    response = client.post('/group', {'name': 'Group', 'users': [
+        {'email': 'a.test@example.com'},
+    ]})
+    path = '/' + response.body['uri'].split('/', 3)[-1]
+    etag = client.get(path).headers['etag']
+
+    assert client.delete('/user/a.test@example.com').status == 204
+    assert client.delete('/user/a.test@example.com').status == 404
+    response = client.get(path)
+    assert response.body['users'] == []
+    assert response.headers['etag'] != etag
+
+    assert client.delete(path).status == 204
+    assert client.get(path).status == 404
+
+
+def test_concurrent_requests(client):
+    """Test that concurrent requests each have a session of their own."""
+    async def create_and_get(number):
+        email = 'user.{}@example.com'.format(number)
+        await client.send('POST', '/user', {'email': email, 'username': 'A'})
+        return await client.send('GET', '/user/{}'.format(email))
+
+    async def create_and_get_all():
+        return await asyncio.gather(*(
+            create_and_get(number) for number in range(20)
+        ))
+
+    responses = client.loop.run_until_complete(create_and_get_all())
+    assert [response.status for response in responses] == [200] * 20
+    assert async_db.scope.get() is None
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""Tests for the response and existence caches."""
+
+import json
+import threading
+from urllib.parse import urlparse
+
+import pytest
+
+from falcon_experiment import app
+from falcon_experiment.cache import BloomFilter, ExistenceCache, ResponseCache
+from falcon_experiment.db import engine
+
+
+class Clock(object):
+
+    """A clock for tests, which only moves when told to."""
+
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        """Return the current time."""
+        return self.time
+
+
+@pytest.fixture()
+def clock():
+    """Fixture to provide a clock that can be moved on by hand."""
+    return Clock()
+
+
+def test_get_and_set(clock):
+    """Test that cached bodies are returned, and misses counted."""
+    cache = ResponseCache(clock=clock)
+    assert cache.get('/user/a', 'application/json') is None
+    cache.set('/user/a', 'application/json', b'{}')
+    assert cache.get('/user/a', 'application/json') == b'{}'
+    assert cache.get('/user/a', 'application/msgpack') is None
+    assert cache.stats == {
+        'hits': 1,
+        'misses': 2,
+        'evictions': 0,
+        'expirations': 0,
+        'size': 1,
+    }
+
+
+def test_ttl(clock):
+    """Test that bodies expire once they have lived for the ttl."""
+    cache = ResponseCache(ttl=10, clock=clock)
+    cache.set('/user/a', 'application/json', b'{}')
+    clock.time = 9
+    assert cache.get('/user/a', 'application/json') == b'{}'
+    clock.time = 10
+    assert cache.get('/user/a', 'application/json') is None
+    assert cache.stats['expirations'] == 1
+    assert cache.stats['size'] == 0
+
+
+def test_lru_eviction(clock):
+    """Test that the least recently used body is evicted when full."""
+    cache = ResponseCache(capacity=2, clock=clock)
+    cache.set('/user/a', 'application/json', b'a')
+    cache.set('/user/b', 'application/json', b'b')
+    cache.get('/user/a', 'application/json')
+    cache.set('/user/c', 'application/json', b'c')
+    assert cache.get('/user/b', 'application/json') is None
+    assert cache.get('/user/a', 'application/json') == b'a'
+    assert cache.get('/user/c', 'application/json') == b'c'
+    assert cache.stats['evictions'] == 1
+
+
+def test_invalidate(clock):
+    """Test that invalidating a URI drops it in every media type."""
+    cache = ResponseCache(clock=clock)
+    cache.set('/user/a', 'application/json', b'{}')
+    cache.set('/user/a', 'application/msgpack', b'\x80')
+    cache.set('/user/b', 'application/json', b'{}')
+    cache.invalidate('/user/a', '/user/c')
+    assert cache.get('/user/a', 'application/json') is None
+    assert cache.get('/user/a', 'application/msgpack') is None
+    assert cache.get('/user/b', 'application/json') == b'{}'
+
+
+def test_disabled(clock):
+    """Test that a cache with no capacity caches nothing."""
+    cache = ResponseCache(capacity=0, clock=clock)
+    cache.set('/user/a', 'application/json', b'{}')
+    assert cache.get('/user/a', 'application/json') is None
+
+
+def test_get_user_cached(client):
+    """Test that a retrieved user is served from the cache after that."""
+    client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    first = client.get('/user/a.test@example.com')
+    hits = app.cache.hits
+    second = client.get('/user/a.test@example.com')
+    assert app.cache.hits == hits + 1
+    assert second.data == first.data
+    assert second.headers['Content-Type'] == 'application/json'
+
+    client.delete('/user/a.test@example.com')
+    response = client.get('/user/a.test@example.com')
+    assert response.status == '404 Not Found'
+
+
+def test_delete_user_invalidates_groups(client):
+    """Test that deleting a user drops the cached groups it was in."""
+    for email in ('a.test@example.com', 'b.test@example.com'):
+        client.post(
+            '/user',
+            data=json.dumps({'email': email, 'username': 'A Test'}),
+            content_type='application/json',
+        )
+    response = client.post(
+        '/group',
+        data=json.dumps({
+            'name': 'Test Group',
+            'users': [
+                {'email': 'a.test@example.com'},
+                {'email': 'b.test@example.com'},
+            ],
+        }),
+        content_type='application/json',
+    )
+    path = urlparse(json.loads(response.data.decode())['uri']).path
+    response = client.get(path)
+    assert len(json.loads(response.data.decode())['users']) == 2
+
+    client.delete('/user/a.test@example.com')
+    response = client.get(path)
+    assert json.loads(response.data.decode())['users'] == [
+        {'email': 'b.test@example.com'}
+    ]
+
+
+def test_bloom_filter():
+    """Test that a Bloom filter holds what is added, and little else."""
+    bloom = BloomFilter(1000)
+    added = ['{}.test@example.com'.format(number) for number in range(1000)]
+    for key in added:
+        bloom.add(key)
+    assert all(key in bloom for key in added)
+
+    others = ['{}.other@example.com'.format(number) for number in range(1000)]
+    assert sum(key in bloom for key in others) < 30
+
+
+class Lookup(object):
+
+    """A lookup for tests, which records the keys it is asked for."""
+
+    def __init__(self, existing):
+        self.existing = set(existing)
+        self.calls = []
+
+    def __call__(self, keys):
+        """Return the keys that exist."""
+        self.calls.append(set(keys))
+        return self.existing & set(keys)
+
+
+def test_existence_cache(clock):
+    """Test that known keys and those not in the filter are not looked up."""
+    lookup = Lookup({'a', 'b'})
+    cache = ExistenceCache(lambda: ['a', 'b'], capacity=10, clock=clock)
+    assert cache.existing({'a', 'c'}, lookup) == {'a'}
+    assert lookup.calls == [{'a'}]
+    assert cache.existing({'a', 'b', 'c'}, lookup) == {'a', 'b'}
+    assert lookup.calls == [{'a'}, {'b'}]
+    assert cache.stats == {'hits': 1, 'misses': 2, 'negatives': 2, 'size': 2}
+
+
+def test_existence_cache_writes(clock):
+    """Test that added keys are known, and invalidated ones looked up."""
+    lookup = Lookup({'a', 'b'})
+    cache = ExistenceCache(lambda: ['a'], capacity=10, clock=clock)
+    assert cache.existing({'b'}, lookup) == set()
+    cache.add('b')
+    assert cache.existing({'b'}, lookup) == {'b'}
+    assert lookup.calls == []
+
+    cache.invalidate('b')
+    lookup.existing.discard('b')
+    assert cache.existing({'b'}, lookup) == set()
+    assert lookup.calls == [{'b'}]
+
+
+def test_existence_cache_ttl(clock):
+    """Test that the filter is loaded again once it has lived for the ttl."""
+    keys = ['a']
+    cache = ExistenceCache(lambda: keys, capacity=1, ttl=10, clock=clock)
+    lookup = Lookup({'a', 'b'})
+    assert cache.existing({'b'}, lookup) == set()
+    keys = ['a', 'b']
+    clock.time = 10
+    assert cache.existing({'a', 'b'}, lookup) == {'a', 'b'}
+    # The least recently used key was evicted to keep within capacity
+    assert cache.stats['size'] == 1
+
+
+def test_existence_cache_stale_window(clock):
+    """Test that keys deleted elsewhere are said to exist for up to the ttl."""
+    lookup = Lookup({'a'})
+    cache = ExistenceCache(lambda: ['a'], capacity=10, ttl=10, clock=clock)
+    assert cache.existing({'a'}, lookup) == {'a'}
+    # Deleted by another process, so never invalidated here
+    lookup.existing.discard('a')
+    clock.time = 9
+    assert cache.existing({'a'}, lookup) == {'a'}
+    clock.time = 10
+    assert cache.existing({'a'}, lookup) == set()
+
+
+def test_existence_cache_loads_once():
+    """Test that one thread loads the filter while others use the last."""
+    loading = threading.Event()
+    release = threading.Event()
+    loads = []
+
+    def load():
+        loads.append(None)
+        if len(loads) > 1:
+            loading.set()
+            release.wait(5)
+        return ['a']
+
+    cache = ExistenceCache(load, capacity=10, ttl=0)
+    cache.load_bloom()
+    thread = threading.Thread(target=cache.load_bloom)
+    thread.start()
+    assert loading.wait(5)
+    # The filter has expired, but is being loaded, so is used as it was
+    assert 'a' in cache.load_bloom()
+    assert len(loads) == 2
+    release.set()
+    thread.join()
+
+
+def test_existence_cache_disabled():
+    """Test that a cache with no capacity looks up every key."""
+    lookup = Lookup({'a'})
+    cache = ExistenceCache(lambda: ['a'], capacity=0)
+    cache.add('a')
+    assert cache.existing({'a', 'b'}, lookup) == {'a'}
+    assert lookup.calls == [{'a', 'b'}]
+
+
+def test_post_group_users_cached(client, monkeypatch):
+    """Test that group writes check users through the existence cache."""
+    monkeypatch.setattr(app.users, 'capacity', 100)
+    client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+
+    def post_group(name, *emails):
+        return client.post(
+            '/group',
+            data=json.dumps({
+                'name': name,
+                'users': [{'email': email} for email in emails],
+            }),
+            content_type='application/json',
+        )
+
+    response = post_group('Test Group', 'a.test@example.com')
+    assert response.status == '201 Created'
+    response = post_group('Other Group', 'b.test@example.com')
+    assert response.status == '400 Bad Request'
+    assert app.users.stats['hits'] == 1
+    assert app.users.stats['negatives'] == 1
+
+    client.delete('/user/a.test@example.com')
+    response = post_group('Third Group', 'a.test@example.com')
+    assert response.status == '400 Bad Request'
+    assert app.users.stats['misses'] == 1
+
+
+def test_group_users_deleted_elsewhere(client, monkeypatch):
+    """Test that users cached as existing are checked again as written."""
+    monkeypatch.setattr(app.users, 'capacity', 100)
+    client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    response = client.post(
+        '/group',
+        data=json.dumps({'name': 'Test Group', 'users': []}),
+        content_type='application/json',
+    )
+    path = urlparse(json.loads(response.data.decode())['uri']).path
+    app.users.add('a.test@example.com')
+    hits = app.users.stats['hits']
+    # Deleted by another process, so never invalidated in this one
+    engine.execute('DELETE FROM users')
+
+    response = client.post(
+        '/group',
+        data=json.dumps({
+            'name': 'Other Group', 'users': [{'email': 'a.test@example.com'}],
+        }),
+        content_type='application/json',
+    )
+    assert response.status == '400 Bad Request'
+    response = client.patch(
+        path,
+        data=json.dumps({'add': ['a.test@example.com']}),
+        content_type='application/json',
+    )
+    assert response.status == '400 Bad Request'
+    assert app.users.stats['hits'] == hits + 2
+    assert engine.execute(
+        'SELECT count(*) FROM groups_to_users'
+    ).scalar() == 0
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Tests for the write coalescer."""
+
+import json
+import threading
+
+import pytest
+
+from falcon_experiment import app
+from falcon_experiment.coalesce import Write, WriteCoalescer
+from falcon_experiment.db import Session
+from falcon_experiment.models import User
+from falcon_experiment.resources import create_user
+
+
+@pytest.yield_fixture()
+def session(db):
+    """Fixture to yield the scoped session, removing it afterwards."""
+    yield Session
+    Session.remove()
+
+
+def test_submit(session):
+    """Test that a submitted write is committed before it returns."""
+    coalescer = WriteCoalescer(max_delay=0)
+    email = coalescer.submit(
+        create_user, {'email': 'a.test@example.com', 'username': 'A Test'}
+    )
+    assert email == 'a.test@example.com'
+    assert not session.new
+    session.remove()
+    assert session.query(User).get('a.test@example.com') is not None
+    assert coalescer.stats == {'batches': 1, 'writes': 1}
+
+
+def test_failed_write_rolled_back_alone(session):
+    """Test that a failing write is rolled back without the others."""
+    def fail():
+        session.add(User(email='b.test@example.com', username='B Test'))
+        session.flush()
+        raise ValueError('failed')
+
+    writes = [
+        Write(create_user, ({'email': 'a.test@example.com',
+                             'username': 'A Test'},)),
+        Write(fail, ()),
+    ]
+    WriteCoalescer().flush(writes)
+    assert writes[0].result() == 'a.test@example.com'
+    with pytest.raises(ValueError):
+        writes[1].result()
+
+    session.remove()
+    assert session.query(User.email).all() == [('a.test@example.com',)]
+
+
+def test_concurrent_writes_batched():
+    """Test that writes submitted concurrently are committed together."""
+    coalescer = WriteCoalescer(max_items=4, max_delay=10)
+    results = []
+
+    def submit(number):
+        try:
+            results.append(coalescer.submit(lambda: number))
+        finally:
+            Session.remove()
+
+    threads = [
+        threading.Thread(target=submit, args=(number,))
+        for number in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [0, 1, 2, 3]
+    assert coalescer.stats == {'batches': 1, 'writes': 4}
+
+
+def test_post_user_coalesced(client, monkeypatch):
+    """Test creating users through the coalescer, as the app would."""
+    resource, _, _ = app.api._router.find('/user')
+    monkeypatch.setattr(resource, 'coalescer', WriteCoalescer(max_delay=0))
+    for _ in range(2):
+        response = client.post(
+            '/user',
+            data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+            content_type='application/json',
+        )
+        assert response.status == '201 Created'
+
+    response = client.get('/user/a.test@example.com')
+    assert json.loads(response.data.decode())['username'] == 'A'
+    assert resource.coalescer.stats == {'batches': 2, 'writes': 2}
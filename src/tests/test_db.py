@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Tests for the configuration of the engine."""
+
+import pytest
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from falcon_experiment import settings
+from falcon_experiment.db import (
+    TimedQueuePool,
+    create,
+    engine_options,
+    intent,
+)
+
+
+def test_engine_options_memory():
+    """Test that in memory SQLite databases are not pooled."""
+    assert engine_options(make_url('sqlite:///:memory:')) == {}
+    assert engine_options(make_url('sqlite://')) == {}
+
+
+def test_engine_options_sqlite_file():
+    """Test that file backed SQLite databases are pooled across threads."""
+    options = engine_options(make_url('sqlite:////tmp/test.db'))
+    assert options['poolclass'] is TimedQueuePool
+    assert options['pool_size'] == settings.POOL_SIZE
+    assert options['max_overflow'] == settings.MAX_OVERFLOW
+    assert options['pool_recycle'] == settings.POOL_RECYCLE
+    assert options['connect_args'] == {'check_same_thread': False}
+
+
+def test_engine_options_server(monkeypatch):
+    """Test that pool settings are passed to other databases as they are."""
+    monkeypatch.setattr(settings, 'POOL_SIZE', 20)
+    options = engine_options(make_url('postgresql://localhost/test'))
+    assert options == {
+        'poolclass': TimedQueuePool,
+        'pool_size': 20,
+        'max_overflow': settings.MAX_OVERFLOW,
+        'pool_recycle': settings.POOL_RECYCLE,
+        'pool_timeout': settings.POOL_TIMEOUT,
+    }
+
+
+def test_create_sqlite_file(tmpdir):
+    """Test that connections to SQLite files have the pragmas set."""
+    engine = create('sqlite:///{}'.format(tmpdir.join('test.db')))
+    with engine.connect() as connection:
+        pragma = connection.exec_driver_sql
+        assert pragma('PRAGMA journal_mode').scalar() == 'wal'
+        assert pragma('PRAGMA synchronous').scalar() == 1
+        assert pragma('PRAGMA busy_timeout').scalar() == (
+            settings.SQLITE_BUSY_TIMEOUT
+        )
+        assert pragma('PRAGMA mmap_size').scalar() == settings.SQLITE_MMAP_SIZE
+    engine.dispose()
+
+
+def test_begin_immediate(tmpdir, monkeypatch):
+    """Test that transactions which will write take the write lock at once."""
+    monkeypatch.setattr(settings, 'SQLITE_BUSY_TIMEOUT', 0)
+    engine = create('sqlite:///{}'.format(tmpdir.join('test.db')))
+    with engine.connect() as reader, engine.connect() as writer:
+        reader.begin()
+        monkeypatch.setattr(intent, 'write', True, raising=False)
+        writer.begin()
+        with pytest.raises(OperationalError):
+            with engine.connect() as other:
+                other.begin()
+    engine.dispose()
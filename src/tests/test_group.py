@@ -5,6 +5,9 @@ import json
 from urllib.parse import urlparse
 
 import pytest
+from sqlalchemy import event
+
+from falcon_experiment.models import User
 
 
 @pytest.yield_fixture()
@@ -154,6 +157,22 @@ def test_post_group_with_users(client, users):
     assert body['users'] == users
 
 
+def test_post_group_with_repeated_users(client, users):
+    """Test that a user listed twice is made a member once."""
+    payload = json.dumps({
+        'name': 'Test Group with Users',
+        'users': users + users[:1],
+    })
+    response = client.post(
+        '/group', data=payload, content_type='application/json'
+    )
+    assert response.status == '201 Created'
+
+    path = urlparse(json.loads(response.data.decode())['uri']).path
+    body = json.loads(client.get(path).data.decode())
+    assert body['users'] == users
+
+
 def test_post_group_with_user_does_not_exist(client, users):
     """
     Test user relations.
@@ -176,3 +195,223 @@ def test_post_group_with_user_does_not_exist(client, users):
     assert body['description'] == [
         "Users: {'does-not-exist@example.com'} do not exist"
     ]
+
+
+def test_get_groups(client, group, users):
+    """Test that the group collection lists groups, without their members."""
+    client.post(
+        '/group',
+        data=json.dumps({'name': 'Test Group with Users', 'users': users}),
+        content_type='application/json',
+    )
+    response = client.get('/group')
+    assert response.status == '200 OK'
+    body = json.loads(response.data.decode())
+    assert [group['name'] for group in body['groups']] == [
+        'Test Group', 'Test Group with Users'
+    ]
+    assert 'users' not in body['groups'][0]
+    assert 'member_count' not in body['groups'][0]
+    assert body['next'] is None
+
+
+def test_get_groups_paginated(client):
+    """Test that following the next cursor visits every group once."""
+    names = ['Group {}'.format(number) for number in range(5)]
+    for name in names:
+        client.post(
+            '/group',
+            data=json.dumps({'name': name}),
+            content_type='application/json',
+        )
+
+    seen = []
+    query_string = 'limit=2'
+    while True:
+        response = client.get('/group', query_string=query_string)
+        body = json.loads(response.data.decode())
+        seen.extend(group['name'] for group in body['groups'])
+        if body['next'] is None:
+            break
+        query_string = 'limit=2&cursor={}'.format(body['next'])
+
+    assert seen == names
+
+
+def test_get_groups_member_count(client, group, users):
+    """Test that member counts can be embedded in the group listing."""
+    client.post(
+        '/group',
+        data=json.dumps({'name': 'Test Group with Users', 'users': users}),
+        content_type='application/json',
+    )
+    response = client.get('/group', query_string='include=member_count')
+    assert response.status == '200 OK'
+    body = json.loads(response.data.decode())
+    assert [group['member_count'] for group in body['groups']] == [0, 3]
+
+
+def test_get_groups_bad_include(client):
+    """Test that including an unknown field returns a HTTP Bad Request."""
+    response = client.get('/group', query_string='include=users')
+    assert response.status == '400 Bad Request'
+
+
+def test_get_group_etag_changes_with_members(client, users):
+    """Test that a group's ETag changes when one of its members is deleted."""
+    response = client.post(
+        '/group',
+        data=json.dumps({'name': 'Test Group with Users', 'users': users}),
+        content_type='application/json',
+    )
+    path = urlparse(json.loads(response.data.decode())['uri']).path
+    etag = client.get(path).headers['ETag']
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status == '304 Not Modified'
+
+    client.delete('/user/{}'.format(users[0]['email']))
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status == '200 OK'
+    assert response.headers['ETag'] != etag
+    body = json.loads(response.data.decode())
+    assert users[0] not in body['users']
+
+
+def test_get_group_does_not_load_users(client, users):
+    """Test that members of a group are listed without loading them."""
+    response = client.post(
+        '/group',
+        data=json.dumps({'name': 'Test Group with Users', 'users': users}),
+        content_type='application/json',
+    )
+    path = urlparse(json.loads(response.data.decode())['uri']).path
+    loaded = []
+
+    def load(target, context):
+        loaded.append(target)
+
+    event.listen(User, 'load', load)
+    try:
+        response = client.get(path)
+    finally:
+        event.remove(User, 'load', load)
+
+    assert json.loads(response.data.decode())['users'] == users
+    assert loaded == []
+
+
+def test_get_group_users_paginated(client, users):
+    """Test paging through the members of a group."""
+    response = client.post(
+        '/group',
+        data=json.dumps({'name': 'Test Group with Users', 'users': users}),
+        content_type='application/json',
+    )
+    path = urlparse(json.loads(response.data.decode())['uri']).path
+    client.post(
+        '/group',
+        data=json.dumps({'name': 'Other Group', 'users': users[:1]}),
+        content_type='application/json',
+    )
+
+    seen = []
+    query_string = 'limit=2'
+    while True:
+        response = client.get(path + '/users', query_string=query_string)
+        assert response.status == '200 OK'
+        body = json.loads(response.data.decode())
+        assert len(body['users']) <= 2
+        seen.extend(body['users'])
+        if body['next'] is None:
+            break
+        query_string = 'limit=2&cursor={}'.format(body['next'])
+
+    assert [{'email': user['email']} for user in seen] == users
+    assert seen[0]['username'] == 'A Test'
+
+
+def test_get_group_users_not_found(client):
+    """Test that listing members of a missing group returns Not Found."""
+    response = client.get('/group/does-not-exist/users')
+    assert response.status == '404 Not Found'
+
+
+def test_patch_group_members(client, group, users):
+    """Test adding and removing members, which changes the ETag."""
+    etag = client.get(group).headers['ETag']
+    response = client.patch(
+        group,
+        data=json.dumps({'add': [user['email'] for user in users]}),
+        content_type='application/json',
+    )
+    assert response.status == '200 OK'
+    assert json.loads(response.data.decode()) == {'added': 3, 'removed': 0}
+
+    loaded = []
+
+    def load(target, context):
+        loaded.append(target)
+
+    event.listen(User, 'load', load)
+    try:
+        response = client.patch(
+            group,
+            data=json.dumps({
+                'add': [users[0]['email']],
+                'remove': [users[1]['email'], 'd.test@example.com'],
+            }),
+            content_type='application/json',
+        )
+    finally:
+        event.remove(User, 'load', load)
+
+    assert json.loads(response.data.decode()) == {'added': 0, 'removed': 1}
+    assert loaded == []
+    response = client.get(group, headers={'If-None-Match': etag})
+    assert response.status == '200 OK'
+    body = json.loads(response.data.decode())
+    assert body['users'] == [users[0], users[2]]
+
+
+def test_patch_group_bad_request(client, group, users):
+    """Test that missing users, users added and removed, and arrays fail."""
+    for document in (
+        {'add': ['does-not-exist@example.com']},
+        {'add': [users[0]['email']], 'remove': [users[0]['email']]},
+        {'add': 'a.test@example.com'},
+        [users[0]['email']],
+        'a.test@example.com',
+    ):
+        response = client.patch(
+            group, data=json.dumps(document), content_type='application/json'
+        )
+        assert response.status == '400 Bad Request'
+
+    body = json.loads(client.get(group).data.decode())
+    assert body['users'] == []
+
+
+def test_patch_group_not_found(client):
+    """Test that changing the members of a missing group is Not Found."""
+    response = client.patch(
+        '/group/does-not-exist',
+        data=json.dumps({'add': []}),
+        content_type='application/json',
+    )
+    assert response.status == '404 Not Found'
+
+
+def test_delete_group_with_users(client, users):
+    """Test that deleting a group deletes its memberships, not its users."""
+    response = client.post(
+        '/group',
+        data=json.dumps({'name': 'Test Group with Users', 'users': users}),
+        content_type='application/json',
+    )
+    path = urlparse(json.loads(response.data.decode())['uri']).path
+    response = client.delete(path)
+    assert response.status == '204 No Content'
+
+    response = client.get('/user/{}/groups'.format(users[0]['email']))
+    assert response.status == '200 OK'
+    assert json.loads(response.data.decode())['groups'] == []
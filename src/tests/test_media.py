@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Tests for the codecs and their registry."""
+
+import io
+import json
+from collections import OrderedDict
+
+import pytest
+from falcon.testing import create_environ
+
+from falcon_experiment.app import JSONRequest
+from falcon_experiment.media import (
+    ArrayDecoder,
+    ItemTooLarge,
+    JSONCodec,
+    MessagePackCodec,
+    OrjsonCodec,
+    Registry,
+    msgpack,
+    orjson,
+)
+
+requires_msgpack = pytest.mark.skipif(
+    msgpack is None, reason='msgpack is not installed'
+)
+json_codecs = [JSONCodec()] + ([OrjsonCodec()] if orjson else [])
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 3, 1024])
+def test_array_decoder(read_size):
+    """Test that arrays decode the same whatever size blocks are read in."""
+    document = [
+        12345, -1.5e10, 'caf\u00e9 \u2603', {'a': [1, {}]}, [], None, True
+    ]
+    body = ' [ {} ]\n'.format(', '.join(
+        json.dumps(item, ensure_ascii=False) for item in document
+    )).encode('utf-8')
+    decoder = ArrayDecoder(io.BytesIO(body), len(body), read_size)
+    assert list(decoder) == document
+
+
+@pytest.mark.parametrize('body', [b'[]', b' [ ] '])
+def test_array_decoder_empty(body):
+    """Test that empty arrays decode to no items."""
+    assert list(ArrayDecoder(io.BytesIO(body), len(body), 1)) == []
+
+
+@pytest.mark.parametrize('body', [
+    b'[1, 2',
+    b'[1 2]',
+    b'[1, 2,]',
+    b'[1, 2] 3',
+    b'{"a": 1}',
+    b'["\xff"]',
+])
+def test_array_decoder_malformed(body):
+    """Test that malformed arrays raise a ValueError."""
+    with pytest.raises(ValueError):
+        list(ArrayDecoder(io.BytesIO(body), len(body), 2))
+
+
+@pytest.mark.parametrize(
+    'codec', json_codecs + ([MessagePackCodec()] if msgpack else [])
+)
+@pytest.mark.parametrize('read_size', [1, 16])
+def test_decoder_item_too_large(codec, read_size):
+    """Test that decoders refuse items larger than their maximum size."""
+    document = ['x' * 100, 'y']
+    body = codec.dumps(document)
+    decoder = codec.decoder(io.BytesIO(body), len(body), read_size, 110)
+    assert list(decoder) == document
+
+    decoder = codec.decoder(io.BytesIO(body), len(body), read_size, 50)
+    with pytest.raises(ItemTooLarge):
+        list(decoder)
+
+
+def test_iterencode():
+    """Test that lazily encoded documents decode to what was iterated."""
+    items = [{'email': 'a.test@example.com'}, {'email': 'b.test@example.com'}]
+    document = OrderedDict([
+        ('users', iter(items)),
+        ('empty', iter([])),
+        ('nested', {}),
+        ('next', lambda: 'cursor'),
+    ])
+    encoded = b''.join(JSONCodec().iterencode(document))
+    assert json.loads(encoded.decode()) == {
+        'users': items,
+        'empty': [],
+        'nested': {},
+        'next': 'cursor',
+    }
+
+
+@pytest.mark.parametrize('codec', json_codecs)
+def test_json_codecs(codec):
+    """Test that the JSON codecs round trip documents."""
+    document = {'users': [{'email': 'a.test@example.com'}], 'next': None}
+    assert json.loads(codec.dumps(document).decode()) == document
+    assert codec.loads(codec.dumps(document)) == document
+    with pytest.raises(ValueError):
+        codec.loads(b'{')
+
+
+@requires_msgpack
+def test_msgpack_codec():
+    """Test that MessagePack lazy documents are evaluated, then encoded."""
+    codec = MessagePackCodec()
+    document = OrderedDict([
+        ('users', iter([{'email': 'a.test@example.com'}])),
+        ('next', lambda: None),
+    ])
+    encoded = b''.join(codec.iterencode(document))
+    assert codec.loads(encoded) == {
+        'users': [{'email': 'a.test@example.com'}],
+        'next': None,
+    }
+    with pytest.raises(ValueError):
+        codec.loads(b'\xc1')
+
+
+@requires_msgpack
+@pytest.mark.parametrize('read_size', [1, 3, 1024])
+def test_msgpack_decoder(read_size):
+    """Test that MessagePack arrays are decoded item by item."""
+    document = [{'email': 'a.test@example.com'}, 1, 'two', [3.0]] * 10
+    body = msgpack.packb(document)
+    decoder = MessagePackCodec().decoder(
+        io.BytesIO(body), len(body), read_size
+    )
+    assert decoder.is_array()
+    assert list(decoder) == document
+
+
+@requires_msgpack
+@pytest.mark.parametrize('body', [
+    b'\x92\x01',
+    b'\x92\x01\x02\x01',
+])
+def test_msgpack_decoder_malformed(body):
+    """Test that truncated or overlong MessagePack arrays raise ValueError."""
+    decoder = MessagePackCodec().decoder(io.BytesIO(body), len(body), 1)
+    with pytest.raises(ValueError):
+        list(decoder)
+
+
+@requires_msgpack
+def test_msgpack_decoder_not_array():
+    """Test that other MessagePack documents can be read whole."""
+    body = msgpack.packb({'email': 'a.test@example.com'})
+    decoder = MessagePackCodec().decoder(io.BytesIO(body), len(body), 2)
+    assert not decoder.is_array()
+    assert decoder.rest() == body
+
+
+@pytest.mark.parametrize('accept,media_type', [
+    ('*/*', 'application/json'),
+    ('application/*', 'application/json'),
+    ('application/json', 'application/json'),
+    ('application/msgpack', 'application/msgpack'),
+    ('application/json;q=0.5, application/msgpack', 'application/msgpack'),
+    ('text/html', None),
+])
+@requires_msgpack
+def test_registry_for_accept(accept, media_type):
+    """Test that codecs are chosen by the client's preference."""
+    registry = Registry()
+    registry.register(JSONCodec())
+    registry.register(MessagePackCodec())
+    request = JSONRequest(create_environ(headers={'Accept': accept}))
+    codec = registry.for_accept(request)
+    assert getattr(codec, 'media_type', None) == media_type
+
+
+def test_registry_for_content_type():
+    """Test that codecs are chosen by the media type of a request body."""
+    registry = Registry()
+    registry.register(JSONCodec())
+    codec = registry.for_content_type('application/json; charset=UTF-8')
+    assert codec.media_type == 'application/json'
+    assert registry.for_content_type('text/plain') is None
+    assert registry.for_content_type(None) is None
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Tests for the metrics and the /metrics endpoint."""
+
+import json
+import threading
+
+from falcon_experiment import app, metrics
+from falcon_experiment.metrics import Callback, Counter, Histogram, Registry
+
+
+def sample(text, line):
+    """Return the value of a sample in rendered metrics, or None."""
+    for rendered in text.splitlines():
+        if rendered.startswith(line + ' '):
+            return float(rendered.rsplit(' ', 1)[1])
+
+
+def test_counter_threads():
+    """Test that counts from every thread are summed."""
+    registry = Registry()
+    counter = registry.register(Counter('things_total', 'Things.'))
+
+    def count():
+        for _ in range(1000):
+            counter.inc((('kind', 'a'),))
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc((('kind', 'b'),), 2)
+
+    assert registry.render() == '\n'.join([
+        '# HELP things_total Things.',
+        '# TYPE things_total counter',
+        'things_total{kind="a"} 4000',
+        'things_total{kind="b"} 2',
+    ]) + '\n'
+    # Only this thread's shard is left, the others having been folded
+    assert len(registry.shards) == 1
+
+
+def test_histogram():
+    """Test that histograms render cumulative buckets, a sum and a count."""
+    registry = Registry()
+    histogram = registry.register(Histogram('size', 'Sizes.', [1, 10]))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'size_bucket{le="1"} 2',
+        'size_bucket{le="10"} 3',
+        'size_bucket{le="+Inf"} 4',
+        'size_sum 56.5',
+        'size_count 4',
+    ]
+
+
+def test_callback():
+    """Test that callback metrics are read when rendered, with labels."""
+    registry = Registry()
+    registry.register(Callback(
+        'pool', 'Pool.', lambda: [((('engine', 'a"b'),), 3)]
+    ))
+    assert registry.render().splitlines()[-1] == 'pool{engine="a\\"b"} 3'
+
+
+def test_metrics_endpoint(client):
+    """Test that requests are counted, and served as Prometheus text."""
+    def render():
+        response = client.get('/metrics', headers={'Accept': 'text/plain'})
+        assert response.status == '200 OK'
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+        return response.data.decode()
+
+    before = render()
+    client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    client.get('/user/a.test@example.com')
+    client.get('/user/does-not-exist@example.com')
+    after = render()
+
+    def increase(line):
+        return sample(after, line) - (sample(before, line) or 0)
+
+    assert increase(
+        'http_requests_total{resource="UserDetail",method="GET",status="200"}'
+    ) == 1
+    assert increase(
+        'http_requests_total{resource="UserDetail",method="GET",status="404"}'
+    ) == 1
+    assert increase(
+        'http_request_duration_seconds_count'
+        '{resource="UserCollection",method="POST"}'
+    ) == 1
+    assert increase(
+        'http_response_size_bytes_count{resource="UserDetail",method="GET"}'
+    ) == 1
+    assert increase('db_session_commits_total') == 1
+    assert increase('db_session_rollbacks_total') >= 2
+
+
+def test_metrics_caches(client):
+    """Test that the stats of the caches are served."""
+    client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    for _ in range(3):
+        client.get('/user/a.test@example.com')
+    response = client.get('/metrics', headers={'Accept': 'text/plain'})
+    text = response.data.decode()
+
+    stats = app.cache.stats
+    assert stats['hits'] >= 2
+    for name, stat in (
+        ('cache_hits_total', 'hits'),
+        ('cache_misses_total', 'misses'),
+        ('cache_evictions_total', 'evictions'),
+        ('cache_expirations_total', 'expirations'),
+        ('cache_entries', 'size'),
+    ):
+        assert sample(text, '{}{{cache="response"}}'.format(name)) == (
+            stats[stat]
+        )
+    assert sample(text, 'cache_negatives_total{cache="users"}') == (
+        app.users.stats['negatives']
+    )
+    assert sample(text, 'cache_evictions_total{cache="users"}') is None
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Tests for the database migrations."""
+
+from sqlalchemy import inspect, text
+
+from falcon_experiment.db import create
+from falcon_experiment.migrations import MIGRATIONS, migrate
+
+# The tables as they were before the first migration
+LEGACY_SCHEMA = [
+    'CREATE TABLE groups (version VARCHAR(32) NOT NULL, '
+    'id INTEGER NOT NULL, created DATETIME, name VARCHAR NOT NULL, '
+    'PRIMARY KEY (id))',
+    'CREATE TABLE users (version VARCHAR(32) NOT NULL, '
+    'email VARCHAR NOT NULL, created DATETIME, username VARCHAR NOT NULL, '
+    'PRIMARY KEY (email))',
+    'CREATE TABLE groups_to_users (group_id INTEGER, user_email INTEGER, '
+    'FOREIGN KEY(group_id) REFERENCES groups (id), '
+    'FOREIGN KEY(user_email) REFERENCES users (email))',
+]
+
+
+def test_migrate_new_database(tmpdir):
+    """Test that a new database is created whole, needing no migrations."""
+    engine = create('sqlite:///{}'.format(tmpdir.join('test.db')))
+    assert migrate(engine) == []
+    assert migrate(engine) == []
+    indexes = inspect(engine).get_indexes('groups')
+    assert [index['name'] for index in indexes] == ['ix_groups_name']
+    engine.dispose()
+
+
+def test_migrate_index_memberships(tmpdir):
+    """Test that legacy memberships are keyed, indexed and deduplicated."""
+    engine = create('sqlite:///{}'.format(tmpdir.join('test.db')))
+    with engine.begin() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text(
+            "INSERT INTO users VALUES ('1', 'a.test@example.com', NULL, 'A')"
+        ))
+        connection.execute(text(
+            "INSERT INTO groups VALUES ('1', 1, NULL, 'Group'), "
+            "('2', 2, NULL, 'Group'), ('3', 3, NULL, 'Other')"
+        ))
+        connection.execute(text(
+            "INSERT INTO groups_to_users VALUES (1, 'a.test@example.com'), "
+            "(1, 'a.test@example.com'), (2, 'a.test@example.com')"
+        ))
+
+    assert migrate(engine) == list(MIGRATIONS)
+    assert migrate(engine) == []
+
+    with engine.connect() as connection:
+        memberships = connection.execute(text(
+            'SELECT group_id, user_email FROM groups_to_users '
+            'ORDER BY group_id'
+        )).fetchall()
+        names = connection.execute(text(
+            'SELECT name FROM groups ORDER BY id'
+        )).fetchall()
+    assert memberships == [
+        (1, 'a.test@example.com'), (2, 'a.test@example.com'),
+    ]
+    assert names == [('Group',), ('Group (2)',), ('Other',)]
+
+    inspector = inspect(engine)
+    assert inspector.get_pk_constraint('groups_to_users')[
+        'constrained_columns'
+    ] == ['group_id', 'user_email']
+    assert [
+        index['name'] for index in inspector.get_indexes('groups_to_users')
+    ] == ['ix_groups_to_users_user_email']
+    engine.dispose()
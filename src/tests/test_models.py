@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Tests for the model query patterns."""
+
+import pytest
+from sqlalchemy import event
+
+from falcon_experiment.db import Session, engine
+from falcon_experiment.models import Group, Model, User
+
+
+@pytest.yield_fixture()
+def session(db):
+    """Fixture to yield the scoped session, removing it afterwards."""
+    yield Session
+    Session.remove()
+
+
+@pytest.yield_fixture(params=[True, False], ids=['native', 'fallback'])
+def native_upsert(request):
+    """Fixture to run a test with and without the native upsert path."""
+    Model.native_upsert = request.param
+    yield request.param
+    Model.native_upsert = True
+
+
+def test_upsert_insert(session):
+    """Test that a native upsert is only used to look up unique columns."""
+    assert User.upsert_insert({'email': 'a.test@example.com'}) is not None
+    assert User.upsert_insert({'username': 'A Test'}) is None
+    assert Group.upsert_insert({'name': 'Test Group'}) is not None
+
+
+def test_upsert_creates(session, native_upsert):
+    """Test that upserting a new row creates it."""
+    user = User.upsert(
+        email='a.test@example.com',
+        create_kwargs={'email': 'a.test@example.com', 'username': 'A Test'},
+    )
+    assert user in session
+    session.commit()
+    session.remove()
+
+    user = session.query(User).get('a.test@example.com')
+    assert user.username == 'A Test'
+    assert user.created
+
+
+def test_upsert_creates_in_one_statement(session):
+    """Test that a native upsert inserts without looking the row up first."""
+    statements = []
+
+    def execute(connection, cursor, statement, *args):
+        if not statement.startswith('BEGIN'):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', execute)
+    try:
+        User.upsert(
+            email='a.test@example.com',
+            create_kwargs={
+                'email': 'a.test@example.com', 'username': 'A Test',
+            },
+        )
+    finally:
+        event.remove(engine, 'before_cursor_execute', execute)
+
+    assert [statement.split()[0] for statement in statements] == ['INSERT']
+
+
+def test_upsert_gets_existing(session, native_upsert):
+    """Test that upserting an existing row returns it unchanged."""
+    session.add(User(email='a.test@example.com', username='A Test'))
+    session.commit()
+
+    user = User.upsert(
+        email='a.test@example.com',
+        create_kwargs={'email': 'a.test@example.com', 'username': 'B Test'},
+    )
+    session.commit()
+    assert user.username == 'A Test'
+    assert session.query(User).count() == 1
+
+
+def test_upsert_relationships(session, native_upsert):
+    """Test that relationships given to create a new row are saved."""
+    user = User(email='a.test@example.com', username='A Test')
+    session.add(user)
+    session.commit()
+
+    group = Group.upsert(
+        name='Test Group',
+        create_kwargs={'name': 'Test Group', 'users': [user]},
+    )
+    session.commit()
+    group_id = group.id
+    session.remove()
+
+    group = session.query(Group).get(group_id)
+    assert [user.email for user in group.users] == ['a.test@example.com']
+
+
+def test_existing_batched(session):
+    """Test that existing values are looked up a batch at a time."""
+    session.add_all(
+        User(email='{}.test@example.com'.format(number), username='Test')
+        for number in range(5)
+    )
+    session.commit()
+
+    statements = []
+
+    def execute(connection, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', execute)
+    try:
+        existing = User.existing(User.email, [
+            '{}.test@example.com'.format(number) for number in range(3, 8)
+        ], batch_size=2)
+    finally:
+        event.remove(engine, 'before_cursor_execute', execute)
+
+    assert existing == {'3.test@example.com', '4.test@example.com'}
+    assert len(statements) == 3
+
+
+def test_bulk_create_inserted_since_checked(session, monkeypatch):
+    """Test that rows inserted after they were looked up are skipped."""
+    existing = User.existing
+
+    def insert_after_checking(key, values, batch_size=500):
+        checked = existing(key, values, batch_size)
+        # As another transaction would, between the lookup and the INSERT
+        session.add(User(email='a.test@example.com', username='Other'))
+        session.flush()
+        return checked
+
+    monkeypatch.setattr(User, 'existing', insert_after_checking)
+    created = User.bulk_create(User.email, [
+        {'email': 'a.test@example.com', 'username': 'A Test'},
+        {'email': 'b.test@example.com', 'username': 'B Test'},
+    ])
+    session.commit()
+
+    # SQLite cannot say which of the batch were inserted, so counts neither
+    assert created <= {'b.test@example.com'}
+    assert session.query(User).get('a.test@example.com').username == 'Other'
+    assert session.query(User).count() == 2
+
+
+def test_bulk_create_parameters(session):
+    """Test that batches keep within the bound parameters SQLite allows."""
+    parameters = []
+
+    def execute(connection, cursor, statement, values, *args):
+        if statement.startswith('INSERT'):
+            parameters.append(len(values))
+
+    event.listen(engine, 'before_cursor_execute', execute)
+    try:
+        created = User.bulk_create(User.email, (
+            {'email': '{}.test@example.com'.format(number), 'username': 'T'}
+            for number in range(1000)
+        ))
+    finally:
+        event.remove(engine, 'before_cursor_execute', execute)
+
+    assert len(created) == 1000
+    assert max(parameters) <= 999
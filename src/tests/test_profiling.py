@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Tests for profiling a sample of requests."""
+
+import pstats
+import tracemalloc
+
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from falcon_experiment import app, settings
+from falcon_experiment.profiling import (
+    CPUProfiler,
+    MemoryProfiler,
+    Profiles,
+    collapse,
+)
+
+
+def profiled_client(profiles, **kwargs):
+    """Return a client of an API profiling requests to the given profiles."""
+    api = app.create_api([
+        app.Profiling(profiles, **kwargs),
+        app.Timing(),
+        app.RequireCodec(),
+        app.DBSession(),
+    ])
+    return Client(api, BaseResponse)
+
+
+def read_collapsed(path):
+    """Return the stacks and values of a collapsed stack file."""
+    stacks = {}
+    for line in path.read().splitlines():
+        stack, value = line.rsplit(' ', 1)
+        stacks[stack] = int(value)
+    return stacks
+
+
+def test_disabled_by_default(monkeypatch):
+    """Test that requests are not profiled unless a rate or token is set."""
+    assert not any(
+        isinstance(middleware, app.Profiling)
+        for middleware in app.default_middleware()
+    )
+    monkeypatch.setattr(settings, 'PROFILE_TOKEN', 'secret')
+    assert isinstance(app.default_middleware()[0], app.Profiling)
+
+
+@pytest.mark.usefixtures('db')
+def test_profile_token(tmpdir):
+    """Test that requests with the token are profiled, and no others."""
+    profiles = Profiles(CPUProfiler(), str(tmpdir), interval=0)
+    client = profiled_client(profiles, rate=0, token='secret')
+
+    client.get('/user', headers={'X-Profile': 'wrong'})
+    assert profiles.dump_changed() == []
+
+    response = client.get('/user', headers={'X-Profile': 'secret'})
+    assert response.status == '200 OK'
+    # Profiles are dumped apart from the requests profiled
+    assert tmpdir.listdir() == []
+    assert len(profiles.dump_changed()) == 2
+    assert profiles.dump_changed() == []
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        'UserCollection.GET.cpu.folded', 'UserCollection.GET.cpu.pstats',
+    ]
+    stats = pstats.Stats(str(tmpdir.join('UserCollection.GET.cpu.pstats')))
+    assert any(
+        name == 'on_get' and filename.endswith('resources.py')
+        for filename, _, name in stats.stats
+    )
+    stacks = read_collapsed(tmpdir.join('UserCollection.GET.cpu.folded'))
+    assert any(':on_get;' in stack for stack in stacks)
+
+
+@pytest.mark.usefixtures('db')
+def test_profile_rate(tmpdir):
+    """Test that requests are profiled at random, at the rate."""
+    profiles = Profiles(CPUProfiler(), str(tmpdir), interval=0)
+    draws = iter([0.9, 0.1])
+    client = profiled_client(
+        profiles, rate=0.5, token='', random=lambda: next(draws)
+    )
+
+    client.get('/user/a.test@example.com')
+    assert profiles.merged == {}
+    client.get('/user/a.test@example.com')
+    assert list(profiles.merged) == ['UserDetail.GET']
+
+
+@pytest.mark.usefixtures('db')
+def test_profile_memory(tmpdir):
+    """Test that memory profiles count bytes by stack, and stop tracing."""
+    profiles = Profiles(MemoryProfiler(), str(tmpdir), interval=0)
+    client = profiled_client(profiles, rate=1)
+
+    client.get('/user')
+    assert not tracemalloc.is_tracing()
+    profiles.dump_changed()
+    stacks = read_collapsed(tmpdir.join('UserCollection.GET.memory.folded'))
+    assert stacks
+    assert all(value > 0 for value in stacks.values())
+
+
+def test_profiles_window(tmpdir):
+    """Test that only the samples within the window are dumped, merged."""
+    now = [0]
+    profiles = Profiles(
+        MemoryProfiler(), str(tmpdir), window=10, interval=0,
+        clock=lambda: now[0],
+    )
+    profiles.add('route', {'a;b': 1})
+    now[0] = 5
+    profiles.add('route', {'a;b': 2, 'a;c': 3})
+    now[0] = 12
+    profiles.add('route', {'a;c': 4})
+
+    [path] = profiles.dump('route')
+    assert read_collapsed(tmpdir.join('route.memory.folded')) == {
+        'a;b': 2, 'a;c': 7,
+    }
+    assert profiles.dump('other') == []
+
+    # Samples leave the window even when no more are added
+    now[0] = 30
+    assert profiles.dump('route') == []
+
+
+def test_profiles_merged_as_added(tmpdir):
+    """Test that samples in a bucket are merged, leaving one per bucket."""
+    now = [0]
+    profiles = Profiles(
+        CPUProfiler(), str(tmpdir), window=10, interval=0,
+        clock=lambda: now[0],
+    )
+    for _ in range(3):
+        profile = profiles.profiler.start()
+        sum(range(1000))
+        profiles.add('route', profiles.profiler.stop(profile))
+    now[0] = 1
+    profiles.add('route', profiles.profiler.stop(profiles.profiler.start()))
+    assert [bucket for bucket, _ in profiles.merged['route']] == [0, 1]
+
+    profiles.dump('route')
+    stats = pstats.Stats(str(tmpdir.join('route.cpu.pstats')))
+    [calls] = [
+        stat[0] for (_, _, name), stat in stats.stats.items()
+        if name == '<built-in method builtins.sum>'
+    ]
+    assert calls == 3
+
+
+def test_profiles_dumped_by_thread(tmpdir):
+    """Test that profiles are dumped every interval by a thread."""
+    profiles = Profiles(MemoryProfiler(), str(tmpdir), interval=0.01)
+    profiles.add('route', {'a;b': 1})
+    profiles.thread.join(0.5)
+    assert tmpdir.join('route.memory.folded').check()
+
+    profiles.add('route', {'a;b': 1})
+    profiles.stop()
+    profiles.thread.join()
+    assert read_collapsed(tmpdir.join('route.memory.folded')) == {'a;b': 2}
+
+
+def test_collapse():
+    """Test that stacks are rebuilt from the callers of each function."""
+    def inner():
+        return sum(range(100000))
+
+    def outer():
+        return inner()
+
+    profile = CPUProfiler().start()
+    outer()
+    stacks = collapse(pstats.Stats(CPUProfiler().stop(profile)))
+
+    [stack] = [stack for stack in stacks if stack.endswith(':inner')]
+    assert stack.split(';')[-2].endswith(':outer')
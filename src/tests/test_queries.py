@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Tests for the Core read path."""
+
+import json
+from urllib.parse import urlparse
+
+import pytest
+from sqlalchemy.engine.default import CACHE_HIT
+
+from falcon_experiment import app, queries
+from falcon_experiment.db import Session
+from falcon_experiment.models import Group, User
+from falcon_experiment.resources import GroupDetail, UserDetail
+
+
+@pytest.yield_fixture()
+def session(db):
+    """Fixture to yield the scoped session with a user in a group."""
+    user = User(email='a.test@example.com', username='A Test')
+    Session.add(Group(name='Test Group', users=[user]))
+    Session.commit()
+    Session.remove()
+    yield Session
+    Session.remove()
+
+
+def test_reads_skip_identity_map(session):
+    """Test that rows are read without building mapped instances."""
+    user = queries.user('a.test@example.com')
+    assert user['username'] == 'A Test'
+    assert queries.user_version('a.test@example.com') == user['version']
+    group = queries.group(1)
+    assert group['name'] == 'Test Group'
+    assert queries.group_version(1) == group['version']
+    assert queries.member_emails(1) == ['a.test@example.com']
+    assert len(session.identity_map) == 0
+
+
+def test_reads_not_found(session):
+    """Test that reading rows that do not exist returns None."""
+    assert queries.user('does-not-exist@example.com') is None
+    assert queries.user_version('does-not-exist@example.com') is None
+    assert queries.group(2) is None
+    assert queries.member_emails(2) == []
+
+
+def test_reads_cached(session):
+    """Test that statements are found in the compiled cache once used."""
+    queries.user('a.test@example.com')
+    result = queries.execute(queries.USER, email='b.test@example.com')
+    assert result.context.cache_hit is CACHE_HIT
+
+
+@pytest.mark.parametrize('resource', [UserDetail, GroupDetail])
+def test_core_reads_match_orm(client, monkeypatch, resource):
+    """Test that documents read through Core match those of the ORM."""
+    client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    response = client.post(
+        '/group',
+        data=json.dumps({
+            'name': 'Test Group', 'users': [{'email': 'a.test@example.com'}]
+        }),
+        content_type='application/json',
+    )
+    group = urlparse(json.loads(response.data.decode())['uri']).path
+    path = group if resource is GroupDetail else '/user/a.test@example.com'
+
+    responses = []
+    for core_reads in (True, False):
+        monkeypatch.setattr(resource, 'core_reads', core_reads)
+        response = client.get(path)
+        etag = response.headers['ETag']
+        revalidated = client.get(path, headers={'If-None-Match': etag})
+        responses.append((response.data, etag, revalidated.status))
+        # Read from the database each time, not the response cache
+        app.cache.clear()
+
+    assert responses[0] == responses[1]
+    assert responses[0][2] == '304 Not Modified'
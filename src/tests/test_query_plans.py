@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Tests that hot queries are answered from indexes, not table scans."""
+
+import pytest
+from sqlalchemy import select
+
+from falcon_experiment.db import Session, engine
+from falcon_experiment.models import Group, User, groups_to_users
+
+
+def plan(statement):
+    """Return the steps SQLite plans to take to run a statement."""
+    compiled = statement.compile(
+        dialect=engine.dialect, compile_kwargs={'literal_binds': True}
+    )
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            'EXPLAIN QUERY PLAN {}'.format(compiled)
+        )
+        return [row[-1] for row in rows]
+
+
+def user_groups():
+    """Select the groups of a user through the dynamic relationship."""
+    user = User(email='a.test@example.com', username='A Test')
+    Session.add(user)
+    Session.flush()
+    try:
+        return user.groups.statement
+    finally:
+        Session.remove()
+
+
+@pytest.mark.parametrize('query', [
+    lambda: select([Group.id]).where(Group.name == 'Test Group'),
+    lambda: Group.member_emails(1),
+    lambda: User.in_group(1),
+    lambda: User.keyset_page(
+        User.email, after='a', limit=10, query=User.in_group(1)
+    ),
+    user_groups,
+    lambda: groups_to_users.delete().where(groups_to_users.c.group_id == 1),
+    lambda: groups_to_users.delete().where(
+        groups_to_users.c.user_email == 'a.test@example.com'
+    ),
+], ids=[
+    'group by name',
+    'member emails',
+    'users in group',
+    'users in group page',
+    'groups of user',
+    'delete memberships of group',
+    'delete memberships of user',
+])
+def test_uses_index(db, query):
+    """Test that a query searches an index rather than scanning a table."""
+    steps = plan(query())
+    assert steps
+    assert not [step for step in steps if step.startswith('SCAN')], steps
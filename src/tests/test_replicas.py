@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Tests for reading from replicas, with SQLite files standing in for them."""
+
+import json
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from falcon_experiment import app, db
+from falcon_experiment.models import Group, Model, User
+from falcon_experiment.resources import Page
+
+REPLICATED = {'email': 'replicated.test@example.com', 'username': 'Replica'}
+
+
+@pytest.yield_fixture()
+def replicas(tmpdir, client):
+    """Fixture to route reads to two replicas with a user the primary lacks."""
+    urls = [
+        'sqlite:///{}'.format(tmpdir.join('replica-{}.db'.format(number)))
+        for number in range(2)
+    ]
+    for url in urls:
+        engine = db.create(url)
+        Model.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(
+                User.__table__.insert(), dict(REPLICATED, version='1')
+            )
+        engine.dispose()
+
+    engines = [db.create(url, replica=True) for url in urls]
+    db.replicas[:] = engines
+    yield engines
+    del db.replicas[:]
+    for engine in engines:
+        engine.dispose()
+
+
+def test_read_engine_primary_by_default(replicas):
+    """Test that threads read from the primary unless they say otherwise."""
+    assert db.read_engine() is db.engine
+
+
+def test_page_reads_from_session_replica(replicas):
+    """Test that pages are read from the replica their session reads from."""
+    primary = getattr(db.intent, 'primary', True)
+    db.intent.primary = False
+    try:
+        bind = db.Session.get_bind()
+        assert bind in replicas
+        for _ in range(20):
+            assert Page(None, None, 'email', 10).engine is bind
+    finally:
+        db.intent.primary = primary
+        db.Session.remove()
+
+
+def test_reads_from_replica(client, replicas):
+    """Test that read only requests read from a replica."""
+    response = client.get('/user/{}'.format(REPLICATED['email']))
+    assert response.status == '200 OK'
+    response = client.get('/user')
+    assert json.loads(response.data.decode())['users'][0]['email'] == (
+        REPLICATED['email']
+    )
+
+
+def test_read_your_writes(client, replicas):
+    """Test that clients read from the primary for a while after writing."""
+    response = client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    assert 'primary_until=' in response.headers['Set-Cookie']
+    response = client.get('/user/a.test@example.com')
+    assert response.status == '200 OK'
+
+    app.cache.clear()
+    client.cookie_jar.clear()
+    response = client.get('/user/a.test@example.com')
+    assert response.status == '404 Not Found'
+
+
+def test_read_your_writes_past_the_cache(client, replicas):
+    """Test that replica reads are not cached for clients that wrote.
+
+    A client that is not sticky reads the group from a replica, which has
+    not seen the writer's change, after the writer changed it.
+    """
+    group = {'id': 1, 'name': 'Group', 'version': '1'}
+    for engine in [db.engine] + [
+        db.create(replica.url) for replica in replicas
+    ]:
+        with engine.begin() as connection:
+            connection.execute(Group.__table__.insert(), group)
+    client.post(
+        '/user',
+        data=json.dumps({'email': 'a.test@example.com', 'username': 'A'}),
+        content_type='application/json',
+    )
+    response = client.patch(
+        '/group/1',
+        data=json.dumps({'add': ['a.test@example.com']}),
+        content_type='application/json',
+    )
+    assert response.status == '200 OK'
+
+    other = Client(app.application, BaseResponse)
+    response = other.get('/group/1')
+    assert json.loads(response.data.decode())['users'] == []
+    assert app.cache.get('/group/1', 'application/json') is None
+
+    response = client.get('/group/1')
+    assert json.loads(response.data.decode())['users'] == [
+        {'email': 'a.test@example.com'},
+    ]
+
+
+def test_replicas_refuse_writes(replicas):
+    """Test that connections to a replica cannot write."""
+    with pytest.raises(OperationalError):
+        with replicas[0].begin() as connection:
+            connection.execute(User.__table__.delete())
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Differential tests of compiled dump functions against marshmallow."""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from marshmallow import Schema, fields, post_dump
+from sqlalchemy import select
+
+from falcon_experiment.db import Session, engine
+from falcon_experiment.models import Group, User
+from falcon_experiment.schemas import GroupSchema, UserSchema
+from falcon_experiment.serializers import CompileError, compile_dump
+
+NAIVE = datetime(2016, 2, 29, 12, 30, 15, 123456)
+AWARE = datetime(2016, 2, 29, 12, 30, tzinfo=timezone(timedelta(hours=-5)))
+
+
+class Thing(object):
+
+    """An object with attributes to dump, some of them callable."""
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class ThingSchema(Schema):
+
+    """A schema using the field options compile_dump supports."""
+
+    name = fields.Str(dump_to='title')
+    size = fields.Int(attribute='length', default=0)
+    weight = fields.Float()
+    when = fields.DateTime(format='%Y-%m-%d')
+    secret = fields.Str(load_only=True)
+    tags = fields.Nested('ThingSchema', many=True, only=('name',))
+    parent = fields.Nested('ThingSchema', exclude=('tags', 'parent'))
+
+
+def assert_same(schema, obj):
+    """Assert a compiled dump returns what marshmallow does, in order."""
+    expected = schema.dump(obj).data
+    actual = compile_dump(schema)(obj)
+    assert actual == expected
+    if isinstance(expected, dict):
+        assert list(actual) == list(expected)
+
+
+def users():
+    """Return users covering the values a User's fields may take."""
+    return [
+        User(email='a.test@example.com', username='A Test', created=NAIVE),
+        User(email='b.test@example.com', username='B Test', created=AWARE),
+        User(email='c.test@example.com', username='C Test'),
+        User(email='d.test@example.com', username=b'D Test', created=NAIVE),
+    ]
+
+
+@pytest.mark.parametrize('user', users(), ids=[
+    'naive', 'aware', 'no created', 'bytes',
+])
+def test_user(user):
+    """Test dumping users as objects."""
+    assert_same(UserSchema(), user)
+
+
+@pytest.mark.parametrize('document', [
+    {'email': 'a.test@example.com', 'username': 'A Test', 'created': NAIVE},
+    {'email': 'a.test@example.com'},
+    {},
+], ids=['whole', 'partial', 'empty'])
+def test_user_mapping(document):
+    """Test dumping users as mappings, whose missing keys are left out."""
+    assert_same(UserSchema(), document)
+
+
+def test_users_many():
+    """Test dumping many users at once."""
+    assert_same(UserSchema(many=True), users())
+    assert_same(UserSchema(many=True), [])
+
+
+@pytest.mark.parametrize('members', [0, 1, 3])
+def test_group_nested(members):
+    """Test dumping groups with their members nested, excluding fields."""
+    group = Group(
+        id=1, name='Test Group', created=NAIVE, users=users()[:members]
+    )
+    assert_same(GroupSchema(), group)
+    assert_same(GroupSchema(exclude=['users']), group)
+
+
+def test_group_rows(db):
+    """Test dumping rows of groups, with their member counts."""
+    Session.add(Group(name='Test Group', users=users()))
+    Session.add(Group(name='Other Group'))
+    Session.commit()
+    Session.remove()
+
+    query = Group.with_member_count(select([Group.__table__]))
+    with engine.connect() as connection:
+        rows = [row._mapping for row in connection.execute(query)]
+    assert [row['member_count'] for row in rows] == [4, 0]
+    for row in rows:
+        assert_same(GroupSchema(exclude=['users']), row)
+
+
+@pytest.mark.parametrize('thing', [
+    Thing(
+        name='Thing', length=3, weight=1, when=NAIVE, secret='x',
+        tags=[Thing(name='a'), Thing(name='b')],
+        parent=Thing(name='Parent', length=lambda: 4),
+    ),
+    Thing(name=None, weight=None, when=None, tags=None),
+    Thing(),
+], ids=['whole', 'none', 'empty'])
+def test_field_options(thing):
+    """Test the field options compile_dump supports, on objects and dicts."""
+    assert_same(ThingSchema(), thing)
+    assert_same(ThingSchema(), vars(thing))
+    assert_same(ThingSchema(prefix='thing_'), thing)
+
+
+@pytest.mark.parametrize('when', [NAIVE, AWARE, None], ids=[
+    'naive', 'aware', 'none',
+])
+def test_local_datetimes(when):
+    """Test that datetimes dumped in local time keep their own offsets."""
+    class LocalSchema(Schema):
+        local = fields.LocalDateTime()
+        localtime = fields.DateTime(localtime=True)
+        formatted = fields.LocalDateTime(format='%Y-%m-%d %H:%M')
+
+    schema = LocalSchema()
+    # Marshmallow keeps localtime=True as metadata, and dumps in UTC, unless
+    # the field's attribute is set as LocalDateTime sets it
+    assert_same(schema, Thing(localtime=when))
+    schema.fields['localtime'].localtime = True
+    thing = Thing(local=when, localtime=when, formatted=when)
+    assert_same(schema, thing)
+    if when is AWARE:
+        assert compile_dump(schema)(thing)['local'].endswith('-05:00')
+
+
+def test_ordered():
+    """Test that ordered schemas dump ordered dictionaries."""
+    class OrderedSchema(ThingSchema):
+        class Meta(object):
+            ordered = True
+
+    thing = Thing(name='Thing', length=3, tags=[Thing(name='a')])
+    assert type(compile_dump(OrderedSchema())(thing)) is type(
+        OrderedSchema().dump(thing).data
+    )
+    assert_same(OrderedSchema(), thing)
+
+
+def test_unsupported():
+    """Test that compiling what we do not support raises a CompileError."""
+    class BooleanSchema(Schema):
+        flag = fields.Bool()
+
+    class ProcessedSchema(Schema):
+        name = fields.Str()
+
+        @post_dump
+        def process(self, data):
+            return data
+
+    class RFCSchema(Schema):
+        when = fields.DateTime(format='rfc')
+
+    class StringSchema(Schema):
+        number = fields.Int(as_string=True)
+
+    for schema in (
+        BooleanSchema(), ProcessedSchema(), RFCSchema(), StringSchema()
+    ):
+        with pytest.raises(CompileError):
+            compile_dump(schema)
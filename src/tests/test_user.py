@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 """Tests for the user endpoints."""
 
+import base64
 import json
 from urllib.parse import urlparse
 
 import pytest
+from sqlalchemy import event
+
+from falcon_experiment import app
+from falcon_experiment.app import JSONRequest
+from falcon_experiment.media import msgpack
+from falcon_experiment.models import Group, User
+
+requires_msgpack = pytest.mark.skipif(
+    msgpack is None, reason='msgpack is not installed'
+)
 
 
 @pytest.yield_fixture()
@@ -114,3 +125,386 @@ def test_delete_user_not_found(client):
     response = client.delete('/user/does-not-exist')
     assert response.status == '404 Not Found'
     assert response.data == b''
+
+
+@pytest.yield_fixture()
+def users(client):
+    """Fixture to yield the emails of several created users, in order."""
+    emails = ['{}.test@example.com'.format(name) for name in 'abcde']
+    for email in emails:
+        client.post(
+            '/user',
+            data=json.dumps({'email': email, 'username': 'A Test'}),
+            content_type='application/json',
+        )
+
+    yield emails
+
+    for email in emails:
+        client.delete('/user/{}'.format(email))
+
+
+def test_get_users(client, users):
+    """Test that the user collection lists every user, ordered by email."""
+    response = client.get('/user')
+    assert response.status == '200 OK'
+    body = json.loads(response.data.decode())
+    assert [user['email'] for user in body['users']] == users
+    assert body['users'][0]['username'] == 'A Test'
+    assert body['users'][0]['created']
+    assert body['next'] is None
+
+
+def test_get_users_paginated(client, users):
+    """
+    Test paging through the user collection.
+
+    Following the next cursor should visit every user exactly once, and the
+    final page should not offer a next cursor.
+    """
+    seen = []
+    query_string = 'limit=2'
+    while True:
+        response = client.get('/user', query_string=query_string)
+        assert response.status == '200 OK'
+        body = json.loads(response.data.decode())
+        assert len(body['users']) <= 2
+        seen.extend(user['email'] for user in body['users'])
+        if body['next'] is None:
+            break
+        query_string = 'limit=2&cursor={}'.format(body['next'])
+
+    assert seen == users
+
+
+def test_get_users_invalid_cursor(client):
+    """Test that a cursor we did not issue returns a HTTP Bad Request."""
+    response = client.get('/user', query_string='cursor=not-a-cursor')
+    assert response.status == '400 Bad Request'
+
+
+@pytest.mark.parametrize('path,key', [
+    ('/user', [1]),
+    ('/user', {'a': 1}),
+    ('/user', 1),
+    ('/group', 'a.test@example.com'),
+    ('/group', True),
+    ('/group', 1.5),
+    ('/group/1/users', [1]),
+    ('/user/a.test@example.com/groups', {'a': 1}),
+])
+def test_get_forged_cursor(client, path, key):
+    """Test that a cursor whose key is not of the paged column's type is bad.
+
+    Cursors are base64 encoded JSON, so may be forged to hold any value.
+    """
+    for path_created, document in (
+        ('/user', {'email': 'a.test@example.com', 'username': 'A Test'}),
+        ('/group', {'name': 'Group'}),
+    ):
+        client.post(
+            path_created,
+            data=json.dumps(document),
+            content_type='application/json',
+        )
+    cursor = base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+    response = client.get(path, query_string='cursor={}'.format(cursor))
+    assert response.status == '400 Bad Request'
+
+
+def test_get_users_limit_out_of_range(client):
+    """Test that a page size over the maximum returns a HTTP Bad Request."""
+    response = client.get('/user', query_string='limit=100000')
+    assert response.status == '400 Bad Request'
+
+
+def test_post_users_bulk(client, user):
+    """
+    Test that many users can be created from a list in one request.
+
+    Each user is reported on in turn: created, already existing or invalid.
+    """
+    payload = json.dumps([
+        {'username': 'B Test', 'email': 'b.test@example.com'},
+        {'username': 'A Test', 'email': 'a.test@example.com'},
+        {'username': 'C Test', 'emial': 'c.test@example.com'},
+        {'username': 'B Test', 'email': 'b.test@example.com'},
+    ])
+    response = client.post(
+        '/user', data=payload, content_type='application/json'
+    )
+    assert response.status == '200 OK'
+    body = json.loads(response.data.decode())
+    assert body['users'] == [
+        {
+            'status': 'created',
+            'uri': 'http://localhost:8000/user/b.test@example.com',
+        },
+        {
+            'status': 'exists',
+            'uri': 'http://localhost:8000/user/a.test@example.com',
+        },
+        {
+            'status': 'invalid',
+            'errors': {'email': ['Missing data for required field.']},
+        },
+        {
+            'status': 'exists',
+            'uri': 'http://localhost:8000/user/b.test@example.com',
+        },
+    ]
+
+    response = client.get('/user/b.test@example.com')
+    assert response.status == '200 OK'
+    assert json.loads(response.data.decode())['username'] == 'B Test'
+
+
+def test_post_users_bulk_malformed(client):
+    """
+    Test that a bulk request with malformed JSON creates no users.
+
+    The body is only found to be malformed after the first users are read.
+    """
+    payload = '[{}, {{'.format(json.dumps(
+        {'username': 'A Test', 'email': 'a.test@example.com'}
+    ))
+    response = client.post(
+        '/user', data=payload, content_type='application/json'
+    )
+    assert response.status == '400 Bad Request'
+    body = json.loads(response.data.decode())
+    assert body['title'] == 'Malformed JSON'
+
+    response = client.get('/user/a.test@example.com')
+    assert response.status == '404 Not Found'
+
+
+def test_post_user_too_large(client, monkeypatch):
+    """Test that a body over the size limit returns a HTTP 413."""
+    monkeypatch.setattr(JSONRequest, 'max_body_size', 16)
+    payload = json.dumps({
+        'username': 'A Test',
+        'email': 'a.test@example.com'
+    })
+    response = client.post(
+        '/user', data=payload, content_type='application/json'
+    )
+    assert response.status == '413 Payload Too Large'
+
+    # Arrays may be larger, as long as each of their items is not
+    monkeypatch.setattr(JSONRequest, 'max_body_size', len(payload))
+    response = client.post(
+        '/user',
+        data='[{}, {}]'.format(payload, payload),
+        content_type='application/json',
+    )
+    assert response.status == '200 OK'
+
+
+def test_post_users_item_too_large(client, monkeypatch):
+    """Test that an array with an item over the size limit is a HTTP 413."""
+    monkeypatch.setattr(JSONRequest, 'max_body_size', 1024)
+    monkeypatch.setattr(JSONRequest, 'read_size', 64)
+    payload = json.dumps([
+        {'username': 'A Test', 'email': 'a.test@example.com'},
+        {'username': 'B' * 2048, 'email': 'b.test@example.com'},
+    ])
+    response = client.post(
+        '/user', data=payload, content_type='application/json'
+    )
+    assert response.status == '413 Payload Too Large'
+
+
+@requires_msgpack
+def test_post_and_get_user_msgpack(client):
+    """Test that users can be created and retrieved in MessagePack."""
+    payload = msgpack.packb({
+        'username': 'A Test',
+        'email': 'a.test@example.com'
+    })
+    response = client.post(
+        '/user', data=payload, content_type='application/msgpack',
+        headers={'Accept': 'application/msgpack'},
+    )
+    assert response.status == '201 Created'
+    assert response.headers['Content-Type'] == 'application/msgpack'
+    body = msgpack.unpackb(response.data, raw=False)
+    assert body['uri'] == 'http://localhost:8000/user/a.test@example.com'
+
+    response = client.get(
+        '/user/a.test@example.com',
+        headers={'Accept': 'application/msgpack'},
+    )
+    assert response.status == '200 OK'
+    body = msgpack.unpackb(response.data, raw=False)
+    assert body['username'] == 'A Test'
+
+
+@requires_msgpack
+def test_post_user_bad_request_msgpack(client):
+    """Test that errors are encoded in MessagePack for clients asking."""
+    response = client.post(
+        '/user', data=msgpack.packb({'email': 'not an email'}),
+        content_type='application/msgpack',
+        headers={'Accept': 'application/msgpack'},
+    )
+    assert response.status == '400 Bad Request'
+    assert response.headers['Content-Type'] == 'application/msgpack'
+    body = msgpack.unpackb(response.data, raw=False)
+    assert body['title'] == 'Invalid document submitted'
+
+
+def test_get_user_not_acceptable(client):
+    """Test that a client accepting no format we speak gets a HTTP 406.
+
+    Its error is encoded in JSON, the default.
+    """
+    response = client.get(
+        '/user/a.test@example.com', headers={'Accept': 'text/html'}
+    )
+    assert response.status == '406 Not Acceptable'
+    assert response.headers['Content-Type'] == 'application/json'
+    body = json.loads(response.data.decode())
+    assert body['title'] == 'Media type not acceptable'
+
+
+def test_post_user_unsupported_media_type(client):
+    """Test that a body in a format we do not speak gets a HTTP 415."""
+    response = client.post(
+        '/user', data='email=a.test@example.com', content_type='text/plain'
+    )
+    assert response.status == '415 Unsupported Media Type'
+
+
+def test_get_user_etag(client, user):
+    """
+    Test conditional retrieval of a user.
+
+    A client sending back the ETag it was given should be told the user is
+    not modified, whether or not the user is cached.
+    """
+    response = client.get(user)
+    etag = response.headers['ETag']
+    assert etag.startswith('"') and etag.endswith('"')
+
+    for clear_cache in (False, True):
+        if clear_cache:
+            app.cache.clear()
+        response = client.get(user, headers={'If-None-Match': etag})
+        assert response.status == '304 Not Modified'
+        assert response.headers['ETag'] == etag
+        assert response.data == b''
+
+    response = client.get(user, headers={'If-None-Match': '"other"'})
+    assert response.status == '200 OK'
+    assert response.headers['ETag'] == etag
+
+
+def test_get_user_etag_not_found(client):
+    """Test that revalidating a user that does not exist is Not Found."""
+    response = client.get(
+        '/user/does-not-exist', headers={'If-None-Match': '"any"'}
+    )
+    assert response.status == '404 Not Found'
+
+
+@requires_msgpack
+def test_get_user_etag_per_media_type(client, user):
+    """Test that each encoding of a user has an ETag of its own."""
+    json_etag = client.get(user).headers['ETag']
+    msgpack_etag = client.get(
+        user, headers={'Accept': 'application/msgpack'}
+    ).headers['ETag']
+    assert json_etag != msgpack_etag
+
+
+def test_get_user_groups_paginated(client, users):
+    """Test paging through the groups a user is in, ordered by id."""
+    names = ['Group {}'.format(number) for number in range(5)]
+    for name in names:
+        client.post(
+            '/group',
+            data=json.dumps({'name': name, 'users': [{'email': users[0]}]}),
+            content_type='application/json',
+        )
+    client.post(
+        '/group',
+        data=json.dumps({'name': 'Other', 'users': [{'email': users[1]}]}),
+        content_type='application/json',
+    )
+
+    seen = []
+    query_string = 'limit=2'
+    while True:
+        response = client.get(
+            '/user/{}/groups'.format(users[0]), query_string=query_string
+        )
+        assert response.status == '200 OK'
+        body = json.loads(response.data.decode())
+        seen.extend(group['name'] for group in body['groups'])
+        if body['next'] is None:
+            break
+        query_string = 'limit=2&cursor={}'.format(body['next'])
+
+    assert seen == names
+
+
+def test_get_user_groups_not_found(client):
+    """Test that listing groups of a missing user returns Not Found."""
+    response = client.get('/user/does-not-exist@example.com/groups')
+    assert response.status == '404 Not Found'
+
+
+def test_delete_users_batch(client, users):
+    """Test deleting many users at once, removing them from their groups."""
+    response = client.post(
+        '/group',
+        data=json.dumps({
+            'name': 'Test Group',
+            'users': [{'email': email} for email in users[:3]],
+        }),
+        content_type='application/json',
+    )
+    group = urlparse(json.loads(response.data.decode())['uri']).path
+    etag = client.get(group).headers['ETag']
+
+    loaded = []
+
+    def load(target, context):
+        loaded.append(target)
+
+    event.listen(Group, 'load', load)
+    event.listen(User, 'load', load)
+    try:
+        response = client.delete('/user', query_string=[
+            ('email', users[0]), ('email', users[1]),
+            ('email', 'does-not-exist@example.com'), ('email', users[0]),
+        ])
+    finally:
+        event.remove(Group, 'load', load)
+        event.remove(User, 'load', load)
+
+    assert response.status == '200 OK'
+    assert json.loads(response.data.decode())['users'] == [
+        {'email': users[0], 'status': 'deleted'},
+        {'email': users[1], 'status': 'deleted'},
+        {'email': 'does-not-exist@example.com', 'status': 'not found'},
+    ]
+    assert loaded == []
+    assert client.get('/user/{}'.format(users[0])).status == '404 Not Found'
+
+    response = client.get(group, headers={'If-None-Match': etag})
+    assert response.status == '200 OK'
+    assert json.loads(response.data.decode())['users'] == [
+        {'email': users[2]}
+    ]
+
+
+def test_delete_users_batch_bad_request(client):
+    """Test that a batch delete needs emails, and not too many of them."""
+    response = client.delete('/user')
+    assert response.status == '400 Bad Request'
+
+    emails = ','.join('{}@example.com'.format(n) for n in range(1001))
+    response = client.delete('/user', query_string='email=' + emails)
+    assert response.status == '400 Bad Request'